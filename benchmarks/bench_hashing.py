@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# pyORM : Microbenchmark of hashing for Q & F objects
+
+Summary :
+    Compare structural hashing of Q & F objects against hashing their repr.
+Use Case :
+    As a developer I want to measure the cost of using filter trees as cache keys
+    So that I can tell whether changes to Q & F make hot paths slower
+
+Testable Statements :
+    Can I time hash & dict lookups on 100 term filter trees
+    ....
+
+    Run from the root of the repository : PYTHONPATH=. python benchmarks/bench_hashing.py
+"""
+import timeit
+from functools import reduce
+
+import click
+
+from pyorm.db.models.queryset import Q, F
+
+__version__ = "0.1"
+__author__ = 'Tony Flury : anthony.flury@btinternet.com'
+__created__ = '18 Oct 2026'
+
+
+def q_tree(terms):
+    """A Q tree of the given number of terms - a mix of AND, OR and negation"""
+    leaves = [Q(**{'field_{}__gt'.format(index): index}) for index in range(terms)]
+    return reduce(lambda tree, leaf: (tree | ~leaf) if leaf._members[0][1] % 3 else (tree & leaf), leaves)
+
+
+def f_tree(terms):
+    """A F expression of the given number of terms"""
+    return reduce(lambda tree, index: tree + F('field_{}'.format(index)) * index,
+                  range(1, terms), F('field_0'))
+
+
+def time_it(statement, number):
+    """Best of 5 runs - in microseconds per call"""
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e6
+
+
+def compare(name, build, terms, number):
+    """Time repr based hashing against structural hashing - for both a fresh and a reused tree"""
+    tree, twin = build(terms), build(terms)
+    cache = {tree: None}
+
+    results = [
+        ('{} hash (repr)'.format(name), time_it(lambda: hash(repr(tree)), number)),
+        ('{} hash (structural, cold)'.format(name), time_it(lambda: hash(build(terms)), number // 10)
+            - time_it(lambda: build(terms), number // 10)),
+        ('{} hash (structural, cached)'.format(name), time_it(lambda: hash(tree), number)),
+        ('{} dict lookup (repr)'.format(name), time_it(lambda: {repr(tree): None}.get(repr(twin)), number)),
+        ('{} dict lookup (structural)'.format(name), time_it(lambda: twin in cache, number)),
+    ]
+    return results
+
+
+@click.command()
+@click.option('-t', '--terms', default=100, help='Number of terms in each tree')
+@click.option('-n', '--number', default=1000, help='Number of calls per timing run')
+def main(terms, number):
+    """Report the cost of hashing Q & F trees - repr hashing is the previous implementation"""
+    for name, build in (('Q', q_tree), ('F', f_tree)):
+        for label, micro_seconds in compare(name, build, terms, number):
+            click.echo('{:<32} {:>10.2f} us'.format(label, micro_seconds))
+
+
+if __name__ == '__main__':
+    main()
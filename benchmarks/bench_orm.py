@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# pyORM : Benchmarks of the ORM hot paths, with regression thresholds
+
+Summary :
+    Time the building & compiling of queries, model instances, and sqlite round trips - against raw sqlite3.
+Use Case :
+    As a developer I want to quantify the overhead of the ORM on its hot paths
+    So that I can tell when a change makes one of them slower
+
+Testable Statements :
+    Can I time Q/F trees, deep joins, query set clones, model instances and row conversion
+    Can I time select, insert & update round trips against the same statements through raw sqlite3
+    Can I save the results to JSON, and fail a run which regresses past a threshold
+    ....
+
+    Run from the root of the repository :
+        PYTHONPATH=. python benchmarks/bench_orm.py -r 1000 -r 100000 -r 1000000 -o results.json
+        PYTHONPATH=. python benchmarks/bench_orm.py -b results.json --threshold 0.25
+
+    Results are operations per second - calls for the in memory paths, rows for the round trips - and the
+    peak memory allocated by a single operation. With a baseline the run exits with status 1 if any result
+    is more than the threshold slower than in the baseline.
+"""
+import json
+import platform
+import sqlite3
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from functools import reduce
+
+import click
+
+from pyorm.db.engine.sqlite import Engine
+from pyorm.db.models.models import Model
+from pyorm.db.models.queryset import Q, F, Join, QuerySet, LOOKUP_SEP
+import pyorm.db.models.fields as fields
+
+__version__ = "0.1"
+__author__ = 'Tony Flury : anthony.flury@btinternet.com'
+__created__ = '18 Oct 2026'
+
+
+def best_of(run, setup=None, number=1, repeat=5):
+    """The quickest of repeat timings of number calls - in seconds per call. setup is called (untimed) before each"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        for _ in range(number):
+            run()
+        timings.append((time.perf_counter() - started) / number)
+    return min(timings)
+
+
+def peak_memory(run, setup=None):
+    """The peak memory in bytes allocated during a single call"""
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(run, setup=None, number=1, repeat=5, ops=1, unit='call'):
+    """A result - operations per second (ops per call) and the peak memory of one call"""
+    seconds = best_of(run, setup=setup, number=number, repeat=repeat)
+    return OrderedDict([('ops_per_sec', ops / seconds), ('unit', unit), ('seconds', seconds),
+                        ('peak_bytes', peak_memory(run, setup=setup))])
+
+
+class Schema:
+    """The models being benchmarked - built on an in memory database"""
+    def __init__(self, terms, depth):
+        self.engine = Engine(':memory:')
+
+        # A wide model for the Q & F trees - field_0 ... field_<terms-1>
+        attrs = OrderedDict(('field_{}'.format(index), fields.IntegerField()) for index in range(terms))
+        attrs['_engine'] = self.engine
+        self.wide = type('BenchWide', (Model,), attrs)
+
+        # A chain of models, each with a foreign key to the next - for deep join trees
+        model = type('BenchLevel{}'.format(depth), (Model,), {'_engine': self.engine, 'name': fields.CharField()})
+        for level in reversed(range(depth)):
+            model = type('BenchLevel{}'.format(level), (Model,), {'_engine': self.engine, 'name': fields.CharField(),
+                                                                  'next': fields.ForeignKey(model)})
+        self.levels = model
+
+        self.row = type('BenchRow', (Model,), {'_engine': self.engine, 'name': fields.CharField(),
+                                               'value': fields.IntegerField()})
+
+        # The in memory database lives as long as a connection to it is open
+        self.connection = self.engine.connect()
+        self.connection.execute('CREATE TABLE {} (id integer PRIMARY KEY, name text, value integer)'.format(
+                                self.row.table_name()))
+
+        self.raw = sqlite3.connect(':memory:', isolation_level=None)
+        self.raw.execute('CREATE TABLE raw_row (id integer PRIMARY KEY, name text, value integer)')
+
+    def close(self):
+        self.connection.close()
+        self.raw.close()
+        Engine.reset()
+
+
+def q_tree(terms):
+    """A Q tree of the given number of terms - a mix of AND, OR and negation"""
+    leaves = [Q(**{'field_{}__gt'.format(index): index}) for index in range(terms)]
+    return reduce(lambda tree, leaf: (tree | ~leaf) if leaf._members[0][1] % 3 else (tree & leaf), leaves)
+
+
+def f_tree(terms):
+    """A F expression of the given number of terms"""
+    return reduce(lambda tree, index: tree + F('field_{}'.format(index)) * index, range(1, terms), F('field_0'))
+
+
+def in_memory(schema, terms, depth, number):
+    """The paths which don't touch the database - each op is one call"""
+    wide, row = schema.wide, schema.row
+    engine = schema.engine
+    q, f = q_tree(terms), f_tree(terms)
+
+    def resolve(tree):
+        return lambda: tree.resolve(default_alias='BenchWide', engine=engine, model=wide,
+                                    joins=Join(root_model=wide))
+
+    join = Join(root_model=schema.levels)
+    join.addJoin(LOOKUP_SEP.join(['next'] * depth))
+
+    def clone_chain():
+        qs = QuerySet(model=row)
+        for index in range(10):
+            qs = qs.filter(value__gt=index).exclude(name='row {}'.format(index)).order_by('value', '-id')
+        return qs
+
+    instance = row(name='row', value=1)
+
+    def set_value():
+        instance.value = 5
+
+    db_data = {'id': 1, 'name': 'row', 'value': 1}
+    return OrderedDict([
+        ('q_tree_build', measure(lambda: q_tree(terms), number=number // 10 or 1)),
+        ('q_tree_resolve', measure(resolve(q), number=number // 10 or 1)),
+        ('f_tree_resolve', measure(resolve(f), number=number // 10 or 1)),
+        ('join_to_sql', measure(join.to_sql, number=number)),
+        ('queryset_clone_chain', measure(clone_chain, number=number // 10 or 1)),
+        ('model_init', measure(lambda: row(name='row', value=1), number=number)),
+        ('model_setattr', measure(set_value, number=number)),
+        ('db_data_to_model_attrs', measure(lambda: row._db_data_to_model_attrs(db_data), number=number)),
+    ])
+
+
+def round_trips(schema, rows):
+    """Select, insert & update of every row - through the ORM and through raw sqlite3. Each op is one row"""
+    model, raw, table = schema.row, schema.raw, schema.row.table_name()
+    data = [('row {}'.format(index), index) for index in range(rows)]
+    repeat = 3 if rows <= 100000 else 1
+
+    def clear():
+        schema.engine.execute('DELETE FROM {}'.format(table))
+        raw.execute('DELETE FROM raw_row')
+
+    def fill():
+        clear()
+        model.objects.bulk_create(model(name=name, value=value) for name, value in data)
+        raw_insert()
+
+    def orm_insert():
+        model.objects.bulk_create(model(name=name, value=value) for name, value in data)
+
+    def raw_insert():
+        raw.execute('BEGIN')
+        raw.executemany('INSERT INTO raw_row (name, value) VALUES (?, ?)', data)
+        raw.execute('COMMIT')
+
+    results = OrderedDict()
+    for name, orm, baseline, setup in (
+            ('insert', orm_insert, raw_insert, clear),
+            ('select', lambda: list(model.objects.all()),
+             lambda: raw.execute('SELECT id, name, value FROM raw_row').fetchall(), fill),
+            ('update', lambda: model.objects.update(value=F('value') + 1),
+             lambda: raw.execute('UPDATE raw_row SET value = value + 1'), fill)):
+        orm_result = measure(orm, setup=setup, repeat=repeat, ops=rows, unit='row')
+        raw_result = measure(baseline, setup=setup, repeat=repeat, ops=rows, unit='row')
+        orm_result['overhead'] = raw_result['ops_per_sec'] / orm_result['ops_per_sec']
+        results['{}_{}'.format(name, rows)] = orm_result
+        results['raw_{}_{}'.format(name, rows)] = raw_result
+    clear()
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """The results more than threshold slower than the baseline - a list of (name, baseline, now) ops per second"""
+    slower = []
+    for name, result in results.items():
+        previous = baseline.get(name, None)
+        if previous is not None and result['ops_per_sec'] < previous['ops_per_sec'] * (1 - threshold):
+            slower.append((name, previous['ops_per_sec'], result['ops_per_sec']))
+    return slower
+
+
+@click.command()
+@click.option('-r', '--rows', type=int, multiple=True, default=[1000],
+              help='Number of rows for the round trips - repeat for several sizes (e.g. -r 1000 -r 100000 -r 1000000)')
+@click.option('-n', '--number', default=1000, help='Number of calls per timing run of the in memory paths')
+@click.option('-t', '--terms', default=100, help='Number of terms in each Q & F tree')
+@click.option('-d', '--depth', default=10, help='Number of joins in the deep join tree')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Save the results to this JSON file')
+@click.option('-b', '--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Compare with the results saved in this JSON file')
+@click.option('--threshold', default=0.25, help='Fraction slower than the baseline which counts as a regression')
+def main(rows, number, terms, depth, output, baseline, threshold):
+    """Report ops/sec & peak memory for the ORM hot paths - round trips are compared with raw sqlite3"""
+    schema = Schema(terms, depth)
+    try:
+        results = in_memory(schema, terms, depth, number)
+        for size in rows:
+            results.update(round_trips(schema, size))
+    finally:
+        schema.close()
+
+    for name, result in results.items():
+        click.echo('{:<32} {:>14,.0f} {:<4}/s {:>12,} bytes{}'.format(
+            name, result['ops_per_sec'], result['unit'], result['peak_bytes'],
+            '   x{:.2f} raw sqlite3'.format(result['overhead']) if 'overhead' in result else ''))
+
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(OrderedDict([('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                                   ('python', platform.python_version()),
+                                   ('sqlite', sqlite3.sqlite_version),
+                                   ('results', results)]), output_file, indent=2)
+
+    if baseline:
+        with open(baseline) as baseline_file:
+            slower = regressions(results, json.load(baseline_file)['results'], threshold)
+        for name, previous, now in slower:
+            click.echo('REGRESSION {:<32} {:>14,.0f}/s -> {:,.0f}/s'.format(name, previous, now), err=True)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,21 @@ PROJ = Path(__file__).parent()
 # Keys:
 #   'database': The path to the application database
 #   'engine' : The Engine class of the appropruate db engine module
+#   'pool' : Optional connection pool settings - a dictionary with any of :
+#               'min_size' : Number of connections kept open when idle (default 0)
+#               'max_size' : Maximum number of open connections (default unlimited)
+#               'timeout' : Seconds to wait for a connection when the pool is exhausted
+#               'idle_timeout' : Seconds an unused connection is kept open (default 0)
+#               'recycle' : Close a connection after this many uses (default never)
+#   'options' : Optional engine options - for sqlite a dictionary with any of :
+#               'profile' : A named set of the options below - 'durable', 'balanced' or 'bulk-load'
+#               'journal_mode' : DELETE, TRUNCATE, PERSIST, MEMORY, WAL or OFF
+#               'synchronous' : OFF, NORMAL, FULL or EXTRA
+#               'cache_size' : Pages (positive) or KiB (negative) of page cache per connection
+#               'mmap_size' : Bytes of the database to memory map
+#               'temp_store' : DEFAULT, FILE or MEMORY
+#               'busy_timeout' : Milliseconds to wait for a locked database
+#             Options given explicitly override those from the profile
 #
 db = { 'database': PROJ / 'database.db',
        'engine': db.engine.sqlite.Engine}
@@ -91,6 +91,13 @@ class LimitsError(QuerySetError):
     """Public API exception when there is an error in the Limits value"""
     pass
 
+class CursorError(QuerySetError):
+    """Public API exception when a pagination cursor is invalid for the query"""
+    pass
+
 class NotModfiable(QuerySetError):
     """Public API exception when the query cannot be modified"""
-    pass
\ No newline at end of file
+    pass
+class MigrationError(pyOrmBaseException):
+    """Public API exception when a migration can't be applied"""
+    pass
@@ -41,7 +41,8 @@ class ImportEngine:
             module_name, cls_name = '.'.join(class_name.split('.')[:-1]), class_name.split('.')[-1]
             self._module = importlib.import_module(name=module_name)
             self._engine_cls = getattr(self._module, cls_name)
-            self._engine_inst = self._engine_cls(self._settings.get('database'))
+            self._engine_inst = self._engine_cls(self._settings.get('database'), pool=self._settings.get('pool'),
+                                                 options=self._settings.get('options'))
 
     def engine_cls(self):
         return self._engine_cls
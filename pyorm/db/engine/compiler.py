@@ -12,8 +12,14 @@ Testable Statements :
     Can I <Boolean statement>
     ....
 """
+import threading
+from collections import OrderedDict, namedtuple
+
 import pyorm.core.exceptions as exceptions
-from functools import wraps
+from pyorm.db.models.queryset import F, Join
+from pyorm.db.models.utils import Annotation
+from pyorm.db.models.functions import TruncDate, Function
+from pyorm.db.models.aggregates import Aggregate
 
 __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
@@ -21,17 +27,90 @@ __created__ = '31 Aug 2017'
 
 LOOKUP_SEP = '__'
 
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'size', 'maxsize'])
+
+
+class SQLCache:
+    """A thread safe LRU cache of compiled SQL templates, keyed on the structure of the query"""
+    def __init__(self, maxsize=256):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """Return the SQL cached for this key (or None) - counts the hit or miss"""
+        with self._lock:
+            sql = self._entries.get(key, None)
+            if sql is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+            return sql
+
+    def put(self, key, sql):
+        """Cache the SQL for this key - discarding the least recently used entries if full"""
+        with self._lock:
+            self._entries[key] = sql
+            self._entries.move_to_end(key)
+            self._trim()
+
+    def _trim(self):
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        with self._lock:
+            self._maxsize = value
+            self._trim()
+
+    def clear(self):
+        """Empty the cache and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._misses = 0
+
+    def stats(self):
+        """A CacheStats snapshot of the hit & miss counters and the occupancy"""
+        with self._lock:
+            return CacheStats(hits=self._hits, misses=self._misses,
+                              size=len(self._entries), maxsize=self._maxsize)
+
+
 class Compiler:
     _lookups = {}
 
+    sql_cache = SQLCache()
+
     def __init__(self, engine, obj):
         self._engine = engine
         self._obj = obj
 
+    @classmethod
+    def cache_stats(cls):
+        """Hit & miss counters for the compiled SQL cache"""
+        return cls.sql_cache.stats()
+
+    @classmethod
+    def clear_cache(cls):
+        cls.sql_cache.clear()
+
 
     def lookup(self, lookup, value):
+        """Compile a field lookup into the tables it needs and the comparison
+
+           Returns a 2-tuple : (tables, (sql_fragment, params))
+        """
         parts = lookup.split(LOOKUP_SEP)
-        lookup_callable = self._lookups.get(parts[-1],None)
+        comparisons = self._engine._comparisons if self._engine is not None else self._lookups
+        lookup_callable = comparisons.get(parts[-1],None)
         if lookup_callable is None:
             raise exceptions.UnknownLookup('Unknown field lookup {}'.format(parts[-1]))
 
@@ -44,4 +123,378 @@ class Compiler:
         else:
             tables = []
 
-        return (tables, lookup_callable(field,value))
\ No newline at end of file
+        return (tables, lookup_callable(field,value))
+
+    def _wrapped(self, form):
+        """True if a COUNT or EXISTS probe has to wrap the full SELECT - i.e. if DISTINCT, limits or grouping apply"""
+        query = self._obj
+        if form == 'count':
+            return bool(query.options or query.limits) or any(
+                isinstance(field, Annotation) and isinstance(field.args[0], Aggregate) for field in query.fields)
+        return form == 'exists' and bool(query.limits)
+
+    def fingerprint(self, form='select'):
+        """The structural key of the query, and the values to be bound in placeholder order
+
+           Literal values are excluded from the key, so queries which differ only by their
+           values share a key - and share the cached SQL.
+        """
+        query = self._obj
+        select = form == 'select' or self._wrapped(form)
+        params = []
+
+        fields = []
+        for field in query.fields:
+            shape, field_params = self._expression_fingerprint(field)
+            fields.append(shape)
+            if select:
+                params.extend(field_params)
+
+        criteria, criteria_params = query.criteria.fingerprint()
+        params.extend(criteria_params)
+
+        if query.keyset:
+            descending = [self._descending(item) for item in query.order_by]
+            if len(descending) == len(query.keyset):
+                nullable = [self._nullable(item, query.model) for item in query.order_by]
+                params.extend(self.keyset([''] * len(descending), descending, query.keyset, nullable)[1])
+            else:
+                params.extend(query.keyset)
+
+        order_by = []
+        for item in query.order_by:
+            shape, item_params = self._expression_fingerprint(item)
+            order_by.append(shape)
+            if form == 'select':
+                params.extend(item_params)
+
+        if select:
+            params.extend(query.limits)
+
+        engine = self._engine if isinstance(self._engine, type) else self._engine.__class__
+        key = (engine, form, query.model, tuple(query.options), tuple(fields), tuple(query.joins),
+               criteria, tuple(order_by), tuple(value is None for value in query.keyset), len(query.limits))
+        return key, params
+
+    @staticmethod
+    def _expression_fingerprint(expression):
+        if isinstance(expression, F):
+            return expression.fingerprint()
+        return expression, []
+
+    def as_sql(self, form='select'):
+        """Compile the query to a 2-tuple of (sql, params)
+
+           The form is 'select' for the query itself, 'count' to count the rows it returns, or 'exists' to probe
+           for any row. The SQL is fetched from the cache if a query of the same structure has been compiled before.
+        """
+        key, params = self.fingerprint(form)
+        sql = self.sql_cache.get(key)
+        if sql is not None:
+            return sql, params
+
+        sql, compiled_params = self.compile(form)
+
+        # Only cache the SQL if the fingerprint reproduces the compiled params -
+        # a comparison which transforms its value can't be re-bound from the fingerprint
+        if compiled_params == params:
+            self.sql_cache.put(key, sql)
+        return sql, compiled_params
+
+    def compile(self, form='select'):
+        """Build the SELECT statement for a SimpleQuery - returns a 2-tuple of (sql, params)
+
+           A 'count' or 'exists' form only compiles the tables and criteria, unless DISTINCT or limits
+           mean the full SELECT has to be wrapped as a sub-query.
+        """
+        if form not in ('select', 'count', 'exists'):
+            raise exceptions.CompileError('Unknown form of query {!r}'.format(form))
+
+        query = self._obj
+        model = query.model
+        if model is None:
+            raise exceptions.NoTables('Cannot compile a query without a model')
+
+        joins = Join(root_model=model)
+        alias = joins.name_root()
+        params = []
+
+        wrapped = self._wrapped(form)
+        select = form == 'select' or wrapped
+
+        aliases = set(field.kwargs['alias'] for field in query.fields
+                      if isinstance(field, Annotation) and 'alias' in field.kwargs)
+
+        # If any field is an aggregate the rows are grouped by every other field
+        columns, group_by, aggregated = [], [], False
+        if select:
+            for field in query.fields:
+                sql, field_params = self.column(field, alias=alias, model=model, joins=joins)
+                columns.append(sql)
+                params.extend(field_params)
+                if isinstance(field, Annotation) and isinstance(field.args[0], Aggregate):
+                    aggregated = True
+                elif isinstance(field, Annotation) and 'alias' in field.kwargs:
+                    group_by.append('"{}"'.format(field.kwargs['alias']))
+                else:
+                    group_by.append(sql)
+
+            # Every column of each related model is selected - aliased by the relation path
+            for relation in query.joins:
+                node = joins.addJoin(relation, allow_nulls=True)
+                for name, field in node.model.db_fields():
+                    column = '{}.{}'.format(node.relation, self._engine.column_name(field))
+                    columns.append('{} AS "{}"'.format(column, relation + LOOKUP_SEP + field.db_column))
+                    group_by.append(column)
+
+        where = ''
+        if query.criteria:
+            where, where_params = query.criteria.resolve(default_alias=alias, engine=self._engine,
+                                                         model=model, joins=joins)
+            where = ' WHERE ' + where
+            params.extend(where_params)
+
+        # Keyset pagination - only the rows after the keyset values in the order by sequence
+        if query.keyset:
+            seek, seek_params = self.seek(alias=alias, model=model, joins=joins, aliases=aliases)
+            where = '{} AND {}'.format(where, seek) if where else ' WHERE ' + seek
+            params.extend(seek_params)
+
+        order_by = []
+        if form == 'select':
+            for item in query.order_by:
+                sql, item_params = self.ordering(item, alias=alias, model=model, joins=joins, aliases=aliases)
+                order_by.append(sql)
+                params.extend(item_params)
+
+        limits = ''
+        if query.limits and select:
+            limits = ' LIMIT ?' if len(query.limits) == 1 else ' LIMIT ? OFFSET ?'
+            params.extend(query.limits)
+
+        if form == 'select' or wrapped:
+            sql = 'SELECT {options}{columns} FROM {tables}{where}{group_by}{order_by}{limits}'.format(
+                    options=''.join(option + ' ' for option in query.options),
+                    columns=', '.join(columns),
+                    tables=joins.to_sql().strip(),
+                    where=where,
+                    group_by=(' GROUP BY ' + ', '.join(group_by)) if aggregated and group_by else '',
+                    order_by=(' ORDER BY ' + ', '.join(order_by)) if order_by else '',
+                    limits=limits)
+            if form == 'select':
+                return sql, params
+            tables = '({}) AS "subquery"'.format(sql)
+            where = ''
+        else:
+            tables = joins.to_sql().strip()
+
+        if form == 'count':
+            return 'SELECT COUNT(*) FROM {tables}{where}'.format(tables=tables, where=where), params
+        return 'SELECT 1 FROM {tables}{where} LIMIT 1'.format(tables=tables, where=where), params
+
+    def _write_criteria(self, action):
+        """The table and WHERE clause of an UPDATE or DELETE - returns a 3-tuple of (table, where, params)
+
+           Criteria across relations can't be joined in the statement itself, so the rows are identified by
+           their primary keys in a sub-query.
+        """
+        query = self._obj
+        model = query.model
+        if model is None:
+            raise exceptions.NoTables('Cannot compile a query without a model')
+        if query.limits or query.keyset:
+            raise exceptions.CompileError('Cannot {} a query with limits'.format(action))
+
+        joins = Join(root_model=model)
+        alias = joins.name_root()
+        if not query.criteria:
+            return model.table_name(), '', []
+
+        where, params = query.criteria.resolve(default_alias=alias, engine=self._engine, model=model, joins=joins)
+        if len(list(joins.items())) > 1:
+            primary = self._engine.column_name(model.primary_field())
+            where = '{primary} IN (SELECT {alias}.{primary} FROM {tables} WHERE {where})'.format(
+                    primary=primary, alias=alias, tables=joins.to_sql().strip(), where=where)
+        return model.table_name(), ' WHERE ' + where, params
+
+    def as_update(self, values):
+        """Compile an UPDATE of the rows the query matches - returns a 2-tuple of (sql, params)
+
+           values is a dictionary of field name : value, where a value can be an F expression of the
+           fields of the same row.
+        """
+        query = self._obj
+        model = query.model
+        if not values:
+            raise exceptions.CompileError('Nothing to update')
+
+        assignments, params = [], []
+        for name, value in values.items():
+            field = model.db_field_by_name(name) if model is not None else None
+            if field is None:
+                raise exceptions.CompileError('Unknown field name: \'{}\' is not a field on the model'.format(name))
+            if isinstance(value, F):
+                joins = Join(root_model=model)
+                sql, value_params = value.resolve(default_alias=joins.name_root(), engine=self._engine,
+                                                  model=model, joins=joins)
+                if len(list(joins.items())) > 1:
+                    raise exceptions.CompileError('Cannot update \'{}\' from a related field'.format(name))
+            else:
+                sql, value_params = '?', [field.db_value(value)]
+            assignments.append('{} = {}'.format(self._engine.column_name(field), sql))
+            params.extend(value_params)
+
+        table, where, where_params = self._write_criteria('update')
+        return 'UPDATE {table} SET {assignments}{where}'.format(
+                table=table, assignments=', '.join(assignments), where=where), params + where_params
+
+    def as_delete(self):
+        """Compile a DELETE of the rows the query matches - returns a 2-tuple of (sql, params)"""
+        table, where, params = self._write_criteria('delete')
+        return 'DELETE FROM {table}{where}'.format(table=table, where=where), params
+
+    def column(self, field, alias='', model=None, joins=None):
+        """Compile an entry in the field list - a column on the model, a (related) field name or an F expression"""
+        if isinstance(field, F):
+            return field.resolve(default_alias=alias, engine=self._engine, model=model, joins=joins)
+
+        if isinstance(field, Annotation):
+            sql, params = self.expression(field.args[0], alias=alias, model=model, joins=joins)
+            if 'alias' in field.kwargs:
+                sql = '{} AS "{}"'.format(sql, field.kwargs['alias'])
+            return sql, params
+
+        if not isinstance(field, str):
+            raise exceptions.CompileError('Unable to compile field {!r}'.format(field))
+
+        if model is not None and model.db_column_to_attr_name(field) is not None:
+            field = model.db_column_to_attr_name(field)
+
+        return self._engine.resolve_name(field, default_alias=alias, model=model, joins=joins), []
+
+    def expression(self, expression, alias='', model=None, joins=None):
+        """Compile an annotated expression - returns a 2-tuple of (sql, params)"""
+        if isinstance(expression, TruncDate):
+            column = self._engine.resolve_name(expression.field, default_alias=alias, model=model, joins=joins)
+            return self._engine.resolve_function(expression.function_name, column), []
+
+        if isinstance(expression, Aggregate):
+            if isinstance(expression.field, F):
+                column, params = expression.field.resolve(default_alias=alias, engine=self._engine,
+                                                          model=model, joins=joins)
+            elif expression.field == '*':
+                column, params = '*', []
+            else:
+                column, params = self._engine.resolve_name(expression.field, default_alias=alias, model=model,
+                                                           joins=joins), []
+            return '{}({}{})'.format(expression.function, 'DISTINCT ' if expression.distinct else '', column), params
+
+        if isinstance(expression, Function):
+            arguments = [self._engine.resolve_name(argument, default_alias=alias, model=model, joins=joins)
+                         for argument in expression.arguments]
+            return self._engine.resolve_function(expression.name, *arguments), []
+
+        raise exceptions.CompileError('Unable to compile expression {!r}'.format(expression))
+
+    def ordering(self, item, alias='', model=None, joins=None, aliases=()):
+        """Compile an entry in the order by list - a field name, an annotation alias, an ordinal or an F expression
+
+           A leading '-' on a name, a negative ordinal or a negated F expression sort descending.
+        """
+        if isinstance(item, int):
+            return ('{} DESC'.format(-item) if item < 0 else str(item)), []
+
+        if isinstance(item, F):
+            sql, params = (+item).resolve(default_alias=alias, engine=self._engine, model=model, joins=joins)
+            return (sql + ' DESC' if item._negate else sql), params
+
+        descending = item.startswith('-')
+        if item.lstrip('-') in aliases:
+            sql, params = '"{}"'.format(item.lstrip('-')), []
+        else:
+            sql, params = self.column(item.lstrip('-'), alias=alias, model=model, joins=joins)
+        return (sql + ' DESC' if descending else sql), params
+
+    @staticmethod
+    def _descending(item):
+        """True if this entry in the order by list sorts descending"""
+        if isinstance(item, F):
+            return item._negate
+        if isinstance(item, str):
+            return item.startswith('-')
+        return item < 0
+
+    def seek(self, alias='', model=None, joins=None, aliases=()):
+        """Compile the keyset condition - the rows which sort after the keyset values, for the current ordering
+
+           Returns a 2-tuple of (sql_fragment, params). Only field names and F expressions can be seeked past.
+        """
+        query = self._obj
+        if len(query.keyset) != len(query.order_by):
+            raise exceptions.CompileError('The keyset has {} values but the query is ordered by {} fields'.format(
+                    len(query.keyset), len(query.order_by)))
+
+        columns, params = [], []
+        for item in query.order_by:
+            if isinstance(item, F):
+                sql, item_params = (+item).resolve(default_alias=alias, engine=self._engine, model=model, joins=joins)
+            elif isinstance(item, str) and item.lstrip('-') not in aliases:
+                sql, item_params = self.column(item.lstrip('-'), alias=alias, model=model, joins=joins)
+            else:
+                raise exceptions.CompileError('Unable to use {!r} in a keyset'.format(item))
+            if item_params:
+                raise exceptions.CompileError('Unable to use {!r} in a keyset'.format(item))
+            columns.append(sql)
+
+        return self.keyset(columns, [self._descending(item) for item in query.order_by], query.keyset,
+                           [self._nullable(item, model) for item in query.order_by])
+
+    @staticmethod
+    def _nullable(item, model):
+        """True unless this entry in the order by list is a field which can't be NULL - i.e. a non null field
+           on the model itself (a related field can be NULL through an outer join)
+        """
+        name = item._lhs if isinstance(item, F) else item.lstrip('-')
+        if model is None or not isinstance(name, str) or LOOKUP_SEP in name:
+            return True
+        field = model.db_field_by_name(model.db_column_to_attr_name(name) or name)
+        return field is None or not field.not_null()
+
+    @staticmethod
+    def keyset(columns, descending, values, nullable=None):
+        """The comparison of the columns against the keyset values - returns a 2-tuple of (sql_fragment, params)
+
+           If every column sorts the same way this is a single row value comparison, which can use an index on
+           the columns - i.e. (a, b) > (?, ?). Otherwise the comparison is expanded : a > ? OR (a = ? AND b < ?)
+
+           NULLs sort first, so the expansion is also used if a value is NULL, or if a descending column could
+           be NULL : a NULL value is compared with IS NULL, and NULLs come after every value of a descending column.
+        """
+        nullable = nullable if nullable is not None else [True] * len(columns)
+        if len(set(descending)) == 1 and None not in values and not (descending[0] and any(nullable)):
+            return '({}) {} ({})'.format(', '.join(columns), '<' if descending[0] else '>',
+                                         ', '.join('?' * len(columns))), list(values)
+
+        terms, params = [], []
+        for index, column in enumerate(columns):
+            value = values[index]
+            if value is None:
+                # Only non NULL values come after a NULL ascending - nothing comes after a NULL descending
+                if descending[index]:
+                    continue
+                after, after_params = '{} IS NOT NULL'.format(column), []
+            elif descending[index] and nullable[index]:
+                after, after_params = '({column} < ? OR {column} IS NULL)'.format(column=column), [value]
+            else:
+                after, after_params = '{} {} ?'.format(column, '<' if descending[index] else '>'), [value]
+
+            equals = []
+            for previous, previous_value in zip(columns[:index], values[:index]):
+                if previous_value is None:
+                    equals.append('{} IS NULL'.format(previous))
+                else:
+                    equals.append('{} = ?'.format(previous))
+                    params.append(previous_value)
+            terms.append('({})'.format(' AND '.join(equals + [after])) if equals or not after.startswith('(') else after)
+            params.extend(after_params)
+        return ('(' + ' OR '.join(terms) + ')') if terms else '0', params
@@ -14,8 +14,10 @@ Testable Statements :
 """
 
 import threading
+import time
+from itertools import chain
 from abc import abstractmethod, ABCMeta
-from collections import defaultdict
+from collections import deque, namedtuple
 
 __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
@@ -25,7 +27,12 @@ from contextlib import contextmanager
 
 from enum import Enum
 from pyorm.db.models._core import _Field
-from pyorm.core.exceptions import ConnectionError
+from pyorm.core.exceptions import ConnectionError, CompileError, pyOrmEngineException
+from pyorm.db.models.indexes import Index
+from pyorm.db.models.functions import Function, TruncDate
+from pyorm.db.engine.compiler import Compiler
+
+LOOKUP_SEP = '__'
 
 
 class SqlCommands(Enum):
@@ -36,47 +43,388 @@ class SqlCommands(Enum):
     ALTER = 5
 
 
+PoolStats = namedtuple('PoolStats', ['size', 'in_use', 'idle', 'max_size',
+                                     'waits', 'wait_time', 'max_wait', 'timeouts'])
+PoolStats.__doc__ = """Snapshot of the occupancy and wait times of a connection pool
+
+    size : The number of database handles currently open (in use + idle)
+    in_use : The number of handles currently checked out
+    idle : The number of open handles waiting in the pool
+    max_size : The upper bound on size - None if the pool is unbounded
+    waits : The number of checkouts which had to wait for a handle
+    wait_time : Total seconds spent waiting for a handle
+    max_wait : Longest single wait for a handle in seconds
+    timeouts : The number of checkouts which gave up waiting
+"""
+
+
+FunctionInfo = namedtuple('FunctionInfo', ['callable', 'arity', 'deterministic'])
+FunctionInfo.__doc__ = """A function registered with an engine - to be called by the database
+
+    callable : The python function
+    arity : The number of arguments - -1 for any number
+    deterministic : True if the result depends only on the arguments
+"""
+
+ExecuteEvent = namedtuple('ExecuteEvent', ['engine', 'connection', 'sql', 'params', 'param_count', 'many', 'thread_id',
+                                           'queryset', 'rowcount', 'elapsed', 'error'])
+ExecuteEvent.__doc__ = """A statement passing through an engine - given to the pre & post execute listeners
+
+    engine : The engine executing the statement
+    connection : The connection the statement is executed on
+    sql : The SQL statement
+    params : The bound parameters - a list of parameter lists for executemany
+    param_count : The number of bound parameters - across every set of parameters for executemany
+    many : True if the statement is executed once for each set of parameters
+    thread_id : The ident of the thread executing the statement
+    queryset : The QuerySet executing the statement - None if it isn't executed for a QuerySet
+    rowcount : The rows returned by a query or changed by a write - None before execution
+    elapsed : Seconds from the start of execution until the last row was fetched - None before execution
+    error : The exception raised by the statement - None if it succeeded
+"""
+
+Listener = namedtuple('Listener', ['engine_class', 'pre_execute', 'post_execute'])
+Listener.__doc__ = """Callbacks registered for every statement executed by engines of a class
+
+    engine_class : The engines the callbacks apply to - this class and its subclasses
+    pre_execute : Called with an ExecuteEvent before the statement is executed - or None
+    post_execute : Called with the completed ExecuteEvent after the statement is executed - or None
+"""
+
+# The QuerySet which is executing a statement on each thread
+_caller = threading.local()
+
+Result = namedtuple('Result', ['rows', 'rowcount', 'lastrowid'])
+Result.__doc__ = """The outcome of executing a single statement
+
+    rows : A list of all the rows returned by the statement
+    rowcount : The number of rows changed by the statement (-1 for queries)
+    lastrowid : The rowid of the last row inserted by the statement
+"""
+
+
+class ConnectionPool:
+    """A bounded, thread safe pool of database handles for a single database
+
+       Handles are created on demand by the factory callable, up to max_size. Once max_size
+       handles are checked out further checkouts wait (up to timeout seconds) for a handle to be
+       released.
+
+       Shared checkouts are keyed (typically by thread id) - a second checkout with the same key
+       returns the same Connection with an incremented reference count, and the handle is only
+       returned to the pool once every reference has been closed.
+    """
+
+    class _Slot:
+        """An open database handle and its usage record"""
+        __slots__ = ('handle', 'uses', 'idle_since')
+
+        def __init__(self, handle):
+            self.handle = handle
+            self.uses = 0
+            self.idle_since = None
+
+    def __init__(self, factory, min_size=0, max_size=10, timeout=None, idle_timeout=None, recycle=None):
+        """Create a pool of database handles
+
+        :param factory: callable which returns a new database handle
+        :param min_size: The number of handles to keep open even when idle
+        :param max_size: The maximum number of open handles - None for no limit
+        :param timeout: Seconds to wait for a handle when the pool is exhausted - None to wait forever
+        :param idle_timeout: Seconds an unused handle (above min_size) is kept open - None (the default) to keep
+                    it until the pool is closed, so each handle keeps its statement cache & registered functions.
+                    0 closes handles as soon as they are released.
+        :param recycle: Close a handle after it has been checked out this many times - None for never
+        """
+        if max_size is not None and max_size < 1:
+            raise ValueError('Connection pool max_size must be at least 1')
+        if max_size is not None and min_size > max_size:
+            raise ValueError('Connection pool min_size cannot be larger than max_size')
+
+        self._factory = factory
+        self._min_size = min_size
+        self._max_size = max_size
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._recycle = recycle
+
+        # The (pool, options) settings of the engine which created the pool
+        self.settings = None
+
+        self._lock = threading.Condition(threading.Lock())
+        self._idle = deque()            # Oldest released handles on the left
+        self._shared = dict()           # key -> Connection for shared checkouts
+        self._ambient = dict()          # thread id -> Connection with an atomic block open on it
+        self._size = 0
+        self._in_use = 0
+
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+
+        for _ in range(self._min_size):
+            slot = self._Slot(self._factory())
+            slot.idle_since = time.monotonic()
+            self._idle.append(slot)
+            self._size += 1
+
+    def ambient(self, thread_id):
+        """The Connection with an atomic block open on this thread - with an extra reference; None if there isn't one"""
+        with self._lock:
+            connection = self._ambient.get(thread_id, None)
+            if connection is not None:
+                connection._refs += 1
+            return connection
+
+    def enlist(self, thread_id, connection):
+        """Record the connection as holding the open transaction for this thread - until it is delisted"""
+        with self._lock:
+            self._ambient[thread_id] = connection
+
+    def delist(self, thread_id):
+        """Forget the open transaction for this thread"""
+        with self._lock:
+            self._ambient.pop(thread_id, None)
+
+    def checkout(self, engine, key=None, shared=True):
+        """Check out a Connection - reusing the connection already checked out with this key if shared"""
+        if shared:
+            with self._lock:
+                connection = self._shared.get(key, None)
+                if connection is not None:
+                    connection._refs += 1
+                    return connection
+
+        slot = self._acquire()
+        slot.uses += 1
+        connection = EngineCore.Connection(slot, engine=engine, pool=self, key=key, shared=shared)
+
+        if shared:
+            with self._lock:
+                self._shared[key] = connection
+        return connection
+
+    def _acquire(self):
+        """Get an idle slot, or make room for a new one - waiting if the pool is exhausted"""
+        started = None
+        with self._lock:
+            while True:
+                self._evict(time.monotonic())
+                if self._idle:
+                    slot = self._idle.pop()         # Most recently used handle first
+                    break
+
+                if self._max_size is None or self._size < self._max_size:
+                    self._size += 1
+                    slot = None
+                    break
+
+                now = time.monotonic()
+                if started is None:
+                    started = now
+                    self._waits += 1
+
+                remaining = None if self._timeout is None else self._timeout - (now - started)
+                if remaining is not None and remaining <= 0:
+                    self._timeouts += 1
+                    self._record_wait(now - started)
+                    raise ConnectionError('Unable to connect to database : connection pool exhausted '
+                                          '({} connections in use)'.format(self._in_use))
+                self._lock.wait(remaining)
+
+            if started is not None:
+                self._record_wait(time.monotonic() - started)
+            self._in_use += 1
+
+        if slot is None:
+            try:
+                slot = self._Slot(self._factory())
+            except BaseException:
+                with self._lock:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._lock.notify()
+                raise
+        return slot
+
+    def _record_wait(self, waited):
+        self._wait_time += waited
+        self._max_wait = max(self._max_wait, waited)
+
+    def _evict(self, now):
+        """Close idle handles which have exceeded the idle timeout - lock must be held"""
+        if self._idle_timeout is None:
+            return
+        while self._idle and self._size > self._min_size and \
+                now - self._idle[0].idle_since >= self._idle_timeout:
+            self._discard(self._idle.popleft())
+
+    def _discard(self, slot):
+        """Close the handle in this slot - lock must be held"""
+        self._size -= 1
+        slot.handle.close()
+
+    def close_ref(self, connection):
+        """Drop one reference to the connection - the handle is returned to the pool with the last reference
+
+           The count is changed under the pool lock, so a shared checkout can never pick up a connection
+           which is being released.
+        """
+        with self._lock:
+            if connection._refs <= 0:
+                return
+            connection._refs -= 1
+            if connection._refs == 0:
+                self._release(connection)
+
+    def release(self, connection):
+        """Return the handle held by the connection to the pool"""
+        with self._lock:
+            self._release(connection)
+
+    def _release(self, connection):
+        """Return the handle held by the connection to the pool - lock must be held"""
+        slot = connection._slot
+        if connection._shared and self._shared.get(connection._key, None) is connection:
+            del self._shared[connection._key]
+
+        self._in_use -= 1
+        if self._recycle is not None and slot.uses >= self._recycle:
+            self._discard(slot)
+        else:
+            slot.idle_since = time.monotonic()
+            self._idle.append(slot)
+            self._evict(slot.idle_since)
+        self._lock.notify()
+
+    def shared_connections(self):
+        """Snapshot of the (key, Connection) pairs currently checked out as shared"""
+        with self._lock:
+            return list(self._shared.items())
+
+    def stats(self):
+        """A PoolStats snapshot of the current pool occupancy & wait times"""
+        with self._lock:
+            return PoolStats(size=self._size, in_use=self._in_use, idle=len(self._idle),
+                             max_size=self._max_size, waits=self._waits, wait_time=self._wait_time,
+                             max_wait=self._max_wait, timeouts=self._timeouts)
+
+    def close(self):
+        """Close all idle handles - handles in use are closed when they are released"""
+        with self._lock:
+            while self._idle:
+                self._discard(self._idle.popleft())
+            self._min_size = 0
+            self._idle_timeout = 0
+
+
+class _InstrumentedCursor:
+    """Wrapper to a query's cursor which counts the rows fetched - the post execute event fires once the
+       cursor is closed (or runs out of rows)
+    """
+    def __init__(self, cursor, event, started, listeners):
+        self._cursor = cursor
+        self._event = event
+        self._started = started
+        self._listeners = listeners
+        self._rows = 0
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is None:
+            self._finished()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._rows += len(rows)
+        if not rows:
+            self._finished()
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._rows += len(rows)
+        self._finished()
+        return rows
+
+    def close(self):
+        self._finished()
+        self._cursor.close()
+
+    def _finished(self):
+        if self._listeners is None:
+            return
+        listeners, self._listeners = self._listeners, None
+        EngineCore._notify(listeners, self._event._replace(rowcount=self._rows,
+                                                           elapsed=time.perf_counter() - self._started))
+
 
 class EngineCore(metaclass=ABCMeta):
 
     class Connection:
         """Wrapper to the database connection to  pass through everything other than the close
 
-            The Wrapper has it's own close method which only closes the real connection if the ref count drops to zero.
+            The Wrapper has it's own close method which only returns the real connection to the pool
+            if the ref count drops to zero.
         """
-        def __init__(self, handle, engine, shared=True):
-            self._handle = handle
+        def __init__(self, slot, engine, pool, key=None, shared=True):
+            self._slot = slot
+            self._handle = slot.handle
             self._engine = engine
+            self._pool = pool
+            self._key = key
             self._shared = shared
+            self._refs = 1
+            self._savepoints = 0
 
         def __getattr__(self, item):
             return getattr(self._handle, item)
 
         def close(self):
-            if self._shared:
-                self._engine.__class__._ref_counts[self] -= 1
-                if self._engine.__class__._ref_counts[self] == 0:
-                    del self._engine.__class__._ref_counts[self]
-                    del self._engine.__class__._connections_per_thread[self._engine._db_path][
-                        self._engine._thread_id]
-                    return self._handle.close()
-            else:
-                return self._handle.close()
+            self._pool.close_ref(self)
 
         @property
         def handle(self):
             return self._handle
 
-    _connections_per_thread = dict()
-    _ref_counts = defaultdict(int)
+    _pools = dict()
+    _pools_lock = threading.Lock()
 
-    def __init__(self, db_path, shared=True, unique_per_thread=True):
+    _comparisons = {}
+    _functions = {}
+    _native_functions = {}
+
+    # Instrumentation callbacks - replaced rather than changed, so executing statements can iterate without a lock
+    _listeners = ()
+    _listeners_lock = threading.Lock()
+
+    # The statement which opens a transaction, and the default limit on bound parameters in one statement
+    _begin = 'BEGIN'
+    _max_variables = 999
+
+    def __init__(self, db_path, shared=True, unique_per_thread=True, pool=None, options=None):
         """A database agnostic base for the db specific handle managers
 
         :param db_path: The path to the database file
         :param shared: Whether db connections are shared or if multiple connections are used.
         :param unique_per_thread: Whether db connections are shared across threads
-        
+        :param pool: A dictionary of ConnectionPool options (min_size, max_size, timeout, idle_timeout, recycle)
+                Only used by the first engine created for a given db_path.
+        :param options: A dictionary of engine specific options - applied to every new connection
+
         If shared is True and unique_per_thread is True then
             One handle is returned per thread.
             
@@ -84,17 +432,14 @@ class EngineCore(metaclass=ABCMeta):
             One handle is shared across all threads in the process
             
         if shared is False then each handle attempt results in a new handle.
+
+        Handles are drawn from a ConnectionPool shared by all engines for the same db_path
         """
         self._db_path = db_path
         self._shared = shared
         self._unique_per_thread = unique_per_thread
-
-        # Implement sharing across threads by ignoring the threading
-        if self._shared:
-            if self._unique_per_thread:
-                self._thread_id = threading.get_ident()
-            else:
-                self._thread_id = None
+        self._pool_options = pool if pool else {}
+        self._options = dict(options) if options else {}
 
         self.prepare_engine(db_path)
 
@@ -112,38 +457,51 @@ class EngineCore(metaclass=ABCMeta):
     def get_connection(self):
         raise NotImplemented
 
+    @property
+    def pool(self):
+        """The ConnectionPool for this engine's database - created on first use
+
+           Every engine for the same database shares the pool, so an engine which asks for different pool
+           settings or connection options from the engine which created it fails with pyOrmEngineException.
+        """
+        key = str(self._db_path)
+        with EngineCore._pools_lock:
+            pool = EngineCore._pools.get(key, None)
+            if pool is None:
+                pool = ConnectionPool(self.get_connection, **self._pool_options)
+                pool.settings = (self._pool_options, self._options)
+                EngineCore._pools[key] = pool
+            elif (self._pool_options or self._options) and pool.settings != (self._pool_options, self._options):
+                raise pyOrmEngineException(
+                    'Conflicting settings for database \'{}\' : its connection pool was created with pool={!r}, '
+                    'options={!r}'.format(key, *pool.settings))
+        return pool
+
+    def pool_stats(self):
+        """A PoolStats snapshot of the occupancy and wait times of this engine's connection pool"""
+        return self.pool.stats()
+
     def connect(self):
         """ Connect to the database - if not already connected
 
             Applies the various rules regarding shared connections
         """
-        # If there is no sharing - get a new handle
-        if not self._shared:
-            try:
-                db_handle = self.Connection(self.get_connection(),engine=self, shared = self._shared)
-            except ConnectionError as exc:
-                raise exc from None
-            else:
-                return db_handle
-        else:
-            # Add a file into the connections list (if not there)
-            # Add a thread for this file - and grab a handle if required
-            # cannot use a default dict here as this is a class variable but has a per instance default function
-            if self._db_path not in EngineCore._connections_per_thread:
-                EngineCore._connections_per_thread[self._db_path] = dict()
-
-            if self._thread_id not in EngineCore._connections_per_thread[self._db_path]:
-                EngineCore._connections_per_thread[self._db_path][self._thread_id] = self.Connection(self.get_connection(), engine=self)
+        # Any statement executed on a thread with an atomic block open joins that transaction
+        ambient = self.pool.ambient(threading.get_ident())
+        if ambient is not None:
+            return ambient
 
-            connection = EngineCore._connections_per_thread[self._db_path][self._thread_id]
-
-        EngineCore._ref_counts[connection] += 1
-        return connection
+        key = threading.get_ident() if self._unique_per_thread else None
+        try:
+            return self.pool.checkout(self, key=key, shared=self._shared)
+        except ConnectionError as exc:
+            raise exc from None
 
     @classmethod
     def open_connections(cls, db_path):
-        for thread, connections in cls._connections_per_thread.get(db_path,{}).items():
-            yield (thread, connections)
+        pool = EngineCore._pools.get(str(db_path), None)
+        if pool:
+            yield from pool.shared_connections()
 
     @property
     def db_path(self):
@@ -151,9 +509,304 @@ class EngineCore(metaclass=ABCMeta):
 
     @classmethod
     def reset(cls):
-        """Force Resest the core data for the db Engine - use with care"""
-        EngineCore._connections_per_thread = dict()
-        EngineCore._ref_counts = defaultdict(int)
+        """Force Resest the core data for the db Engine - use with care
+
+           The idle handles in every pool are closed - handles in use are closed when they are released.
+        """
+        with EngineCore._pools_lock:
+            pools, EngineCore._pools = EngineCore._pools, dict()
+        for pool in pools.values():
+            pool.close()
+
+    def compile(self, query, form='select'):
+        """Compile a query to a 2-tuple of (sql, params) - the SQL is reused from the compiled SQL cache
+
+           The form is 'select' for the query itself, 'count' to count its rows or 'exists' to probe for any row
+        """
+        return Compiler(self, query).as_sql(form)
+
+    def compile_update(self, query, values):
+        """Compile an UPDATE of the rows matched by the query to a 2-tuple of (sql, params)"""
+        return Compiler(self, query).as_update(values)
+
+    def compile_delete(self, query):
+        """Compile a DELETE of the rows matched by the query to a 2-tuple of (sql, params)"""
+        return Compiler(self, query).as_delete()
+
+    def execute(self, sql, params=(), queryset=None):
+        """Execute a single statement on a pooled connection - returns a Result of rows, rowcount and lastrowid
+
+           queryset is the QuerySet the statement is executed for - it is reported to the instrumentation listeners
+        """
+        connection = self.connect()
+        try:
+            cursor = self._execute_for(queryset, connection, sql, params)
+            try:
+                return Result(rows=cursor.fetchall(), rowcount=cursor.rowcount, lastrowid=cursor.lastrowid)
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
+    def fetch(self, sql, params=(), chunk_size=100, queryset=None):
+        """Generator - execute a query and yield the rows as lists of up to chunk_size rows
+
+           Rows are read from the cursor one chunk at a time, so only one chunk is ever held in memory.
+           The connection is held until the generator is exhausted or closed.
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1')
+
+        connection = self.connect()
+        try:
+            cursor = self._execute_for(queryset, connection, sql, params)
+            try:
+                rows = cursor.fetchmany(chunk_size)
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(chunk_size)
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
+    def executemany(self, sql, seq_of_params):
+        """Execute a statement once for each set of params - returns the total number of rows changed"""
+        with self.transaction() as connection:
+            cursor = self._execute(connection, sql, seq_of_params, many=True)
+            try:
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        """Context manager - the statements executed within it on this thread form a single transaction
+
+           The transaction is committed when the block exits normally, and rolled back if it raises.
+           Within an open transaction, the block simply joins the existing transaction.
+           Yields the connection the transaction is open on.
+        """
+        with self.atomic(savepoint=False) as connection:
+            yield connection
+
+    @contextmanager
+    def atomic(self, savepoint=True, durable=None):
+        """Context manager or decorator - the statements executed within it on this thread form a single transaction
+
+           Every statement executed through the engine on this thread while the block is open joins the transaction,
+           so model & query set writes are committed together (and synced to disk once) when the block exits.
+           If the block raises the transaction is rolled back.
+
+           Nested blocks are savepoints - an exception rolls back only the nested block's changes. With
+           savepoint=False a nested block just joins the enclosing transaction.
+
+           durable applies to the outermost block only : True syncs the commit to disk, False commits without
+           waiting for the sync (a crash may lose the transaction but won't corrupt the database), and
+           None keeps the connection's setting. Yields the connection the transaction is open on.
+
+               with engine.atomic():
+                   ...
+
+               @engine.atomic(durable=False)
+               def load(rows):
+                   ...
+        """
+        connection = self.connect()
+        try:
+            if not connection.in_transaction:
+                yield from self._outermost(connection, durable)
+            elif savepoint:
+                yield from self._savepoint(connection)
+            else:
+                yield connection
+        finally:
+            connection.close()
+
+    def _outermost(self, connection, durable):
+        """Generator - open a transaction, and commit or roll it back once the block has run"""
+        thread_id = threading.get_ident()
+        previous = self.durability(connection, durable) if durable is not None else None
+        try:
+            self._execute(connection, self._begin, ())
+            self.pool.enlist(thread_id, connection)
+            try:
+                try:
+                    yield connection
+                except BaseException:
+                    if connection.in_transaction:
+                        self._execute(connection, 'ROLLBACK', ())
+                    raise
+
+                try:
+                    self._execute(connection, 'COMMIT', ())
+                except BaseException:
+                    if connection.in_transaction:
+                        self._execute(connection, 'ROLLBACK', ())
+                    raise
+            finally:
+                self.pool.delist(thread_id)
+        finally:
+            # Restored even if the transaction couldn't begin - the handle goes back to the pool
+            if durable is not None:
+                self.durability(connection, previous)
+
+    def _savepoint(self, connection):
+        """Generator - open a savepoint within the transaction, and release or roll back to it once the block has run"""
+        name = 'pyorm_savepoint_{}'.format(connection._savepoints)
+        connection._savepoints += 1
+        try:
+            self._execute(connection, 'SAVEPOINT {}'.format(name), ())
+            try:
+                yield connection
+            except BaseException:
+                if connection.in_transaction:
+                    self._execute(connection, 'ROLLBACK TO {}'.format(name), ())
+                    self._execute(connection, 'RELEASE {}'.format(name), ())
+                raise
+            self._execute(connection, 'RELEASE {}'.format(name), ())
+        finally:
+            connection._savepoints -= 1
+
+    def durability(self, connection, durable):
+        """Set whether commits on this connection wait for the data to be synced to disk - returns the previous setting
+
+           The setting returned can be passed back to restore it. Engines without a durability control ignore it.
+        """
+        return None
+
+    def explain(self, sql, params=(), connection=None):
+        """The plan the database will use to execute a statement - a list of (depth, step) 2-tuples
+
+           The plan is made on the connection given, or on a pooled connection.
+        """
+        raise NotImplementedError('{} can\'t explain a statement'.format(self.__class__.__name__))
+
+    def max_variables(self, connection):
+        """The maximum number of bound parameters allowed in a single statement on this connection"""
+        return self._max_variables
+
+    def insert_sql(self, table_name, columns, rows=1):
+        """SQL to insert rows into a table - a multi-row VALUES list with a placeholder for every column"""
+        if not columns:
+            return 'INSERT INTO {table} DEFAULT VALUES'.format(table=table_name)
+
+        row = '({})'.format(', '.join(['?'] * len(columns)))
+        return 'INSERT INTO {table} ({columns}) VALUES {rows}'.format(
+                    table=table_name,
+                    columns=', '.join('"{}"'.format(column) for column in columns),
+                    rows=', '.join([row] * rows))
+
+    def update_sql(self, table_name, columns, key):
+        """SQL to update columns of the row with a primary key - a placeholder for every column, then the key"""
+        return 'UPDATE {table} SET {columns} WHERE "{key}" = ?'.format(
+                    table=table_name,
+                    columns=', '.join('"{}" = ?'.format(column) for column in columns),
+                    key=key)
+
+    def bulk_insert(self, table_name, columns, rows, batch_size=None):
+        """Insert the rows into the table - in as few statements as the limit on bound parameters allows
+
+           Rows are grouped into multi-row INSERT statements of up to batch_size rows (by default as many as the
+           limit on bound parameters allows). The statements for the full groups are all executed by one
+           executemany call. Everything is inserted in a single transaction.
+
+           Returns the rowid of the last row inserted - or None if there are no rows.
+        """
+        rows = list(rows)
+        if not rows:
+            return None
+
+        with self.transaction() as connection:
+            if not columns:
+                cursor = self._execute(connection, self.insert_sql(table_name, columns), [()] * len(rows), many=True)
+                cursor.close()
+            else:
+                group = max(1, self.max_variables(connection) // len(columns))
+                group = min(group, batch_size) if batch_size else group
+                full, remainder = divmod(len(rows), group)
+
+                if full:
+                    cursor = self._execute(connection, self.insert_sql(table_name, columns, rows=group),
+                                           [list(chain.from_iterable(rows[start:start + group]))
+                                            for start in range(0, full * group, group)],
+                                           many=True)
+                    cursor.close()
+                if remainder:
+                    cursor = self._execute(connection, self.insert_sql(table_name, columns, rows=remainder),
+                                           list(chain.from_iterable(rows[full * group:])))
+                    cursor.close()
+
+            cursor = self._execute(connection, 'SELECT last_insert_rowid()', ())
+            try:
+                return cursor.fetchone()[0]
+            finally:
+                cursor.close()
+
+    def _execute_for(self, queryset, connection, sql, params):
+        """Execute a statement on behalf of a QuerySet - the QuerySet is reported to the listeners"""
+        previous, _caller.queryset = getattr(_caller, 'queryset', None), queryset
+        try:
+            return self._execute(connection, sql, params)
+        finally:
+            _caller.queryset = previous
+
+    def _execute(self, connection, sql, params, many=False):
+        """Send a single statement to the database - every statement executed by the engine passes through here
+
+           The listeners registered for this engine are called before and after the statement is executed.
+           For a query the post execute listeners are called once the cursor is closed, with the rows fetched.
+        """
+        listeners = [listener for listener in EngineCore._listeners if isinstance(self, listener.engine_class)]
+        if not listeners:
+            return connection.executemany(sql, params) if many else connection.execute(sql, params)
+
+        if many:
+            params = [list(row) for row in params]
+        event = ExecuteEvent(engine=self, connection=connection, sql=sql, params=params, many=many, thread_id=threading.get_ident(),
+                             param_count=sum(len(row) for row in params) if many else len(params),
+                             queryset=getattr(_caller, 'queryset', None), rowcount=None, elapsed=None, error=None)
+        self._notify(listeners, event, pre=True)
+
+        started = time.perf_counter()
+        try:
+            cursor = connection.executemany(sql, params) if many else connection.execute(sql, params)
+        except Exception as exc:
+            self._notify(listeners, event._replace(elapsed=time.perf_counter() - started, error=exc))
+            raise
+
+        if cursor.description is None:
+            self._notify(listeners, event._replace(rowcount=cursor.rowcount, elapsed=time.perf_counter() - started))
+            return cursor
+        return _InstrumentedCursor(cursor, event, started, listeners)
+
+    @staticmethod
+    def _notify(listeners, event, pre=False):
+        """Call the pre or post execute callback of each listener with the event"""
+        for listener in listeners:
+            callback = listener.pre_execute if pre else listener.post_execute
+            if callback is not None:
+                callback(event)
+
+    @classmethod
+    def add_listener(cls, pre_execute=None, post_execute=None):
+        """Register callbacks for every statement executed by engines of this class - returns the Listener
+
+           Each callback is called with an ExecuteEvent - pre_execute before the statement is executed, and
+           post_execute once it has completed (or failed). Callbacks are called on the executing thread and
+           exceptions they raise propagate to the caller.
+        """
+        listener = Listener(engine_class=cls, pre_execute=pre_execute, post_execute=post_execute)
+        with EngineCore._listeners_lock:
+            EngineCore._listeners = EngineCore._listeners + (listener,)
+        return listener
+
+    @classmethod
+    def remove_listener(cls, listener):
+        """Stop calling the callbacks of a Listener returned by add_listener"""
+        with EngineCore._listeners_lock:
+            EngineCore._listeners = tuple(registered for registered in EngineCore._listeners
+                                          if registered is not listener)
 
     @abstractmethod
     def column_name(self, field: _Field):
@@ -170,8 +823,179 @@ class EngineCore(metaclass=ABCMeta):
         """Create the appropriate sql fragement for this field in a select statement"""
         raise NotImplemented('\"select_field\" must be implemented on subclass')
 
-    def resolve_name(self, name, model=None, joins=None):
-        pass
+    def resolve_name(self, name, default_alias='', model=None, joins=None):
+        """Resolve a (possibly related) field name to the qualified column reference used in SQL
+
+        :param name: The field name - related fields are separated by '__' (e.g. 'author__name')
+        :param default_alias: The table alias to use for a field on the model itself
+        :param model: The model the name is relative to
+        :param joins: The Join tree for the query - any relations traversed are added to it
+        """
+        relation, _, field_name = name.rpartition(LOOKUP_SEP)
+        alias = default_alias
+
+        if relation and joins is not None:
+            node = joins.addJoin(relation)
+            alias, model = node.relation, node.model
+
+        if model is not None:
+            field = model.db_field_by_name(field_name)
+            if field is None:
+                raise CompileError('Unknown field name: \'{}\' is not a field on \'{}\' model'.format(
+                    field_name, model.__name__))
+            column = self.column_name(field)
+        else:
+            column = '"{}"'.format(field_name)
+
+        return '{}.{}'.format(alias, column) if alias else column
+
+    def resolve_function(self, name, *arguments):
+        """Generate the SQL to apply a named function to arguments which are already resolved SQL fragments
+
+           The native SQL form of the function is used if the engine has one - otherwise the function must
+           have been registered with the engine as a user defined function.
+        """
+        native = self._native_functions.get(name, None)
+        if native is not None:
+            return native(*arguments)
+
+        function = self._functions.get(name, None)
+        if function is None:
+            raise CompileError('Unknown function {}'.format(name))
+        if function.arity >= 0 and function.arity != len(arguments):
+            raise CompileError('Function {} takes {} arguments : {} given'.format(name, function.arity, len(arguments)))
+        return '{}({})'.format(name, ', '.join(arguments))
 
-    def resolve_lookup(self, name, value, model=None, joins=None):
-        pass
\ No newline at end of file
+    def is_deterministic(self, name):
+        """True if the named function always gives the same result for the same arguments
+
+           Native forms are assumed to be deterministic - they must not depend on the current time
+        """
+        if name in self._native_functions:
+            return True
+        function = self._functions.get(name, None)
+        return function is not None and function.deterministic
+
+    def index_expression(self, expression, model):
+        """Generate the SQL for a single expression in an index - a field name or a function over field names"""
+        if isinstance(expression, str):
+            return self.resolve_name(expression, model=model)
+
+        if isinstance(expression, TruncDate):
+            name, arguments = expression.function_name, [expression.field]
+        elif isinstance(expression, Function):
+            name, arguments = expression.name, expression.arguments
+        else:
+            raise CompileError('Unable to index expression {!r}'.format(expression))
+
+        if not self.is_deterministic(name):
+            raise CompileError('Cannot index function {} : it is not registered as deterministic'.format(name))
+        return self.resolve_function(name, *[self.index_expression(argument, model) for argument in arguments])
+
+    def index_sql(self, model, index: Index):
+        """Generate the CREATE INDEX statement for an index on a model
+
+           The fields an index includes are added after its expressions - so the index covers them. The condition
+           of a partial index can't have bound parameters, so its values are written as SQL literals.
+        """
+        expressions = [self.index_expression(expression, model) for expression in index.expressions]
+        expressions += [self.resolve_name(name, model=model) for name in index.include]
+
+        where = ''
+        if index.where is not None:
+            sql, params = index.where.resolve(engine=self, model=model, literals=True)
+            where = ' WHERE ' + sql
+
+        return 'CREATE {unique}INDEX IF NOT EXISTS "{name}" ON {table} ({expressions}){where}'.format(
+                    unique='UNIQUE ' if index.unique else '',
+                    name=index.name_for(model),
+                    table=model.table_name(),
+                    expressions=', '.join(expressions),
+                    where=where)
+
+    def drop_index_sql(self, name):
+        """Generate the DROP INDEX statement for a named index"""
+        return 'DROP INDEX IF EXISTS "{}"'.format(name)
+
+    def literal(self, value):
+        """A value written as an SQL literal - for statements which can't have bound parameters"""
+        if value is None:
+            return 'NULL'
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, (int, float)):
+            return repr(value)
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    def inline(self, sql, params):
+        """Write the params into the placeholders of an SQL fragment as literals
+
+           Placeholders are only recognised outside quoted strings & identifiers.
+        """
+        params = iter(params)
+        parts, quote = [], None
+        for char in sql:
+            if quote:
+                quote = None if char == quote else quote
+            elif char in '\'"':
+                quote = char
+            elif char == '?':
+                try:
+                    char = self.literal(next(params))
+                except StopIteration:
+                    raise CompileError('Too few values for the placeholders in {!r}'.format(sql)) from None
+            parts.append(char)
+        if next(params, params) is not params:
+            raise CompileError('Too many values for the placeholders in {!r}'.format(sql))
+        return ''.join(parts)
+
+    def table_sql(self, table_name, fields):
+        """Generate the CREATE TABLE statement for a table with these fields - from (name, field) pairs"""
+        columns = []
+        for name, field in fields:
+            columns.append(' '.join([self.column_name(field), self.column_type(field)] +
+                                    list(self.column_constraint(field))))
+        return 'CREATE TABLE IF NOT EXISTS {table} ({columns})'.format(table=table_name, columns=', '.join(columns))
+
+    def schema_sql(self, model):
+        """The statements which create the table for a model, and every index on it"""
+        return [self.table_sql(model.table_name(), model.db_fields())] + \
+               [self.index_sql(model, index) for index in model.indexes()]
+
+    def create_schema(self, *models):
+        """Create the tables and indexes for the models (if they don't already exist) - in one transaction"""
+        with self.atomic():
+            for model in models:
+                for sql in self.schema_sql(model):
+                    self.execute(sql)
+
+    def create_indexes(self, model):
+        """Create every index on the model (if it doesn't already exist)"""
+        with self.transaction():
+            for index in model.indexes():
+                self.execute(self.index_sql(model, index))
+
+    def resolve_lookup(self, name, value, default_alias='', model=None, joins=None):
+        """Resolve a field lookup (e.g. 'name__contains') and value into a 2-tuple of (sql_fragment, params)
+
+           A lookup without a recognised comparison is treated as an 'exact' comparison.
+        """
+        field_name, _, comparison = name.rpartition(LOOKUP_SEP)
+        if not field_name or comparison not in self._comparisons:
+            field_name, comparison = name, 'exact'
+
+        comparison_callable = self._comparisons.get(comparison, None)
+        if comparison_callable is None:
+            raise CompileError('Unknown field lookup {}'.format(comparison))
+
+        column = self.resolve_name(field_name, default_alias=default_alias, model=model, joins=joins)
+        sql, params = comparison_callable(column, value)
+        return sql, list(params)
+
+    def resolve_literal_lookup(self, name, value, default_alias='', model=None, joins=None):
+        """Resolve a field lookup with its values written as SQL literals - a 2-tuple of (sql_fragment, [])
+
+           For statements which can't have bound parameters - e.g. the condition of a partial index.
+        """
+        sql, params = self.resolve_lookup(name, value, default_alias=default_alias, model=model, joins=joins)
+        return self.inline(sql, params), []
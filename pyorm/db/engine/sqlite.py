@@ -12,7 +12,13 @@ Testable Statements :
     Can I <Boolean statement>
     ....
 """
+import collections
+import json
+import logging
+import logging.handlers
+import re
 import sqlite3
+import time
 
 __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
@@ -20,20 +26,117 @@ __created__ = '29 Jul 2017'
 
 from abc import abstractmethod
 
-from .core import EngineCore
+from .core import EngineCore, FunctionInfo
 
-from ..models._core import _Field
+from ..models._core import _Field, _Mapping
 
 from ..models import fields
 
 from .common import Constants
-from .utils import RegisterComparison, RegisterAdapter, RegisterFunction
+from .utils import RegisterComparison, RegisterAdapter, RegisterFunction, RegisterNativeFunction
 
 import pyorm.core.exceptions as exceptions
 
 import decimal
 import datetime
 
+# Validation of each PRAGMA option - values are formatted into the PRAGMA statement so must be checked
+_pragma_options = collections.OrderedDict([
+    ('journal_mode', lambda v: str(v).upper() in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')),
+    ('synchronous', lambda v: str(v).upper() in ('OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3')),
+    ('cache_size', lambda v: isinstance(v, int) and not isinstance(v, bool)),
+    ('mmap_size', lambda v: isinstance(v, int) and not isinstance(v, bool) and v >= 0),
+    ('temp_store', lambda v: str(v).upper() in ('DEFAULT', 'FILE', 'MEMORY', '0', '1', '2')),
+    ('busy_timeout', lambda v: isinstance(v, int) and not isinstance(v, bool) and v >= 0),
+])
+
+# Named sets of PRAGMA options
+#   durable : WAL with a sync on every commit - no committed transaction is lost on power failure
+#   balanced : WAL syncing only at checkpoints, with a larger cache and memory mapped reads
+#   bulk-load : Fastest writes - no sync and an in memory journal; a crash can corrupt the database
+profiles = {
+    'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'busy_timeout': 5000},
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536,
+                 'mmap_size': 268435456, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+    'bulk-load': {'journal_mode': 'MEMORY', 'synchronous': 'OFF', 'cache_size': -262144,
+                  'mmap_size': 268435456, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+}
+
+# A step in a query plan which reads every row of a table - 'SCAN TABLE t' before sqlite 3.36, 'SCAN t' after
+_full_scan = re.compile(r'^SCAN (?:TABLE )?(\S+)(?!.* USING (?:COVERING )?INDEX)')
+
+# Only statements which sqlite can plan are explained
+_explainable = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+class SlowQueryLog:
+    """Record the statements executed against a database which take longer than a threshold
+
+       Each slow statement is written as a JSON object on its own line (NDJSON) - with the SQL, the types of
+       its bound parameters (never their values), the elapsed time, the rows, and the EXPLAIN QUERY PLAN steps.
+       Full table scans in the plan are flagged. The file is rotated once it reaches max_bytes.
+    """
+    def __init__(self, engine, path, threshold=0.1, max_bytes=1048576, backup_count=5):
+        """Start logging the slow statements executed against the engine's database
+
+        :param engine: The engine - statements on any engine for the same database are logged
+        :param path: The NDJSON file to write to
+        :param threshold: The elapsed time in seconds above which a statement is logged
+        :param max_bytes: The size at which the file is rotated - 0 to never rotate
+        :param backup_count: The number of rotated files to keep
+        """
+        self._engine = engine
+        self._db_path = str(engine.db_path)
+        self._threshold = threshold
+        self._handler = logging.handlers.RotatingFileHandler(str(path), maxBytes=max_bytes,
+                                                             backupCount=backup_count, delay=True)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._listener = engine.__class__.add_listener(post_execute=self._post_execute)
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, value):
+        self._threshold = value
+
+    def _post_execute(self, event):
+        """Post execute listener - record the statement if it is slower than the threshold"""
+        if event.elapsed is None or event.elapsed < self._threshold or str(event.engine.db_path) != self._db_path:
+            return
+        self._handler.handle(logging.makeLogRecord({'msg': json.dumps(self.record(event), default=str)}))
+
+    def record(self, event):
+        """The dictionary written for a slow statement"""
+        params = event.params[0] if event.many and event.params else event.params
+        plan = []
+        if event.error is None and event.sql.lstrip().split(None, 1)[0].upper() in _explainable:
+            try:
+                plan = event.engine.explain(event.sql, params, connection=event.connection)
+            except sqlite3.Error:
+                pass
+
+        steps = [step for depth, step in plan]
+        return collections.OrderedDict([
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+            ('database', self._db_path),
+            ('sql', event.sql),
+            ('params', [type(value).__name__ for value in params]),
+            ('param_count', event.param_count),
+            ('many', event.many),
+            ('elapsed', round(event.elapsed, 6)),
+            ('rows', event.rowcount),
+            ('error', repr(event.error) if event.error is not None else None),
+            ('plan', steps),
+            ('full_scans', [match.group(1) for match in map(_full_scan.match, steps) if match]),
+        ])
+
+    def close(self):
+        """Stop logging and close the file"""
+        self._engine.__class__.remove_listener(self._listener)
+        self._handler.close()
+
 
 class Engine(EngineCore):
 
@@ -52,6 +155,7 @@ class Engine(EngineCore):
 
     _comparisons = {}
     _functions = {}
+    _native_functions = {}
     _adapters = {}
     _lookups = {}
 
@@ -60,14 +164,39 @@ class Engine(EngineCore):
         cls._comparisons[name] = comparison_callable
 
     @classmethod
-    def register_function(cls, name, function_callable):
-        cls._functions[name] = function_callable
+    def register_function(cls, name, function_callable, arity=-1, deterministic=False):
+        cls._functions[name] = FunctionInfo(function_callable, arity, deterministic)
+
+    @classmethod
+    def register_native_function(cls, name, function_callable):
+        cls._native_functions[name] = function_callable
 
     @classmethod
     def register_adapter(cls, name, adater_class):
         cls._adapters[name] = adater_class
 
+    @property
+    def pragmas(self):
+        """The PRAGMA options applied to every new connection - as an ordered dictionary"""
+        return collections.OrderedDict(self._pragmas)
+
     def prepare_engine(self, dbpath):
+        # Resolve the profile and explicit options into the PRAGMAs for each connection
+        options = dict(self._options)
+        profile_name = options.pop('profile', None)
+        if profile_name is not None and profile_name not in profiles:
+            raise exceptions.pyOrmEngineException('Unknown sqlite profile \'{}\' : expecting one of {}'.format(
+                profile_name, ', '.join(sorted(profiles))))
+
+        settings = dict(profiles.get(profile_name, {}), **options)
+        for name, value in settings.items():
+            if name not in _pragma_options:
+                raise exceptions.pyOrmEngineException('Unknown sqlite option \'{}\''.format(name))
+            if not _pragma_options[name](value):
+                raise exceptions.pyOrmEngineException('Invalid value for sqlite option \'{}\' : {!r}'.format(name, value))
+
+        self._pragmas = [(name, settings[name]) for name in _pragma_options if name in settings]
+
         # Adapters get added to the sqlite library rather than a specific connection
         for field_type, db_type in self.__class__._column_types.items():
             adapater_type = self.__class__._adapters.get(db_type, None)
@@ -77,6 +206,60 @@ class Engine(EngineCore):
                 sqlite3.register_converter(db_type,adapter.convert)
 
 
+    # Take the write lock as the transaction starts - so no other connection can insert rows part way through
+    _begin = 'BEGIN IMMEDIATE'
+
+    def durability(self, connection, durable):
+        """Set PRAGMA synchronous on the connection - FULL if durable, OFF if not, or a previous setting to restore it"""
+        cursor = self._execute(connection, 'PRAGMA synchronous', ())
+        try:
+            previous = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+        setting = ('FULL' if durable else 'OFF') if isinstance(durable, bool) else durable
+        if setting is not None and _pragma_options['synchronous'](setting):
+            self._execute(connection, 'PRAGMA synchronous={}'.format(setting), ()).close()
+        return previous
+
+    def explain(self, sql, params=(), connection=None):
+        """The EXPLAIN QUERY PLAN steps for a statement - a list of (depth, step) 2-tuples
+
+           The plan is made on the connection given (or a pooled connection). It is read directly from the
+           database handle, so it isn't reported to the instrumentation listeners.
+        """
+        pooled = self.connect() if connection is None else None
+        try:
+            cursor = (pooled or connection).handle.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            try:
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        finally:
+            if pooled is not None:
+                pooled.close()
+
+        # Each step names its parent step - the depth is the length of the chain of parents
+        depths, plan = {0: -1}, []
+        for node, parent, _, detail in rows:
+            depths[node] = depths.get(parent, -1) + 1
+            plan.append((depths[node], detail))
+        return plan
+
+    def slow_query_log(self, path, threshold=0.1, max_bytes=1048576, backup_count=5):
+        """Start logging statements slower than threshold seconds to a rotating NDJSON file - returns the SlowQueryLog
+
+           Call close() on the log to stop logging.
+        """
+        return SlowQueryLog(self, path, threshold=threshold, max_bytes=max_bytes, backup_count=backup_count)
+
+    def max_variables(self, connection):
+        """The limit on bound parameters in a statement - only reported by the sqlite3 module from Python 3.11"""
+        try:
+            return connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        except AttributeError:
+            return self._max_variables
+
     @classmethod
     def CreateTemporaryDb(cls, shared=True, unique_per_thread=True):
         return cls(dbpath=':memory:', shared=True, unique_per_thread=True)
@@ -84,9 +267,14 @@ class Engine(EngineCore):
     def get_connection(self):
         """sqlite specific function to connect to the database"""
         try:
-            con = sqlite3.connect(str(self.db_path), detect_types=sqlite3.PARSE_DECLTYPES)
-            for method_name, method in self.__class__._functions.items():
-                con.create_function(method_name, -1, method)
+            # Autocommit mode - transactions are only opened explicitly
+            con = sqlite3.connect(str(self.db_path), detect_types=sqlite3.PARSE_DECLTYPES,
+                                  isolation_level=None, check_same_thread=False)
+            for method_name, function in self.__class__._functions.items():
+                self._create_function(con, method_name, function)
+
+            for name, value in self._pragmas:
+                con.execute('PRAGMA {}={}'.format(name, value)).close()
 
             con.row_factory = sqlite3.Row
             return con
@@ -94,6 +282,17 @@ class Engine(EngineCore):
             raise exceptions.ConnectionError('Unable to connect to database : {}'.format(e.strerror))
 
 
+    @staticmethod
+    def _create_function(con, name, function):
+        """Register a function on a connection - flagged as deterministic where sqlite & python support it"""
+        if function.deterministic:
+            try:
+                con.create_function(name, function.arity, function.callable, deterministic=True)
+                return
+            except (TypeError, sqlite3.NotSupportedError):
+                pass
+        con.create_function(name, function.arity, function.callable)
+
     @classmethod
     def column_name(cls_, field: _Field):
         """Generate appropriate SQL fragment for this field in a select statement"""
@@ -102,6 +301,9 @@ class Engine(EngineCore):
     @classmethod
     def column_type(cls_, field: _Field):
         """Generate appropriate SQL fragment for this field in a select statement"""
+        # A foreign key column has the type of the field it references
+        if isinstance(field, _Mapping):
+            field = field.related_field()
         type = cls_._column_types.get(field.__class__,'text')
         segment = '{type}'.format(type =type)
         return segment
@@ -125,42 +327,53 @@ class Engine(EngineCore):
 # Engine specific functions for field comparisions - called
 # only when fields have been fully resolved
 #
+# Each comparison returns a 2-tuple of (sql_fragment, params) - values are
+# always bound as parameters (never formatted into the SQL) so that every
+# query of the same shape shares one prepared statement.
+#
 #----------------------------------------------------------------
 @RegisterComparison(Engine, 'exact')
 def exact(field_name, value ):
-    return "{} = {!r}".format(field_name, value)
+    if value is None:
+        return "{} IS NULL".format(field_name), []
+    return "{} = ?".format(field_name), [value]
 
 @RegisterComparison(Engine, 'iexact')
 def iexact(field_name, value ):
-    return "{} = {!r}".format(field_name, value)
+    return "{} = ? COLLATE NOCASE".format(field_name), [value]
 
 @RegisterComparison(Engine, 'gte')
 def gte(field_name, value ):
-    return "{} >= {!r}".format(field_name, value)
+    return "{} >= ?".format(field_name), [value]
 
 @RegisterComparison(Engine, 'gt')
 def gt(field_name, value ):
-    return "{} > {!r}".format(field_name, value)
+    return "{} > ?".format(field_name), [value]
 
 @RegisterComparison(Engine, 'lt')
 def lt(field_name, value ):
-    return "{} < {!r}".format(field_name, value)
+    return "{} < ?".format(field_name), [value]
 
 @RegisterComparison(Engine, 'lte')
 def lte(field_name, value ):
-    return "{} <= {!r}".format(field_name, value)
+    return "{} <= ?".format(field_name), [value]
 
 @RegisterComparison(Engine, 'contains')
 def contains(field_name, value ):
-    return "{} like \'%{}%\'".format(field_name, value)
+    return "{} like \'%\' || ? || \'%\'".format(field_name), [value]
 
 @RegisterComparison(Engine, 'startswith')
 def startswith(field_name, value ):
-    return "{} like \'{}%\'".format(field_name, value)
+    return "{} like ? || \'%\'".format(field_name), [value]
 
 @RegisterComparison(Engine, 'endswith')
-def startswith(field_name, value ):
-    return "{} like \'%{}\'".format(field_name, value)
+def endswith(field_name, value ):
+    return "{} like \'%\' || ?".format(field_name), [value]
+
+@RegisterComparison(Engine, 'in')
+def in_list(field_name, value ):
+    values = list(value)
+    return "{} IN ({})".format(field_name, ', '.join('?' * len(values))), values
 
 #-----------------------------------------------------------------
 #
@@ -256,32 +469,65 @@ def splittime(datetime_str=None, level=1):
     """
     return (':'.join(datetime_str.split(' ')[1].split(':')[0:level] + ['00'] * (3 - level)).split('.')[0]) if datetime_str else None
 
-@RegisterFunction(Engine, 'TruncYear')
+@RegisterFunction(Engine, 'TruncYear', arity=1, deterministic=True)
 def TruncYear(the_date):
     """Truncate the date to the Year only - month and day are replaced with 1, time section is removed"""
     return splitdate(date_str=the_date, level=1)
 
-@RegisterFunction(Engine, 'TruncMonth')
+@RegisterFunction(Engine, 'TruncMonth', arity=1, deterministic=True)
 def Truncmonth(date_str):
     """Truncate the date to the Year & month only - day is replaced with 1, time section is removed"""
     return splitdate(date_str=date_str, level=2)
 
-@RegisterFunction(Engine, 'TruncDay')
+@RegisterFunction(Engine, 'TruncDay', arity=1, deterministic=True)
 def Truncday(date_str):
     """Truncate the date to the Year, month & day only - time section is removed"""
     return splitdate(date_str=date_str, level=3)
 
-@RegisterFunction(Engine, 'TruncHour')
+@RegisterFunction(Engine, 'TruncHour', arity=1, deterministic=True)
 def Trunchour(datetime_str):
     """Truncate the datetime to the hour - minutes and seconds are replaced with 00, microseconds are removed"""
     return (splitdate(date_str=datetime_str, level=3) + ' ' + splittime(datetime_str=datetime_str, level=1)) if datetime_str else None
 
-@RegisterFunction(Engine, 'TruncMinutes')
+@RegisterFunction(Engine, 'TruncMinutes', arity=1, deterministic=True)
 def Truncminutes(datetime_str):
     """Truncate the datetime to the Minute - seconds are replaced with 00, microseconds are removed"""
     return (splitdate(date_str=datetime_str, level=3) + ' ' + splittime(datetime_str=datetime_str, level=2)) if datetime_str else None
 
-@RegisterFunction(Engine, 'TruncSeconds')
+@RegisterFunction(Engine, 'TruncSeconds', arity=1, deterministic=True)
 def Truncseconds(datetime_str):
     """Truncate the datetime to the Second - seconds are replaced with 00, microseconds are removed"""
     return (splitdate(date_str=datetime_str, level=3) + ' ' + splittime(datetime_str=datetime_str, level=3)) if datetime_str else None
+
+#-----------------------------------------------------------------
+#
+# Native TruncDate functions
+#
+# The same truncations as the functions above, built from sqlite's own date
+# functions - evaluated without a call back into Python for every row.
+# The functions above remain registered as the fallback for raw SQL.
+#
+#-----------------------------------------------------------------
+@RegisterNativeFunction(Engine, 'TruncYear')
+def native_trunc_year(the_date):
+    return "strftime('%Y', {}) || '-1-1'".format(the_date)
+
+@RegisterNativeFunction(Engine, 'TruncMonth')
+def native_trunc_month(the_date):
+    return "strftime('%Y-%m', {}) || '-1'".format(the_date)
+
+@RegisterNativeFunction(Engine, 'TruncDay')
+def native_trunc_day(the_date):
+    return "date({})".format(the_date)
+
+@RegisterNativeFunction(Engine, 'TruncHour')
+def native_trunc_hour(the_datetime):
+    return "strftime('%Y-%m-%d %H:00:00', {})".format(the_datetime)
+
+@RegisterNativeFunction(Engine, 'TruncMinutes')
+def native_trunc_minutes(the_datetime):
+    return "strftime('%Y-%m-%d %H:%M:00', {})".format(the_datetime)
+
+@RegisterNativeFunction(Engine, 'TruncSeconds')
+def native_trunc_seconds(the_datetime):
+    return "strftime('%Y-%m-%d %H:%M:%S', {})".format(the_datetime)
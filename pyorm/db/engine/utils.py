@@ -22,7 +22,11 @@ __created__ = '31 Aug 2017'
 
 
 def RegisterComparison(engine_class, lookup_name):
-    """Decorator define a comparison function to support comparise between field and value"""
+    """Decorator define a comparison function to support comparise between field and value
+
+       The comparison function must return a 2-tuple of (sql_fragment, params), where the
+       sql_fragment uses placeholders for the value and params is the list of values to bind.
+    """
     def outer_wrapper( func ):
         @wraps(func)
         def inner_wrapper( field_name,value):
@@ -31,13 +35,32 @@ def RegisterComparison(engine_class, lookup_name):
         return inner_wrapper
     return outer_wrapper
 
-def RegisterFunction(engine_class, lookup_name):
-    """Decorator define a lookup function to support transformation of a SQL field"""
+def RegisterFunction(engine_class, lookup_name, arity=-1, deterministic=False):
+    """Decorator define a lookup function to support transformation of a SQL field
+
+       :param arity: The number of arguments the function takes - -1 for any number
+       :param deterministic: True if the function always returns the same result for the same arguments.
+                Only deterministic functions can be used in indexes, and the database can factor out repeated calls.
+    """
+    def outer_wrapper( func ):
+        @wraps(func)
+        def inner_wrapper(*args):
+            return func(*args)
+        engine_class.register_function(lookup_name, inner_wrapper, arity=arity, deterministic=deterministic)
+        return inner_wrapper
+    return outer_wrapper
+
+def RegisterNativeFunction(engine_class, lookup_name):
+    """Decorator define the native SQL form of a function - used in preference to a function registered as a UDF
+
+       The decorated function is called with the SQL fragments of the arguments, and must return the SQL
+       fragment which applies the function to them.
+    """
     def outer_wrapper( func ):
         @wraps(func)
         def inner_wrapper(*args):
             return func(*args)
-        engine_class.register_function(lookup_name, inner_wrapper)
+        engine_class.register_native_function(lookup_name, inner_wrapper)
         return inner_wrapper
     return outer_wrapper
 
@@ -4,12 +4,13 @@
 # pyORM : Implementation of migrations.py
 
 Summary : 
-    <summary of module/class being implemented>
+    Migrations - the operations which change the database schema
 Use Case : 
-    As a <actor> I want <outcome> So that <justification>
+    As a Developer I want to create tables and indexes from migrations So that the schema matches my models
 
 Testable Statements :
-    Can I <Boolean statement>
+    Can I create a table and its indexes from a list of fields
+    Can I add and remove indexes on an existing model
     ....
 """
 
@@ -17,17 +18,110 @@ __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '01 Aug 2017'
 
+from collections import OrderedDict
+
+from pyorm.core.exceptions import MigrationError
+from pyorm.db.models.indexes import field_indexes
 
 
 class Migration():
+    """A set of operations applied to the database together
+
+       The dependencies and operations can be given to the constructor, or as class attributes of a subclass.
+
+       The operations work on the state of the models as the migrations describe them - a dictionary of
+       model name : ModelState - never on the model classes, which may have changed since. To apply several
+       migrations pass the same state to each, in dependency order.
+    """
+    dependencies = []
+    operations = []
+
     def __init__(self, initial=False, dependencies=None, operations=None):
         self._initial = initial
-        self._dependencies = dependencies if dependencies else []
-        self._operations = operations if operations else []
+        self._dependencies = dependencies if dependencies else list(self.__class__.dependencies)
+        self._operations = operations if operations else list(self.__class__.operations)
+
+    def sql(self, engine, state=None):
+        """The statements which apply this migration on the engine - the state is updated by each operation"""
+        state = {} if state is None else state
+        return [sql for operation in self._operations for sql in operation.sql(engine, state)]
+
+    def execute(self, engine, state=None):
+        """Apply every operation - in a single transaction"""
+        with engine.atomic():
+            for sql in self.sql(engine, state):
+                engine.execute(sql)
+
+
+class ModelState():
+    """A model as described by a migration - its table name, fields and indexes
+
+       Stands in for the model class when generating the SQL - the model may since have changed.
+    """
+    def __init__(self, name, fields, indexes=()):
+        self.__name__ = name
+        self._fields = OrderedDict(fields)
+        for field_name, field in self._fields.items():
+            if field.name != field_name:
+                field.name = field_name
+        self._indexes = list(indexes)
+
+    def table_name(self):
+        return self.__name__
+
+    def db_fields(self):
+        yield from self._fields.items()
+
+    def db_field_by_name(self, name):
+        return self._fields.get(name, None)
+
+    def indexes(self):
+        return field_indexes(self.db_fields()) + self._indexes
+
+    def with_indexes(self, indexes):
+        """A copy of this state with these indexes declared"""
+        return ModelState(self.__name__, self._fields.items(), indexes)
+
+    @staticmethod
+    def lookup(state, name):
+        """The state of the named model - MigrationError if no earlier operation created it"""
+        try:
+            return state[name]
+        except KeyError:
+            raise MigrationError('Unknown model \'{}\' : it isn\'t created by this or an earlier migration'.format(
+                name)) from None
 
-    def execute(self):
-        pass
 
 class CreateModel():
-    def __init__(self, name, fields):
-        pass
\ No newline at end of file
+    """Create the table for a model, with the indexes on its fields and any indexes given"""
+    def __init__(self, name, fields, indexes=()):
+        self._state = ModelState(name, fields, indexes)
+
+    def sql(self, engine, state):
+        state[self._state.__name__] = self._state
+        return engine.schema_sql(self._state)
+
+
+class AddIndex():
+    """Add an index to a model created by an earlier operation"""
+    def __init__(self, model_name, index):
+        self._model_name = model_name
+        self._index = index
+
+    def sql(self, engine, state):
+        model = ModelState.lookup(state, self._model_name)
+        state[self._model_name] = model.with_indexes(model._indexes + [self._index])
+        return [engine.index_sql(model, self._index)]
+
+
+class RemoveIndex():
+    """Remove a named index from a model created by an earlier operation"""
+    def __init__(self, model_name, name):
+        self._model_name = model_name
+        self._name = name
+
+    def sql(self, engine, state):
+        model = ModelState.lookup(state, self._model_name)
+        state[self._model_name] = model.with_indexes([index for index in model._indexes
+                                                      if index.name_for(model) != self._name])
+        return [engine.drop_index_sql(self._name)]
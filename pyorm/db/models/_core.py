@@ -122,6 +122,19 @@ class _Field():
 
 #ToDO Record the parent Model of each field. Record aliases
 
+    def __get__(self, instance, owner):
+        """Only called if the instance has no value for this field - i.e. the field was deferred when loaded
+
+           A deferred field is loaded from the database on first access; otherwise the field itself is returned
+        """
+        if instance is None:
+            return self
+
+        loader = instance.__dict__.get('__deferred', None)
+        if loader is None:
+            return self
+        return loader.load(instance, self.name)
+
     def verify_value(self, value):
 
         if self.not_null() and value is None:
@@ -237,6 +250,10 @@ class _Field():
 
         return value
 
+    def db_value(self, value):
+        """The value to store in the database column for this attribute value"""
+        return value
+
 class _Mapping(_Field):
     """Mixim to record the information required for a ForeignField, OneToMany or ManyToMany mapping"""
     def __init__(self, othermodel=None, to_field=None, *args, **kwargs):
@@ -252,8 +269,27 @@ class _Mapping(_Field):
         super(_Mapping, self).__init__(*args,**kwargs)
 
     def other_model(self):
+        """The related Model class - a Model named by a string is looked up when first needed"""
+        if isinstance(self._othermodel, str):
+            othermodel = _ModelMetaClass._models.get(self._othermodel, None)
+            if othermodel is None:
+                raise ValueError("'othermodel' attribute on field '{n}' : '{m}' is not a known Model".format(
+                    n=self.name, m=self._othermodel))
+            self._othermodel = othermodel
         return self._othermodel
 
+    def related_field(self):
+        """The field on the other model which this field references - the primary key unless set explicitly"""
+        othermodel = self.other_model()
+        if not self._to_field:
+            return othermodel.primary_field()
+
+        field = othermodel.db_field_by_name(self._to_field)
+        if field is None:
+            raise ValueError("Invalid settings for field '{n}' : '{c}' is not a field on the '{m}' model".format(
+                n=self.name, c=self._to_field, m=othermodel.__name__))
+        return field
+
     def to_field(self):
         return self._to_field
 
@@ -281,6 +317,30 @@ class AutoField(_Field):
         return "INTEGER"
 
 
+# The dirty fields of an instance which is unchanged since it was loaded or saved - shared, as it is never changed
+_CLEAN = frozenset()
+
+
+def _make_row_decoder(model, attr_names):
+    """Build a function which converts a database row into an instance of the model
+
+       The row is a sequence of values in the same order as attr_names. Values from the database are trusted -
+       the instance is created without calling __init__, and without validating or coercing each value.
+       The new instance is not dirty.
+    """
+    attr_names = tuple(attr_names)
+
+    def decode(row, _new=object.__new__, _zip=zip):
+        inst = _new(model)
+        attrs = inst.__dict__
+        attrs.update(_zip(attr_names, row))
+        attrs['__dirty'] = _CLEAN
+        return inst
+
+    decode.attr_names = attr_names
+    return decode
+
+
 class _ModelMetaClass(type):
     """Meta class for any Model instance
 
@@ -334,6 +394,9 @@ class _ModelMetaClass(type):
 
         # Class attributes for the __db_path__, __table__ and __name__
         cls._table_name = cls_dict.get("_table", cls_name)
+        cls._order_by = list(cls_dict.get("_order_by", []))
+        cls._engine = cls_dict.get("_engine", None)
+        cls._indexes = list(cls_dict.get("_indexes", []))
 
         # Extract the class attributes which are _Field instances
         fields = collections.OrderedDict([(k, cls_dict[k]) for k in cls_dict
@@ -354,6 +417,8 @@ class _ModelMetaClass(type):
         for manager_name, manager_inst in managers.items():
             if not manager_inst.name:
                 manager_inst.name = manager_name
+            if manager_inst.model is None:
+                manager_inst.model = cls
 
         if not managers:
             if 'objects' in fields:
@@ -362,6 +427,9 @@ class _ModelMetaClass(type):
             managers['objects'] = Manager(name='objects', model=cls)
             cls.objects = managers['objects']
 
+        # The first manager declared is the one the model uses itself - e.g. to save instances
+        cls._default_manager = next(iter(managers.values()))
+
         # Find any primary keys which are already defined
         primaries = [(name, field) for name, field in fields.items() if field.is_primary() ]
 
@@ -384,8 +452,9 @@ class _ModelMetaClass(type):
                     names = ",".join('\''+f[0]+'\'' for f in primaries)
                 ))
 
-        #Find dependencies (i.e.tables that this maps to)
-        cls._dependencies = [field.othermodel() for field_name, field in fields.items()
+        #Find dependencies (i.e.tables that this maps to) - the models are looked up when needed,
+        # as a mapping can name a model which isn't defined yet
+        cls._dependencies = [field for field_name, field in fields.items()
                                      if isinstance(field,_Mapping)]
 
         # Create a mapping from the db_column name to the actual field - used on queries.
@@ -394,6 +463,11 @@ class _ModelMetaClass(type):
         cls._db_fields = fields
         cls._managers = managers
 
+        # The decoder for rows with every column - in field order. Decoders for other columns are built on demand
+        cls._row_decoders = {}
+        cls._row_decoder = _make_row_decoder(cls, fields)
+        cls._row_decoders[tuple(field.db_column for field in fields.values())] = cls._row_decoder
+
          # keep a class based list of all the models we have created.
         _ModelMetaClass._models[cls_name] = cls
 
@@ -19,19 +19,51 @@ __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '29 Aug 2017'
 
 
-#Todo Parameter validation
+class Aggregate(Lazy):
+    """An aggregate function calculated by the database over a group of rows
 
-class Count(Lazy):
-    pass
+       Aggregate(field, distinct=False) - the field is a field name (possibly related) or an F expression.
+       With distinct=True only distinct values of the field are aggregated.
+    """
+    function = None
 
-class Sum(Lazy):
-    pass
+    def __init__(self, field, distinct=False):
+        super().__init__(field, distinct=distinct)
 
-class Avg(Lazy):
-    pass
+    @property
+    def field(self):
+        return self.args[0]
 
-class Max(Lazy):
-    pass
+    @property
+    def distinct(self):
+        return self.kwargs['distinct']
 
-class Min(Lazy):
-    pass
\ No newline at end of file
+    def default_alias(self):
+        """The name of the result if no alias is given - e.g. 'age__sum'"""
+        if not isinstance(self.field, str) or self.field == '*':
+            raise AttributeError('An alias is required for {!r}'.format(self))
+        return '{}__{}'.format(self.field, self.__class__.__name__.lower())
+
+
+class Count(Aggregate):
+    """The number of rows - or non null values of the field - in each group; Count() counts rows"""
+    function = 'COUNT'
+
+    def __init__(self, field='*', distinct=False):
+        super().__init__(field, distinct=distinct)
+
+
+class Sum(Aggregate):
+    function = 'SUM'
+
+
+class Avg(Aggregate):
+    function = 'AVG'
+
+
+class Max(Aggregate):
+    function = 'MAX'
+
+
+class Min(Aggregate):
+    function = 'MIN'
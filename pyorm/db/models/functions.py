@@ -20,5 +20,30 @@ __created__ = '30 Aug 2017'
 
 from .utils import Lazy
 
+class Function(Lazy):
+    """Apply a function registered with the engine - the arguments are the function name and the field names"""
+    def __init__(self, name, *arguments):
+        super().__init__(name, *arguments)
+
+    @property
+    def name(self):
+        return self._args[0]
+
+    @property
+    def arguments(self):
+        return self._args[1:]
+
+
 class TruncDate(Lazy):
-    pass
+    """Truncate a date or datetime field - the arguments are the field name and the kind of truncation"""
+    _function_names = {'years': 'TruncYear', 'months': 'TruncMonth', 'days': 'TruncDay',
+                       'hours': 'TruncHour', 'minutes': 'TruncMinutes', 'seconds': 'TruncSeconds'}
+
+    @property
+    def field(self):
+        return self._args[0]
+
+    @property
+    def function_name(self):
+        """The name of the engine function which implements this truncation"""
+        return self._function_names[self._args[1].lower()]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# pyORM : Implementation of indexes.py
+
+Summary :
+    Declaration of the indexes on a model
+Use Case :
+    As a Developer I want to declare indexes on fields and expressions So that my queries can use them
+
+Testable Statements :
+    Can I declare an index over one or more fields
+    Can I declare an index over a function of a field
+    Can I declare unique, partial and covering indexes
+    Can I index a field by setting indexed=True
+    ....
+"""
+
+__version__ = "0.1"
+__author__ = 'Tony Flury : anthony.flury@btinternet.com'
+__created__ = '18 Oct 2026'
+
+
+class Index:
+    """An index on a model - declared in the model's _indexes list
+
+       Each expression is either a field name or a function of field names (a Function or TruncDate).
+
+       unique : No two rows can have the same values for the expressions
+       where : A Q object - only the rows which match it are indexed (a partial index)
+       include : Field names stored in the index (after the expressions) so a query reading only
+                 these fields and the expressions never reads the table (a covering index)
+
+       Example :
+
+            class Event(Model):
+                created = DateTimeField()
+                owner = CharField()
+                _indexes = [Index(TruncDate('created', 'days'), name='event_created_day'),
+                            Index('owner', 'created', unique=True, where=Q(owner__gt=''))]
+    """
+    def __init__(self, *expressions, name=None, unique=False, where=None, include=()):
+        if not expressions:
+            raise ValueError('An index needs at least one field or expression')
+        self._expressions = expressions
+        self._name = name
+        self._unique = unique
+        self._where = where
+        self._include = tuple(include)
+
+    @property
+    def expressions(self):
+        return self._expressions
+
+    @property
+    def unique(self):
+        return self._unique
+
+    @property
+    def where(self):
+        return self._where
+
+    @property
+    def include(self):
+        return self._include
+
+    def name_for(self, model):
+        """The name of this index on the model - generated from the table and expressions if not given"""
+        if self._name:
+            return self._name
+
+        parts = []
+        for expression in self._expressions:
+            if isinstance(expression, str):
+                parts.append(expression)
+            else:
+                parts.append('_'.join(str(arg) for arg in expression.args))
+        return '{}_{}_{}'.format(model.table_name(), '_'.join(parts), 'uniq' if self._unique else 'idx').replace('__', '_')
+
+    def __repr__(self):
+        options = [', name={!r}'.format(self._name) if self._name else '',
+                   ', unique=True' if self._unique else '',
+                   ', where={!r}'.format(self._where) if self._where is not None else '',
+                   ', include={!r}'.format(self._include) if self._include else '']
+        return 'Index({}{})'.format(', '.join(repr(expression) for expression in self._expressions), ''.join(options))
+
+
+def field_indexes(fields):
+    """The indexes for the fields declared with indexed=True - from (name, field) pairs
+
+       Primary keys and unique fields are skipped - the database indexes them already.
+    """
+    return [Index(name) for name, field in fields
+            if field.is_indexed() and not field.is_primary() and not field.is_unique()]
@@ -13,6 +13,8 @@ Testable Statements :
     ....
 """
 
+from operator import attrgetter
+
 __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '26 Aug 2017'
@@ -28,6 +30,12 @@ class Manager:
     def model(self):
         return self._model
 
+    @model.setter
+    def model(self, model):
+        if self._model:
+            raise AttributeError('Cannot change model attribute once set')
+        self._model = model
+
     @property
     def name(self):
         return self._name
@@ -37,7 +45,135 @@ class Manager:
         if self.name:
             raise AttributeError('Cannot change name attribute once set')
         self._name = new_name
-        # Todo Add all relevant methods to the Manager - including filters etc
+
+    def get_queryset(self):
+        """A QuerySet for all of the instances of the model"""
+        # Imported here as the queryset module depends on the models package which depends on this module
+        from .queryset import QuerySet
+        return QuerySet(model=self._model)
+
+    def all(self):
+        return self.get_queryset()
+
+    def filter(self, **kwargs):
+        return self.get_queryset().filter(**kwargs)
+
+    def exclude(self, **kwargs):
+        return self.get_queryset().exclude(**kwargs)
+
+    def get(self, **kwargs):
+        return self.get_queryset().get(**kwargs)
+
+    def count(self):
+        return self.get_queryset().count()
+
+    def exists(self):
+        return self.get_queryset().exists()
+
+    def update(self, **values):
+        return self.get_queryset().update(**values)
+
+    def aggregate(self, *args, **kwargs):
+        return self.get_queryset().aggregate(*args, **kwargs)
+
+    def annotate(self, *args, **kwargs):
+        return self.get_queryset().annotate(*args, **kwargs)
+
+    def values(self, *names):
+        return self.get_queryset().values(*names)
+
+    def values_list(self, *names, flat=False):
+        return self.get_queryset().values_list(*names, flat=flat)
+
+    def order_by(self, *args):
+        return self.get_queryset().order_by(*args)
+
+    def defer(self, *fields):
+        return self.get_queryset().defer(*fields)
+
+    def only(self, *fields):
+        return self.get_queryset().only(*fields)
+
+    def select_related(self, *fields):
+        return self.get_queryset().select_related(*fields)
+
+    def prefetch_related(self, *lookups):
+        return self.get_queryset().prefetch_related(*lookups)
+
+    def iterator(self, chunk_size=100):
+        return self.get_queryset().iterator(chunk_size=chunk_size)
+
+    def bulk_create(self, objs, batch_size=None):
+        """Insert the instances into the database in as few statements as possible - returns their primary keys
+
+           Every instance is inserted within a single transaction, in multi-row INSERT statements of up to
+           batch_size rows (by default as many rows as the engine's limit on bound parameters allows).
+           Values are not re-validated - every value was validated when it was set on the instance.
+           Primary keys allocated by the database are set on the instances.
+        """
+        # Imported here as the _core module depends on this module
+        from ._core import AutoField
+
+        model = self._model
+        objs = list(objs)
+        if batch_size is not None and batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+
+        for obj in objs:
+            if not isinstance(obj, model):
+                raise TypeError('bulk_create expects instances of {}: got {!r}'.format(model.__name__, obj))
+
+        # Instances without a primary key have one allocated by the database
+        primary = model.primary_field()
+        get_pk = attrgetter(primary.name)
+        allocated = isinstance(primary, AutoField)
+        pending = [obj for obj in objs if allocated and not get_pk(obj)]
+        complete = [obj for obj in objs if not (allocated and not get_pk(obj))]
+
+        fields = [field for name, field in model.db_fields()]
+        engine = model.engine()
+        with engine.transaction():
+            if complete:
+                engine.bulk_insert(model.table_name(), [field.db_column for field in fields],
+                                   map(self._row_getter(fields), complete), batch_size=batch_size)
+
+            # Rows inserted without a rowid get consecutive rowids - the transaction locks out other writers
+            if pending:
+                fields = [field for field in fields if field is not primary]
+                last = engine.bulk_insert(model.table_name(), [field.db_column for field in fields],
+                                          map(self._row_getter(fields), pending), batch_size=batch_size)
+                for pk, obj in zip(range(last - len(pending) + 1, last + 1), pending):
+                    obj._loaded(**{primary.name: pk})
+
+        for obj in complete:
+            obj._loaded()
+        return [get_pk(obj) for obj in objs]
+
+    @staticmethod
+    def _row_getter(fields):
+        """A function to extract the values of these fields from an instance as a tuple"""
+        # Imported here as the _core module depends on this module
+        from ._core import _Field
+
+        if not fields:
+            return lambda obj: ()
+
+        getter = attrgetter(*[field.name for field in fields])
+        if len(fields) == 1:
+            getter = lambda obj, get=getter: (get(obj),)
+
+        # Related instances are stored by their key
+        converters = [(index, field.db_value) for index, field in enumerate(fields)
+                      if field.__class__.db_value is not _Field.db_value]
+        if not converters:
+            return getter
+
+        def get_row(obj):
+            row = list(getter(obj))
+            for index, db_value in converters:
+                row[index] = db_value(row[index])
+            return row
+        return get_row
 
 
 
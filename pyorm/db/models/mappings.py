@@ -21,31 +21,40 @@ from pyorm.db.models import models, _core
 
 
 class ForeignKey(_core._Mapping):
-    def __init__(self, *args, **kwargs):
-        super(ForeignKey, self).__init__(*args, python_type = models.Model, **kwargs)
-
-    def _attributes_valid(self):
-
-        assert issubclass(self._othermodel, models.Model)
-
-        if not issubclass(self._othermodel, models.Model):
-            raise ValueError("'othermodel' attrribute on field '{n}' must be a valid Model".format(n=self.name))
-
-        self._db_column = self._othermodel.__table__ + "_id"
-
-        # check that the to_field is set correctly
-        if self._to_field:
-            # Ensure that the field exists on the other model
-            if self._to_field not in self._othermodel.db_fields():
-                raise ValueError(" Invalid settings for field '{n}' : '{c}' is not a field on the '{m}' model".format(
-                    n=self.name,
-                    c=self._to_field,
-                    m=self._othermodel.__name__))
-            else:
-                return
-        else:
-            # Search for primary field in the other model
-            self._to_field = self._othermodel.primary_name()
-
-    def is_valid(self, value):
-        return isinstance(value, models.Model)
\ No newline at end of file
+    """A field which holds a reference to a row of another model
+
+       The column holds the key of the related row - by default the primary key of the other model. The attribute
+       holds either the key value or an instance of the other model (e.g. when fetched with select_related).
+    """
+    _python_type = object
+
+    def __init__(self, othermodel=None, to_field=None, related_name=None, **kwargs):
+        """
+        :param othermodel: The related Model class - or the name of the Model class
+        :param to_field: The name of the field on the other model - by default the primary key
+        :param related_name: The name of the reverse relation on the other model - by default
+                    the lower case name of this model with a '_set' suffix
+        """
+        self._related_name = related_name
+        super(ForeignKey, self).__init__(othermodel=othermodel, to_field=to_field, **kwargs)
+
+    def related_name(self):
+        """The name of the reverse relation from the other model back to this model"""
+        return self._related_name if self._related_name else self.model.__name__.lower() + '_set'
+
+    @property
+    def name(self):
+        return _core._Field.name.fget(self)
+
+    @name.setter
+    def name(self, value):
+        """The column name defaults to the field name with an '_id' suffix"""
+        if not self._db_column and value:
+            self._db_column = value + '_id'
+        _core._Field.name.fset(self, value)
+
+    def db_value(self, value):
+        """The key value stored in the column - the referenced field of a related instance"""
+        if isinstance(value, models.Model):
+            return getattr(value, self.related_field().name)
+        return value
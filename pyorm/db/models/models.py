@@ -14,7 +14,9 @@ Testable Statements :
 
 import pyorm.core.exceptions as exceptions
 from pyorm.core.settingsmanager import SettingsManager
-from ._core import _Field, _Mapping, _ModelMetaClass
+from ._core import _Field, _Mapping, _ModelMetaClass, _make_row_decoder, _CLEAN
+from .indexes import field_indexes
+from .session import Session
 from ..engine.common import ImportEngine
 
 __version__ = "0.1"
@@ -23,6 +25,7 @@ __created__ = '23 Sep 2014'
 
 
 class Model( metaclass=_ModelMetaClass):
+    _default_engine = None
 
     def __init__(self, **kwargs):
         super(Model, self).__init__()
@@ -35,7 +38,8 @@ class Model( metaclass=_ModelMetaClass):
 
             setattr(self, field_name, value)
 
-        super().__setattr__('__dirty', True)
+        # A new instance has never been saved - every field is written when it is
+        super().__setattr__('__dirty', None)
 
     def primary_name(self):
         """Returns the primary key for this instance - this is a _Field instance - not a raw value
@@ -52,7 +56,7 @@ class Model( metaclass=_ModelMetaClass):
     def dependencies(cls):
         """  Return a list of the Models which this model is dependent on
         """
-        return cls._dependencies
+        return [field.other_model() for field in cls._dependencies]
 
     def __setattr__(self, key, value):
 
@@ -75,8 +79,21 @@ class Model( metaclass=_ModelMetaClass):
         except Exception as exc:
             raise AttributeError('Unknown error while validating value for {} field : {}'.format(self.name, str(exc)))
 
-        super().__setattr__(key, value)
-        super().__setattr__('__dirty', True)
+        # Record which fields of a saved instance have changed - setting the same value again isn't a change
+        attrs = self.__dict__
+        dirty = attrs.get('__dirty', None)
+        if dirty is not None:
+            if key in attrs and type(attrs[key]) is type(value) and attrs[key] == value:
+                return
+            # The row is found by the primary key it was saved with - until it is saved again
+            if field.is_primary() and '__pk' not in attrs:
+                attrs['__pk'] = attrs.get(key, None)
+            try:
+                dirty.add(key)
+            except AttributeError:
+                attrs['__dirty'] = {key}
+
+        attrs[key] = value
 
     @classmethod
     def db_fields(cls):
@@ -112,22 +129,165 @@ class Model( metaclass=_ModelMetaClass):
             attrs[attr_name] = value
         return attrs
 
+    @classmethod
+    def row_decoder(cls_, columns=None):
+        """Return the function to convert database rows with these db_columns into instances of this model
+
+           Without columns the decoder expects every column in field order. Annotations in the columns are set
+           as attributes named by their alias. Decoders are built once and cached. Within a Session the decoder
+           returns the instance already in the session's identity map for a row's primary key.
+        """
+        decoder = cls_._decoder_for(columns)
+        session = Session.current()
+        return session.decoder(cls_, decoder) if session is not None else decoder
+
+    @classmethod
+    def _decoder_for(cls_, columns):
+        """The cached decoder for rows with these db_columns"""
+        if columns is None:
+            return cls_._row_decoder
+
+        columns = tuple(columns)
+        decoder = cls_._row_decoders.get(columns, None)
+        if decoder is None:
+            attr_names = []
+            for column_name in columns:
+                if not isinstance(column_name, str):
+                    # An annotation is set on the instance by its alias
+                    attr_names.append(column_name.kwargs['alias'])
+                    continue
+                attr_name = cls_.db_column_to_attr_name(db_column=column_name)
+                if attr_name is None:
+                    raise exceptions.ColumnError('Unexpected column from database: column \'{}\' is not known on the \'{}\' model'.format(column_name, cls_.__name__)) from None
+                attr_names.append(attr_name)
+            decoder = cls_._row_decoders.setdefault(columns, _make_row_decoder(cls_, attr_names))
+        return decoder
+
+    @classmethod
+    def from_db(cls_, row, columns=None):
+        """Create an instance from a database row - the values are trusted and are not validated"""
+        return cls_.row_decoder(columns)(row)
+
+    def _loaded(self, **values):
+        """Record values set by the database - without validation - and mark the instance as clean"""
+        self.__dict__.update(values)
+        self.__dict__['__dirty'] = _CLEAN
+        self.__dict__.pop('__pk', None)
+
+    def is_dirty(self):
+        """True if this instance has been changed since it was created or loaded from the database"""
+        dirty = self.__dict__.get('__dirty', None)
+        return dirty is None or bool(dirty)
+
+    def is_saved(self):
+        """True if this instance has been loaded from or saved to the database"""
+        return self.__dict__.get('__dirty', None) is not None
+
+    def dirty_fields(self):
+        """The names of the fields changed since this instance was loaded or saved - every field if it never was"""
+        dirty = self.__dict__.get('__dirty', None)
+        if dirty is None:
+            return frozenset(name for name, field in self.db_fields())
+        return frozenset(dirty)
+
+    def save(self):
+        """Write this instance to the database - returns True if a statement was executed
+
+           A new instance is inserted. For a saved instance only the changed fields are updated, by the primary
+           key it was loaded or last saved with - and nothing is written if none have changed. Within an
+           atomic block the save joins the transaction.
+        """
+        model = self.__class__
+        manager = model._default_manager
+        if not self.is_saved():
+            manager.bulk_create([self])
+            session = Session.current()
+            if session is not None:
+                session.add(self)
+            return True
+
+        dirty = self.__dict__['__dirty']
+        if not dirty:
+            return False
+
+        fields = [field for name, field in self.db_fields() if name in dirty]
+        primary = self.primary_field()
+        engine = model.engine()
+        sql = engine.update_sql(model.table_name(), [field.db_column for field in fields], primary.db_column)
+        moved = '__pk' in self.__dict__
+        pk = self.__dict__['__pk'] if moved else getattr(self, primary.name)
+        params = list(manager._row_getter(fields)(self)) + [pk]
+        if engine.execute(sql, params).rowcount == 0:
+            raise exceptions.DoesNotExist('Cannot save \'{}\' instance {!r} : it no longer exists'.format(
+                model.__name__, pk))
+        self._loaded()
+
+        # The session holds the instance by its new primary key
+        session = Session.current()
+        if moved and session is not None:
+            session.evict(model, [pk])
+            session.add(self)
+        return True
+
     @classmethod
     def _check_field_names(cls_, field_names):
         for name in field_names:
             if cls_.db_field_by_name(name=name) is None:
                 raise AttributeError('Unknown field name: \'{}\' is not a field on \'{}\' model'.format(name, cls_.__name__))
 
+    @classmethod
+    def engine(cls):
+        """The engine instance for this model - the _engine class attribute, or the engine from the settings"""
+        if cls._engine is not None:
+            return cls._engine
+
+        if Model._default_engine is None:
+            settings = SettingsManager.get_sm()
+            Model._default_engine = ImportEngine(settings.get('db') if settings else None).engine_inst()
+            if Model._default_engine is None:
+                raise exceptions.ConnectionError('No database engine configured for the \'{}\' model'.format(cls.__name__))
+        return Model._default_engine
+
+    @classmethod
+    def indexes(cls):
+        """The indexes on this model - one for each field declared with indexed=True, then the _indexes class attribute"""
+        return field_indexes(cls.db_fields()) + list(cls._indexes)
+
     @classmethod
     def table_name(cls):
         return cls._table_name
 
     @classmethod
-    def get_relationshup(cls, manager_name):
-        """Finds the named manager, returns a 3-tuple
+    def order_by(cls):
+        """The default ordering for queries on this model - set by the _order_by class attribute"""
+        return list(cls._order_by)
+
+    @classmethod
+    def get_relationship(cls, name):
+        """Finds the named relationship, returns a 3-tuple - or None if there is no relationship with that name
+
+           [0] The related model
+           [1] The db_column on this model
+           [2] The db_column on the related model
+        """
+        field = cls.db_field_by_name(name)
+        if not isinstance(field, _Mapping):
+            return None
+        return field.other_model(), field.db_column, field.related_field().db_column
+
+    @classmethod
+    def reverse_relationships(cls):
+        """The reverse relations onto this model - a dictionary of related name : the field on the other model
 
-           [0] The related model(s) in this manager
-           [1] The field on this model
-           [2] The field on the related model
+           Every ForeignKey on another model which references this model forms a reverse relation.
         """
-        pass
\ No newline at end of file
+        relations = {}
+        for model in _ModelMetaClass._models.values():
+            for field in model._dependencies:
+                try:
+                    other_model = field.other_model()
+                except ValueError:
+                    continue
+                if other_model is cls:
+                    relations[field.related_name()] = field
+        return relations
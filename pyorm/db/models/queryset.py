@@ -12,12 +12,20 @@ Testable Statements :
     Can I <Boolean statement>
     ....
 """
+import base64
+import datetime
+import decimal
+import json
+import weakref
 from copy import copy
+from operator import itemgetter
 from collections import OrderedDict
 
 import pyorm.core.exceptions as exceptions
-from .utils import Annotation, Related
+from .utils import Annotation, Lazy, hashable
 from .functions import TruncDate
+from .aggregates import Aggregate
+from .session import Session
 
 import pyorm.db.models.fields as field_defs
 
@@ -25,9 +33,63 @@ __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '26 Aug 2017'
 
+LOOKUP_SEP = '__'
 
 # Todo - Must be able to pickle everything
 
+# Keyset cursor values which JSON can't represent - tagged with their type : (type, encoder, decoder)
+_cursor_types = {
+    'datetime': (datetime.datetime, lambda value: list(value.timetuple()[:6]) + [value.microsecond],
+                 lambda value: datetime.datetime(*value)),
+    'date': (datetime.date, lambda value: [value.year, value.month, value.day],
+             lambda value: datetime.date(*value)),
+    'decimal': (decimal.Decimal, str, decimal.Decimal),
+}
+
+
+def _encode_cursor(names, values):
+    """An opaque (url safe) cursor for the keyset values of a row"""
+    def tagged(value):
+        for tag, (data_type, encoder, decoder) in _cursor_types.items():
+            if isinstance(value, data_type):
+                return {tag: encoder(value)}
+        return value
+
+    try:
+        data = json.dumps({'o': list(names), 'v': [tagged(value) for value in values]}, separators=(',', ':'))
+    except TypeError as exc:
+        raise exceptions.CursorError('Unable to build a cursor : {}'.format(exc)) from None
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """The field names and keyset values encoded in a cursor - a 2-tuple of lists"""
+    def untagged(value):
+        if isinstance(value, dict) and len(value) == 1:
+            tag, encoded = next(iter(value.items()))
+            return _cursor_types[tag][2](encoded)
+        return value
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return list(data['o']), [untagged(value) for value in data['v']]
+    except (ValueError, TypeError, KeyError, AttributeError, IndexError, decimal.InvalidOperation):
+        raise exceptions.CursorError('Invalid cursor {!r}'.format(cursor)) from None
+
+def _parse_truncated_datetime(value):
+    """Parse a truncated datetime - truncations to years, months & days have no time part, so are midnight"""
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+# Parsers for the ISO strings returned by the date truncation functions - keyed by the annotation's dataType
+_truncation_parsers = {
+    field_defs.DateField: lambda value: datetime.datetime.strptime(value, '%Y-%m-%d').date(),
+    field_defs.DateTimeField: _parse_truncated_datetime,
+}
+
 
 class F:
     """A Deferred field access - accesses the field at execution time not against the Python Model"""
@@ -41,6 +103,8 @@ class F:
             self._rhs = None
             self._operator = None
             self._negate = False
+        self._structure = None
+        self._hash = None
 
     @classmethod
     def CreateCombine(self, lhs=None, operator=None, rhs=None):
@@ -50,17 +114,35 @@ class F:
         c._operator = operator
         return c
 
+    def structure(self):
+        """The immutable structural representation of this expression - built once and then cached
+
+           Nested F objects are held directly, so their cached hashes are reused
+        """
+        if self._structure is None:
+            self._structure = (self._negate, self._operator,
+                               self._lhs if isinstance(self._lhs, F) else hashable(self._lhs),
+                               self._rhs if isinstance(self._rhs, F) else hashable(self._rhs))
+        return self._structure
+
     def __eq__(self, other):
         if not isinstance(other, F):
             return False
 
-        return self._lhs == other._lhs \
-               and self._rhs == other._rhs \
-               and self._operator == other._operator \
-               and self._negate == other._negate
+        return self is other or (hash(self) == hash(other) and self.structure() == other.structure())
 
     def __hash__(self):
-        return hash((repr(self)))
+        if self._hash is None:
+            self._hash = hash(self.structure())
+        return self._hash
+
+    def __copy__(self):
+        """A copy is made to be changed - so the copy doesn't inherit the cached structure"""
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        clone._structure = None
+        clone._hash = None
+        return clone
 
     def __repr__(self):
         # Repr uses () to designate the prioritisation
@@ -151,28 +233,51 @@ class F:
         return self.CreateCombine(lhs=self, operator='%', rhs=other)
 
     def resolve(self, default_alias = '',engine=None, model=None, joins=None):
-        """Public method to validate an F object"""
+        """Public method to validate an F object
+
+           Returns a 2-tuple of (sql_fragment, params) - constants are bound as parameters
+        """
 
         # If the operator and rhs elements are Non then the lhs will be field name
         # other wise one of the fields will be an F object and the other an F object or constant.
-        if self._operator and self._rhs:
-            try:
-                lhs = self._lhs.resolve(default_alias = default_alias, engine=engine, model=model, joins=joins)
-            except AttributeError:
-                lhs = repr(self._lhs)
-            except:
-                raise
+        if self._operator:
+            lhs, lhs_params = self._resolve_operand(self._lhs, default_alias=default_alias, engine=engine, model=model, joins=joins)
+            rhs, rhs_params = self._resolve_operand(self._rhs, default_alias=default_alias, engine=engine, model=model, joins=joins)
+            sql = '(' + lhs + self._operator + rhs + ')'
+            params = lhs_params + rhs_params
+        else:
+            sql = engine.resolve_name(self._lhs, default_alias=default_alias, model=model, joins=joins)
+            params = []
 
-            try:
-                rhs = self._rhs.resolve(default_alias = default_alias, engine=engine, model=model, joins=joins)
-            except AttributeError:
-                rhs = repr(self._rhs)
-            except:
-                raise
+        return ('-' + sql if self._negate else sql), params
+
+    def fingerprint(self):
+        """The structure of this expression with constants excluded, and the constants in placeholder order
+
+           Returns a 2-tuple (shape, params) - two expressions with equal shapes compile to the same SQL
+        """
+        if self._operator:
+            lhs_shape, lhs_params = self._fingerprint_operand(self._lhs)
+            rhs_shape, rhs_params = self._fingerprint_operand(self._rhs)
+            return (self._negate, self._operator, lhs_shape, rhs_shape), lhs_params + rhs_params
+        else:
+            return (self._negate, self._lhs), []
 
-            return '(' + lhs + self._operator + rhs + ')'
+    @staticmethod
+    def _fingerprint_operand(operand):
+        """Fingerprint one side of a combined expression - either another F object or a constant"""
+        if isinstance(operand, F):
+            return operand.fingerprint()
+        else:
+            return ('?', type(operand)), [operand]
+
+    @staticmethod
+    def _resolve_operand(operand, **kwargs):
+        """Resolve one side of a combined expression - either another F object or a constant"""
+        if isinstance(operand, F):
+            return operand.resolve(**kwargs)
         else:
-            return engine.resolve_name(self._lhs, default_alias=default_alias, model=model, joins=joins)
+            return '?', [operand]
 
 class Q:
     """A class for building complex field comparisons, especially when wants to use OR combinations"""
@@ -195,6 +300,8 @@ class Q:
             self._members = []
             self._operator = None
         self._negated = False
+        self._structure = None
+        self._hash = None
 
     # noinspection PyProtectedMember
     def __and__(self, other):
@@ -230,6 +337,8 @@ class Q:
     def _combine(self, *members, operator='AND'):
         self._members = [*members]
         self._operator = operator
+        self._structure = None
+        self._hash = None
 
     def __invert__(self):
         q = self.__class__()
@@ -251,28 +360,72 @@ class Q:
         else:
             return ''
 
+    def structure(self):
+        """The immutable structural representation of this Q - built once and then cached
+
+           Nested Q objects are held directly, so their cached hashes are reused
+        """
+        if self._structure is None:
+            self._structure = (self._negated, self._operator,
+                               tuple(member if isinstance(member, Q) else (member[0], hashable(member[1]))
+                                     for member in self._members))
+        return self._structure
+
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             raise NotImplementedError
-        return self._members == other._members and self._operator == other._operator and self._negated == other._negated
+        return self is other or (hash(self) == hash(other) and self.structure() == other.structure())
 
     def __hash__(self):
-        return hash(repr(self))
+        if self._hash is None:
+            self._hash = hash(self.structure())
+        return self._hash
 
-    def resolve(self, default_alias = '', engine=None, model=None, joins=None):
+    def __bool__(self):
+        """An empty Q has no criteria"""
+        return bool(self._members)
 
-        fs = []
+    def fingerprint(self):
+        """The structure of this Q with the lookup values excluded, and the values in placeholder order
+
+           Returns a 2-tuple (shape, params) - two Q objects with equal shapes compile to the same SQL.
+           The shape records the type of each value, as comparisons can compile differently for None,
+           and the length of a collection of values, as each value has its own placeholder (e.g. 'in').
+        """
+        shape, params = [], []
         for member in self._members:
-            try:
-                fs.append( member.resolve( default_alias = default_alias, engine=engine, model=model, joins=joins))
-            except AttributeError:
-                fs.append( engine.resolve_lookup(*member,default_alias = default_alias, model=model,joins=joins))
-            except:
-                raise
+            if isinstance(member, Q):
+                member_shape, member_params = member.fingerprint()
+            else:
+                lookup, value = member
+                if isinstance(value, (list, tuple, set, frozenset)):
+                    member_shape, member_params = (lookup, type(value), len(value)), list(value)
+                else:
+                    member_shape, member_params = (lookup, type(value)), [value]
+            shape.append(member_shape)
+            params.extend(member_params)
+        return (self._negated, self._operator, tuple(shape)), params
+
+    def resolve(self, default_alias = '', engine=None, model=None, joins=None, literals=False):
+        """Generate the SQL for this Q object
+
+           Returns a 2-tuple of (sql_fragment, params) - params are the values to be bound in order.
+           With literals the values are written into the SQL instead, and params is empty.
+        """
+        resolve_lookup = engine.resolve_literal_lookup if literals else engine.resolve_lookup
+        fs, params = [], []
+        for member in self._members:
+            if isinstance(member, Q):
+                sql, member_params = member.resolve( default_alias = default_alias, engine=engine, model=model, joins=joins,
+                                                     literals=literals)
+            else:
+                sql, member_params = resolve_lookup(*member,default_alias = default_alias, model=model,joins=joins)
+            fs.append(sql)
+            params.extend(member_params)
 
         return '{negated}({fields})'.format(
                                 negated='NOT ' if self._negated else '',
-                                fields = (' ' +self._operator+' ').join(fs) )
+                                fields = (' ' +self._operator+' ').join(fs) ), params
 
 class BaseQuery:
     """Common class for ALL queries
@@ -287,6 +440,12 @@ class BaseQuery:
         self._orderable = orderable and mutable
         self._limitable = limitable and mutable
 
+    def __copy__(self):
+        """Copy the query - list attributes are copied so the copy can be changed independently"""
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update({k: (list(v) if isinstance(v, list) else v) for k, v in self.__dict__.items()})
+        return clone
+
     @property
     def is_mutable(self):
         """Is this query changable"""
@@ -324,6 +483,7 @@ class OrderingAndLimits(BaseQuery):
                          extendable=extendable)
         self._order_by = order_by if order_by else []
         self._limits = limits if limits else []
+        self._keyset = []
 
     def add_order_by(self, *order_bys):
         """Add a field or ordinal to the Order by list"""
@@ -351,7 +511,7 @@ class OrderingAndLimits(BaseQuery):
         return self._order_by
 
     def set_limits(self, *limits):
-        """Set the limits"""
+        """Set the limits - [limit] or [limit, offset]"""
         if len(limits) >2:
             raise exceptions.LimitsError
         self._limits = [*limits]
@@ -365,6 +525,19 @@ class OrderingAndLimits(BaseQuery):
         """Expose the limit list"""
         return self._limits
 
+    def set_keyset(self, *values):
+        """Set the keyset - the values of the order by fields of the row the results start after"""
+        self._keyset = [*values]
+
+    def clear_keyset(self):
+        """Clear the keyset"""
+        self._keyset = []
+
+    @property
+    def keyset(self):
+        """Expose the keyset list"""
+        return self._keyset
+
 
 class FilterableQuery(OrderingAndLimits):
     """A General class for any query which can be filtered"""
@@ -466,6 +639,7 @@ class Join:
             self._fields = fields
             self._children = OrderedDict()
             self._allow_nulls = allow_nulls
+            self._hash = None
 
         def __repr__(self):
             if self._parent:
@@ -482,11 +656,20 @@ class Join:
                         table = self._model.table_name(),
                         )
 
+        def structure(self):
+            """The structural representation of this node - the relation name, models and linking fields"""
+            return (self._relation, self._parent.model if self._parent else None,
+                    self._model, tuple(self._fields))
+
         def __hash__(self):
-            return hash(repr(self))
+            if self._hash is None:
+                self._hash = hash(self.structure())
+            return self._hash
 
         def __eq__(self, other):
-            return repr(self) == repr(other)
+            if not isinstance(other, Join.Node):
+                return False
+            return self is other or (hash(self) == hash(other) and self.structure() == other.structure())
 
         @property
         def allow_nulls(self):
@@ -511,6 +694,7 @@ class Join:
         def relation(self, value):
             """Allow setting of the relation name"""
             self._relation = value
+            self._hash = None
 
         @property
         def fields(self):
@@ -528,6 +712,12 @@ class Join:
         self._sep = sep
         self._index = {}
 
+    def name_root(self):
+        """Name the root node after the root model's table - returns the alias of the root table"""
+        if not self._root.relation:
+            self._root.relation = self._root.model.table_name()
+        return self._root.relation
+
     def from_tuple(self, joins):
         """Build a simple set of joins based a provided set of tuples
 
@@ -540,9 +730,7 @@ class Join:
         if self._root.children:
             raise exceptions.JoinError('Cannot use from_tuple to add to existing joins')
 
-        if not self._root.relation:
-            self._root.relation = self._root.model.table_name()
-            self._root._relation_path = [self._root.model.table_name()]
+        self.name_root()
 
         for a_join in joins:
             try:
@@ -569,13 +757,14 @@ class Join:
         """Find the deepest existing parent for this  given relation name within the current node tree
 
         :param full_relation_name
-        :return: Either the Node
+        :return: A 2-tuple of the Node and the number of components of the relation name it covers
         """
-        parent_name = self._sep.join(full_relation_name.split(self._sep)[:-1])
-        while parent_name and not self._index.get(parent_name, None):
-            parent_name = self._sep.join(parent_name.split(self._sep)[:-1])
+        elements = full_relation_name.split(self._sep)
+        depth = len(elements) - 1
+        while depth and self._sep.join(elements[:depth]) not in self._index:
+            depth -= 1
 
-        return self._index[parent_name] if parent_name else self._root
+        return (self._index[self._sep.join(elements[:depth])] if depth else self._root), depth
 
     def _find_relation(self, full_relation_name):
         """Find a given relation name within the current node tree
@@ -585,11 +774,12 @@ class Join:
         """
         return self._index.get(full_relation_name,None)
 
-    def _addNode_to_parent(self, element='', parent=None, allow_nulls=False):
+    def _addNode_to_parent(self, element='', parent=None, path='', allow_nulls=False):
         """Add a node to the Parent node
 
         :param element: The relevant component of the relation name
         :param parent: The parent node
+        :param path: The relation name of the new node - relative to the root model
         :return:
 
         Creates an Node instance, adds it to the children of the parent
@@ -597,38 +787,34 @@ class Join:
 
         """
         relation_info = parent.model.get_relationship(element)
+        if not relation_info:
+            raise exceptions.JoinError('Unknown relation \'{}\' on \'{}\' table'.format(
+                element, parent.model.table_name()))
         related_model, field, related_field = relation_info
         node = self.Node(parent=parent, relation_name=parent.relation + self._sep + element,
                          model=related_model,
                          fields=(field, related_field),
                          allow_nulls=allow_nulls)
         parent.children[element] = node
-        self._index[parent.relation + self._sep + element] = node
+        self._index[path] = node
         return node
 
     def _create_path(self, relation_name, allow_nulls=False):
         """Create a path to the relation_name building nodes as we go"""
 
         # Find the deepest parent node for this relation
-        parent = self._find_deepest_parent(relation_name)
+        parent, depth = self._find_deepest_parent(relation_name)
 
-        # Identify what is missing
-        remaining_elements = relation_name.split(self._sep)[len(parent._relation_path) - 1:]
-
-        # Build out what is missing, if anything
-        if remaining_elements:
-            for element in remaining_elements:
-                node = self._addNode_to_parent(element=element, parent=parent, allow_nulls=allow_nulls)
-                parent = node
-            return node
-        else:
-            return parent
+        # Build out what is missing
+        elements = relation_name.split(self._sep)
+        for index in range(depth, len(elements)):
+            parent = self._addNode_to_parent(element=elements[index], parent=parent,
+                                             path=self._sep.join(elements[:index + 1]), allow_nulls=allow_nulls)
+        return parent
 
     def addJoin(self, model_path, allow_nulls=False):
         """Public method to add a join - based on a relation to the initial model"""
-        if not self._root.relation:
-            self._root.relation = self._root.model.table_name()
-            self._root._relation_path = [self._root.model.table_name()]
+        self.name_root()
 
         node = self._find_relation(model_path)
         if not node:
@@ -676,13 +862,18 @@ class Join:
 
 class SimpleQuery(FilterableQuery):
     """A simple SQL query - i.e. not a Compound Query or a pre-built SQL Query"""
-    def __init__(self, options=None, joins=None,fields=None,criteria=None, order_by = None):
+    def __init__(self, options=None, joins=None,fields=None,criteria=None, order_by = None, model=None):
         super().__init__()
+        self._model = model
         self._options = options if options else []
         self._fields = fields if fields else []
         self._joins = joins if joins else []
-        self._criteria = criteria if credits else []
-        self.add_order_by(order_by if order_by else [])
+        self._criteria = criteria if criteria else Q()
+        self.add_order_by(*(order_by if order_by else []))
+
+    @property
+    def model(self):
+        return self._model
 
     @property
     def options(self):
@@ -700,12 +891,16 @@ class SimpleQuery(FilterableQuery):
     def criteria(self):
         return self._criteria
 
+    @criteria.setter
+    def criteria(self, value):
+        self._criteria = value
+
     @classmethod
     def from_model(cls, model=None, order_by=None):
         """Class factory method to build a Query Set based on an existing model"""
         if not model:
             return
-        inst = cls(joins=[Join(TableInfo(table_name=model, field=model.primary_field(), alias=model.table_name()), None)],
+        inst = cls(model=model,
                    fields =  [definition.db_column for name, definition in model.db_fields()],
                    order_by = order_by if order_by else model.order_by())
         return inst
@@ -715,44 +910,102 @@ class SimpleQuery(FilterableQuery):
         self._options += [*options]
 
     def add_joins(self, *joins):
-        """Add tables to the tables list"""
+        """Add relations to the joins list - every column of each related model is selected"""
         self._joins += [*joins]
 
     def clear_joins(self):
-        """Clear the table list"""
+        """Clear the joins list"""
         self._joins = []
 
     def add_fields(self, *new_fields):
         """Add fields to the fields list"""
         self._fields += [*new_fields]
 
+    def add_fields_from_model(self, model):
+        """Add every column of the model to the fields list"""
+        self.add_fields(*[definition.db_column for name, definition in model.db_fields()])
+
     def clear_fields(self):
         """Clear the fields list"""
         self._fields = []
 
 
-# noinspection PyMethodMayBeStatic
 class Cache:
-    """A class which will support Caching for Query results - and prefetching"""
-    def __init__(self, cache_id, model):
-        self._id = id
-        self._id = model
+    """The results of evaluating a Query Set - held so that the query is executed only once"""
+    def __init__(self, results=()):
+        self._results = list(results)
+
+    def __len__(self):
+        return len(self._results)
+
+    def __iter__(self):
+        return iter(self._results)
+
+    def __getitem__(self, item):
+        return self._results[item]
+
+    def __bool__(self):
+        return bool(self._results)
+
+
+class _DeferredLoader:
+    """Load the deferred fields of the instances fetched together - a field is loaded for all of them at once
+
+       The instances are held by weak references, so the loader doesn't keep them alive.
+    """
+    def __init__(self, model, deferred):
+        self._model = model
+        self._deferred = frozenset(deferred)
+        self._instances = []
+
+    def add(self, instances):
+        """Record instances whose deferred fields are loaded by this loader"""
+        for instance in instances:
+            instance.__dict__['__deferred'] = self
+            self._instances.append(weakref.ref(instance))
+
+    def load(self, instance, name):
+        """Load a deferred field for every instance which doesn't have it yet - returns the value for this instance"""
+        if name not in self._deferred:
+            return self._model.db_field_by_name(name)
+
+        pending = [other for other in (ref() for ref in self._instances)
+                   if other is not None and name not in other.__dict__]
+        if not any(other is instance for other in pending):
+            pending.append(instance)
+
+        key_name = self._model.primary_field().name
+        query_set = QuerySet(model=self._model).order_by().values_list(key_name, name)
+        values = dict(QuerySet._fetch_in(query_set, key_name, [other.__dict__[key_name] for other in pending]))
+
+        for other in pending:
+            key = other.__dict__[key_name]
+            if key in values:
+                other.__dict__[name] = values[key]
+
+        if name not in instance.__dict__:
+            raise exceptions.DoesNotExist('Cannot load deferred field \'{}\' : \'{}\' instance {!r} no longer exists'.format(
+                name, self._model.__name__, instance.__dict__[key_name]))
+        return instance.__dict__[name]
 
 
 class QuerySet(object):
     """A Class designed to allow simple building of complex queries"""
-    def __init__(self, model=None, query=None, order_by=None):
+    def __init__(self, model=None, query=None, order_by=None, engine=None):
         """
         A generalised query object for a given object - allows the construction of filters
+
+        :param engine: The engine instance to execute against - by default the model's engine
         """
 
         self._model = model
+        self._engine = engine
         self._query = query if query else (
             SimpleQuery.from_model(model, order_by=order_by) if model else None)
         self._related = []
         self._defered = []
         self._output = 'models'
-        self._cache = self._cache.get_cache_instance(id(self))
+        self._cache = None
 
     @property
     def query(self):
@@ -764,9 +1017,19 @@ class QuerySet(object):
         """Allow external setting of the query attribute"""
         self._query = value
 
+    @property
+    def engine(self):
+        """The engine instance this query set executes against"""
+        return self._engine if self._engine is not None else self._model.engine()
+
     def _clone(self):
-        """Take a copy of this clone"""
-        return copy(self)
+        """Take a copy of this clone - the query is copied so the clone can be changed independently"""
+        clone = copy(self)
+        clone._query = copy(self._query) if self._query else None
+        clone._cache = None
+        clone._related = list(self._related)
+        clone._defered = list(self._defered)
+        return clone
 
     def _criteria_add(self, exclude=False, **kwargs):
         """AND a Q object into the criteria list - with a possible negation"""
@@ -791,23 +1054,52 @@ class QuerySet(object):
         clone._criteria_add(exclude=True, **kwargs)
         return clone
 
+    def _annotations(self, args, kwargs):
+        """Build the Annotations for annotate or aggregate - each has an alias
+
+           The positional form annotate(Count('name'), alias='names') is one Annotation (named 'name__count'
+           without an alias); each keyword with an expression is an Annotation named by the keyword.
+        """
+        options = {name: value for name, value in kwargs.items() if not isinstance(value, Lazy)}
+        annotations = []
+        if args:
+            if 'alias' not in options:
+                if not hasattr(args[0], 'default_alias'):
+                    raise AttributeError('An alias is required for {!r}'.format(args[0]))
+                options['alias'] = args[0].default_alias()
+            annotations.append(Annotation(*args, **options))
+        elif options:
+            raise AttributeError('Unexpected arguments: {}'.format(','.join(sorted(options))))
+
+        annotations += [Annotation(value, alias=name) for name, value in kwargs.items() if isinstance(value, Lazy)]
+
+        for annotation in annotations:
+            if self._model.db_field_by_name(annotation.kwargs['alias']):
+                raise AttributeError('The annotation \'{}\' conflicts with a field on the \'{}\' model'.format(
+                    annotation.kwargs['alias'], self._model.__name__))
+        return annotations
+
     def annotate(self, *args, **kwargs):
-        """Add an extra field (which may well be an aggregate)"""
-        if not self._query.is_extenable:
+        """Add extra fields - e.g. Book.objects.all().values('author__name').annotate(longest=Max('pages'))
+
+           Aggregates are calculated by the database for each group of rows, where the rows are grouped by
+           every other field; so after values('author__name') there is a row for each author. Fields of
+           related models are reached through forward relations (ForeignKeys) only. Annotations are
+           returned as attributes of the instance (or entries in the dict/tuple) named by their alias.
+        """
+        if not self._query.is_extendable:
             raise exceptions.NotModfiable
         clone = self._clone()
-        clone.query.add_fields(Annotation(*args, **kwargs))
+        clone.query.add_fields(*self._annotations(args, kwargs))
         return clone
 
     def order_by(self, *args):
-        """Add fields or orderables to the order by attribute - if none given ordering is cleared"""
+        """Replace the ordering with these fields or orderables - if none given ordering is cleared"""
         if not self._query.is_orderable:
             raise exceptions.NotModfiable
         clone = self._clone()
-        if args:
-            clone.query.add_orderby(tuple([p for p in args]))
-        else:
-            clone.query.clear_orderby()
+        clone.query.clear_order_by()
+        clone.query.add_order_by(*args)
         return clone
 
     def reverse(self):
@@ -815,9 +1107,75 @@ class QuerySet(object):
         if not self._query.is_orderable:
             raise exceptions.NotModfiable
         clone = self._clone()
-        clone.query.invert_order_by()
+        clone.query.invert_ordering()
+        return clone
+
+    def _keyset_ordering(self):
+        """The ordering for keyset pagination - the current ordering with the primary key added as a tie breaker
+
+           Returns a list of field names - with a leading '-' for a descending field.
+        """
+        if not isinstance(self._query, SimpleQuery):
+            raise exceptions.NotModfiable
+
+        ordering = []
+        for item in self._query.order_by:
+            if isinstance(item, F) and not item._operator and isinstance(item._lhs, str):
+                item = ('-' if item._negate else '') + item._lhs
+            if not isinstance(item, str):
+                raise exceptions.QuerySetError('Keyset pagination needs an ordering by field names - not {!r}'.format(item))
+            ordering.append(item)
+
+        primary = self._model.primary_field().name
+        if not any(item.lstrip('-') in (primary, self._model.primary_field().db_column) for item in ordering):
+            ordering.append('-' + primary if ordering and ordering[-1].startswith('-') else primary)
+        return ordering
+
+    def after(self, cursor=None):
+        """Keyset pagination - the rows which come after the row the cursor was taken from, in the query's ordering
+
+           The primary key is added to the ordering so every row has a distinct position. Unlike an OFFSET the
+           position is found using the index on the ordered columns, so deep pages are as quick as the first :
+
+               page = list(qs.order_by('created').after(cursor)[:20])
+               cursor = qs.order_by('created').cursor(page[-1])
+
+           After a reverse() the rows before the cursor are returned, nearest first. A cursor of None is the start.
+        """
+        ordering = self._keyset_ordering()
+        clone = self._clone()
+        clone.query.clear_order_by()
+        clone.query.add_order_by(*ordering)
+        clone.query.clear_keyset()
+        if cursor is None:
+            return clone
+
+        names, values = _decode_cursor(cursor)
+        if names != [item.lstrip('-') for item in ordering] or len(values) != len(names):
+            raise exceptions.CursorError('The cursor was not taken from a query ordered by {}'.format(
+                    ', '.join(item.lstrip('-') for item in ordering)))
+        clone.query.set_keyset(*values)
         return clone
 
+    def cursor(self, obj):
+        """An opaque cursor for this instance (or row dictionary), to be passed to after() to get the next page"""
+        names = [item.lstrip('-') for item in self._keyset_ordering()]
+        values = []
+        for name in names:
+            if isinstance(obj, dict):
+                if name not in obj:
+                    raise exceptions.CursorError('The row has no value for \'{}\''.format(name))
+                values.append(obj[name])
+                continue
+
+            owner, parts = obj, name.split(LOOKUP_SEP)
+            for part in parts[:-1]:
+                owner = getattr(owner, part)
+            field = type(owner).db_field_by_name(parts[-1])
+            value = getattr(owner, parts[-1])
+            values.append(field.db_value(value) if field is not None else value)
+        return _encode_cursor(names, values)
+
     def distinct(self):
         """Make this query DISTINCT"""
         if not self._query.is_mutable:
@@ -832,6 +1190,8 @@ class QuerySet(object):
             raise exceptions.NotModfiable
         clone = self._clone()
         clone._output = 'dict'
+        clone.query.clear_fields()
+        clone.query.clear_joins()
         if names:
             clone.query.add_fields(*names)
         else:
@@ -850,14 +1210,30 @@ class QuerySet(object):
             raise AttributeError('Cannot flatten a multi field query')
 
         clone = self._clone()
-        clone._output = 'list' if flat else 'flat-list'
+        clone._output = 'flat' if flat else 'list'
+        clone.query.clear_fields()
+        clone.query.clear_joins()
         if names:
             clone.query.add_fields(*names)
         else:
             clone.query.add_fields_from_model(clone._model)
         return clone
 
-    # Todo - Dates and Datetime Truncation might return a string - need to ensure Date/DateTimeFields accept ISO standard fields
+    def _truncate(self, field, kind, data_type, order, **kwargs):
+        """Replace the fields with a DISTINCT truncation of a date/datetime field - returned as a flat list"""
+        alias = field + '_' + kind
+        clone = self._clone()
+        clone._output = 'flat'
+        clone.query.clear_fields()
+        clone.query.clear_joins()
+        clone.query.add_fields(Annotation(TruncDate(field, kind), alias=alias, dataType=data_type, order=order,
+                                          **kwargs))
+        if 'DISTINCT' not in clone.query.options:
+            clone.query.add_options('DISTINCT')
+        clone.query.clear_order_by()
+        clone.query.add_order_by(alias if order.upper() == 'ASC' else '-' + alias)
+        return clone
+
     def dates(self, field, kind, order='ASC'):
         """Produce a UNIQUE list of date files which are truncated to the appropriate kind
 
@@ -868,12 +1244,7 @@ class QuerySet(object):
 
         if kind.lower() not in ['years', 'months', 'days']:
             raise AttributeError('Invalid truncation option {}'.format(kind))
-        clone = self._clone()
-        clone.query.clear_fields()
-        clone.query.add_fields(
-            Annotation(TruncDate(field, kind), alias=field + '_' + kind,
-                       dataType=field_defs.DateField(), order=order))
-        return clone
+        return self._truncate(field, kind, field_defs.DateField, order)
 
     def datetimes(self, field, kind, order='ASC', tzinfo=None):
         """Produce a UNIQUE list of date files which are truncated to the appropriate kind
@@ -886,12 +1257,7 @@ class QuerySet(object):
         if kind.lower() not in ['years', 'months', 'days', 'hours', 'minutes',
                                 'seconds']:
             raise AttributeError('Invalid truncation option {}'.format(kind))
-        clone = self._clone()
-        clone.query.clear_fields()
-        clone.query.add_fields(
-            Annotation(TruncDate(field, kind), alias=field + '_' + kind,
-                       dataType=field_defs.DateTimeField(), order=order, tz=tzinfo))
-        return clone
+        return self._truncate(field, kind, field_defs.DateTimeField, order, tz=tzinfo)
 
     def none(self):
         """Return a new Query Set which is empty - not even a model"""
@@ -922,41 +1288,85 @@ class QuerySet(object):
         return clone
 
     def select_related(self, *fields):
-        """Select some more fields in this query"""
-        clone = self._clone()
+        """Fetch the related instances of these ForeignKey relations in the same query - by joining their tables
 
-        if not fields or fields[0] is None:
-            clone._related = []
-        else:
-            clone._related += [Annotation(Related(*fields))]
+           Relations are named as in a filter (e.g. 'author__publisher'); every relation along the path is
+           selected. With no names every ForeignKey on the model is selected, and select_related(None) clears
+           the relations. Each instance is returned with its related instances set on it.
+        """
+        if not self._query.is_extendable:
+            raise exceptions.NotModfiable
 
+        clone = self._clone()
+        if fields and fields[0] is None:
+            clone.query.clear_joins()
+            return clone
+
+        if not fields:
+            fields = [name for name, field in self._model.db_fields() if self._model.get_relationship(name)]
+
+        for relation in fields:
+            elements = relation.split(LOOKUP_SEP)
+            for depth in range(1, len(elements) + 1):
+                path = LOOKUP_SEP.join(elements[:depth])
+                if path not in clone.query.joins:
+                    self._relation_model(path)
+                    clone.query.add_joins(path)
         return clone
-        # Todo - Need to add hooks into managers/model fields for the new models to point back to the caches
 
     def prefetch_related(self, *lookups):
-        """Prefetch some data to reduce DB hits"""
+        """Fetch the instances of these relations in a query per relation - rather than a query per instance
+
+           Lookups are relation paths (e.g. 'book_set__author') through ForeignKeys and reverse relations.
+           Once the instances are fetched each relation is fetched in batched 'IN' queries, and the related
+           instances are set on each instance - a list for a reverse relation.
+           prefetch_related(None) clears the lookups.
+        """
         clone = self._clone()
+        if lookups and lookups[0] is None:
+            clone._related = []
+            return clone
+
+        for lookup in lookups:
+            model = self._model
+            for element in lookup.split(LOOKUP_SEP):
+                model = self._prefetch_relation(model, element)[0]
+            if lookup not in clone._related:
+                clone._related.append(lookup)
         return clone
-        # Todo Prefetching of related items - need a design
-        # Todo - Need to add hooks into managers/model fields for the new models to point back to the caches
 
     def defer(self, *fields):
-        """Defer the fetching of specific fields"""
-        clone = self._clone()
-        clone._defered += [*fields]
-        return clone
-        # Todo Defer fetching of items
+        """Defer the fetching of these fields - each is loaded from the database when first accessed
+
+           A deferred field is loaded for all of the instances fetched with the instance at once.
+           The primary key is never deferred; defer(None) clears the deferred fields.
+        """
+        if not self._query.is_extendable:
+            raise exceptions.NotModfiable
+
+        if fields and fields[0] is None:
+            return self._deferring(())
+
+        self._model._check_field_names(fields)
+        return self._deferring(self._defered + [name for name in fields if name not in self._defered])
 
     def only(self, *fields):
-        """Limit the fetching to some fields"""
+        """Limit the fetching to these fields - every other field is deferred (except the primary key)"""
         if not self._query.is_extendable:
             raise exceptions.NotModfiable
+
+        self._model._check_field_names(fields)
+        return self._deferring([name for name, field in self._model.db_fields() if name not in fields])
+
+    def _deferring(self, deferred):
+        """A clone which selects every field of the model except for the deferred fields"""
         clone = self._clone()
+        primary = self._model.primary_field()
+        clone._defered = [name for name in deferred if self._model.db_field_by_name(name) is not primary]
         clone.query.clear_fields()
-        clone.query.add_fields(*fields)
-        clone.query.clear_order_by()
+        clone.query.add_fields(*[field.db_column for name, field in self._model.db_fields()
+                                 if name not in clone._defered])
         return clone
-        # Todo Only fetch some fields fetching of items
 
     def select_for_update(self):
         """Fetch a set of data which will be locked for updates"""
@@ -974,21 +1384,397 @@ class QuerySet(object):
     #
 
 
-    # noinspection PyMethodMayBeStatic
-    def _transform(self, obj):
-        """Chnage the output to the relevant output format - model, dict, list, list-flat"""
-        return obj
+    def _field_names(self):
+        """The names of the fields in each row - the attribute name for a column on the model"""
+        for field in self._query.fields:
+            if isinstance(field, str):
+                yield self._model.db_column_to_attr_name(field) or field
+            else:
+                yield field.kwargs.get('alias', repr(field)) if isinstance(field, Annotation) else repr(field)
+
+    def _parsers(self):
+        """A parser for each field of the row - None for the fields which need no parsing"""
+        parsers = []
+        for field in self._query.fields:
+            parser = None
+            if isinstance(field, Annotation) and isinstance(field.args[0], TruncDate):
+                parser = _truncation_parsers.get(field.kwargs.get('dataType', None), None)
+                tz = field.kwargs.get('tz', None)
+                if parser and tz:
+                    parser = lambda value, parse=parser, tz=tz: parse(value).replace(tzinfo=tz)
+            parsers.append(parser)
+        return parsers if any(parsers) else None
+
+    def _row_transform(self):
+        """A function to convert a database row to the output format - model instance, dict, tuple or single value"""
+        transform = self._output_transform()
+        parsers = self._parsers()
+        if not parsers:
+            return transform
+
+        return lambda row: transform([parse(value) if parse and value is not None else value
+                                      for parse, value in zip(parsers, row)])
+
+    def _relation_model(self, relation):
+        """The model at the end of a relation path from this query set's model"""
+        model = self._model
+        for element in relation.split(LOOKUP_SEP):
+            relation_info = model.get_relationship(element)
+            if not relation_info:
+                raise exceptions.JoinError('Unknown relation \'{}\' on \'{}\' model'.format(element, model.__name__))
+            model = relation_info[0]
+        return model
+
+    def _related_decoder(self, decoder):
+        """Wrap a row decoder so that the related instances selected in the same row are set on each instance
+
+           The columns of each related model follow the query's own fields, in the order of the joins list;
+           a related instance is None if the join found no row (i.e. its primary key is NULL).
+        """
+        width = len(self._query.fields)
+        plan = []
+        start = width
+        for relation in self._query.joins:
+            parent, _, name = relation.rpartition(LOOKUP_SEP)
+            model = self._relation_model(relation)
+            fields = [field for field_name, field in model.db_fields()]
+            plan.append((relation, parent, name, model.row_decoder(), slice(start, start + len(fields)),
+                         start + fields.index(model.primary_field())))
+            start += len(fields)
+
+        def decode(row):
+            instances = {'': decoder(row[:width])}
+            for relation, parent, name, related_decoder, columns, key in plan:
+                related = related_decoder(row[columns]) if row[key] is not None else None
+                instances[relation] = related
+                owner = instances[parent]
+                if owner is not None:
+                    owner.__dict__[name] = related
+            return instances['']
+        return decode
+
+    @staticmethod
+    def _prefetch_relation(model, name):
+        """Identify a relation to prefetch - returns a 3-tuple of (related model, field, is reverse)
+
+           For a ForeignKey the field is on the model, for a reverse relation it is on the related model.
+        """
+        if model.get_relationship(name):
+            field = model.db_field_by_name(name)
+            return field.other_model(), field, False
+
+        field = model.reverse_relationships().get(name, None)
+        if field is None:
+            raise exceptions.JoinError('Unknown relation \'{}\' on \'{}\' model'.format(name, model.__name__))
+        return field.model, field, True
+
+    @staticmethod
+    def _fetch_in(query_set, field_name, keys):
+        """Fetch the results of the query set where the field is one of the keys - in as few queries as possible
+
+           The keys are batched so that no query has more bound parameters than the engine allows.
+        """
+        keys = list(OrderedDict.fromkeys(key for key in keys if key is not None))
+        if not keys:
+            return []
+
+        engine = query_set.engine
+        connection = engine.connect()
+        try:
+            batch_size = engine.max_variables(connection)
+        finally:
+            connection.close()
+
+        fetched = []
+        for start in range(0, len(keys), batch_size):
+            batch = query_set.filter(**{field_name + LOOKUP_SEP + 'in': keys[start:start + batch_size]})
+            fetched.extend(batch.iterator(chunk_size=batch_size))
+        return fetched
+
+    def _prefetch_one(self, model, instances, name):
+        """Fetch one relation for these instances and set the related instances on them
+
+           Returns the related model and the related instances fetched
+        """
+        related_model, field, reverse = self._prefetch_relation(model, name)
+        key_name = field.related_field().name
+
+        if not reverse:
+            keys = [field.db_value(getattr(instance, name)) for instance in instances]
+            fetched = self._fetch_in(QuerySet(model=related_model), key_name, keys)
+            related = {getattr(obj, key_name): obj for obj in fetched}
+            for instance, key in zip(instances, keys):
+                instance.__dict__[name] = related.get(key, None)
+            return related_model, list(related.values())
+
+        # A reverse relation - each instance gets a list, and each related instance points back to its instance
+        parents = OrderedDict()
+        for instance in instances:
+            parents.setdefault(getattr(instance, key_name), []).append(instance)
+        children = {key: [] for key in parents}
+
+        fetched = self._fetch_in(QuerySet(model=related_model), field.name, parents)
+        for obj in fetched:
+            key = field.db_value(obj.__dict__[field.name])
+            children[key].append(obj)
+            obj.__dict__[field.name] = parents[key][0]
+
+        for key, owners in parents.items():
+            for instance in owners:
+                instance.__dict__[name] = list(children[key])
+        return related_model, fetched
+
+    def _fetched_together(self, instances):
+        """Set up the instances fetched in one go - deferred field loading, and prefetching of relations"""
+        if self._defered:
+            _DeferredLoader(self._model, self._defered).add(instances)
+        if self._related:
+            self._prefetch(instances)
+
+    def _prefetch(self, instances):
+        """Fetch the prefetch_related lookups for these instances - one batched query per relation"""
+        done = {}
+        for lookup in self._related:
+            model, objs = self._model, instances
+            elements = lookup.split(LOOKUP_SEP)
+            for depth, element in enumerate(elements, start=1):
+                path = LOOKUP_SEP.join(elements[:depth])
+                if path not in done:
+                    done[path] = self._prefetch_one(model, objs, element)
+                model, objs = done[path]
+
+    def _output_transform(self):
+        if self._output == 'models':
+            decoder = self._model.row_decoder(self._query.fields)
+            return self._related_decoder(decoder) if self._query.joins else decoder
+        elif self._output == 'dict':
+            names = tuple(self._field_names())
+            return lambda row: dict(zip(names, row))
+        elif self._output == 'flat':
+            return itemgetter(0)
+        else:
+            return tuple
+
+    def iterator(self, chunk_size=100):
+        """Generator - stream the results from the database in chunks of chunk_size rows
+
+           Each chunk is converted to the output format as it is fetched, and nothing is cached;
+           memory use is constant regardless of the number of rows. Any prefetch_related lookups are
+           fetched for each chunk, and deferred fields are loaded for a chunk at a time.
+        """
+        engine = self.engine
+        sql, params = engine.compile(self._query)
+        transform = self._row_transform()
+        together = (self._related or self._defered) and self._output == 'models'
+        for rows in engine.fetch(sql, params, chunk_size=chunk_size, queryset=self):
+            if together:
+                instances = list(map(transform, rows))
+                self._fetched_together(instances)
+                yield from instances
+            else:
+                yield from map(transform, rows)
+
+    def _fetch_all(self):
+        """Execute the query - unless it has been already - and cache the results"""
+        if self._cache is not None:
+            return self._cache
+
+        if self._query is None:
+            self._cache = Cache()
+            return self._cache
+
+        engine = self.engine
+        sql, params = engine.compile(self._query)
+        results = list(map(self._row_transform(), engine.execute(sql, params, queryset=self).rows))
+        if (self._related or self._defered) and self._output == 'models':
+            self._fetched_together(results)
+        self._cache = Cache(results)
+        return self._cache
+
+    def __iter__(self):
+        """Iterate through the results - the query is executed on the first iteration and the results cached"""
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def __bool__(self):
+        return bool(self._fetch_all())
+
+    def __getitem__(self, item):
+        """Index or slice the results
+
+           Before the query is executed an index or slice limits the query (LIMIT/OFFSET) - a slice returns a
+           new Query Set, an index executes the limited query. Once executed the cached results are used.
+        """
+        if not isinstance(item, (int, slice)):
+            raise TypeError('Query Set indices must be integers or slices, not {}'.format(type(item).__name__))
+
+        if isinstance(item, slice):
+            start, stop, step = item.start, item.stop, item.step
+        else:
+            start, stop, step = item, item + 1, None
+
+        if (start is not None and start < 0) or (stop is not None and stop < 0):
+            raise ValueError('Negative indexing is not supported')
+
+        if self._cache is not None or not (self._query and self._query.is_limitable):
+            return self._fetch_all()[item]
+
+        clone = self._limited(start or 0, stop)
+        if isinstance(item, int):
+            return clone._fetch_all()[0]
+        return list(clone)[::step] if step not in (None, 1) else clone
+
+    def _limited(self, start, stop):
+        """A clone limited to the rows from start to stop (None for no end) - within any existing limits"""
+        limits = self._query.limits
+        limit, offset = (limits + [0])[:2] if limits else (None, 0)
+        if limit is not None and limit >= 0:
+            start = min(start, limit)
+            stop = limit if stop is None else min(stop, limit)
+
+        clone = self._clone()
+        limit = -1 if stop is None else max(stop - start, 0)
+        if offset + start:
+            clone.query.set_limits(limit, offset + start)
+        elif limit >= 0:
+            clone.query.set_limits(limit)
+        else:
+            clone.query.clear_limits()
+        return clone
+
+    def aggregate(self, *args, **kwargs):
+        """Calculate aggregates over all of the rows of this query set - returns a dict of alias : value
+
+           e.g. aggregate(Sum('age'), oldest=Max('age')) returns {'age__sum': ..., 'oldest': ...}
+        """
+        if not isinstance(self._query, SimpleQuery):
+            raise exceptions.NotModfiable
+        if self._query.limits or self._query.options:
+            raise exceptions.QuerySetError('Cannot aggregate a query set which is sliced or DISTINCT')
+
+        annotations = self._annotations(args, kwargs)
+        if not annotations or not all(isinstance(annotation.args[0], Aggregate) for annotation in annotations):
+            raise TypeError('aggregate expects one or more aggregates')
+
+        clone = self._clone()
+        clone._output = 'dict'
+        clone._related, clone._defered = [], []
+        clone.query.clear_fields()
+        clone.query.clear_joins()
+        clone.query.clear_order_by()
+        clone.query.add_fields(*annotations)
+        return clone._fetch_all()[0]
+
+    def count(self):
+        """The number of rows this query set returns - the cached results are counted if it has been evaluated
+
+           Otherwise the database counts the rows (SELECT COUNT(*)) - without fetching them.
+        """
+        if self._cache is not None or not isinstance(self._query, SimpleQuery):
+            return len(self._fetch_all())
+
+        engine = self.engine
+        sql, params = engine.compile(self._query, form='count')
+        return engine.execute(sql, params, queryset=self).rows[0][0]
+
+    def exists(self):
+        """True if this query set returns any rows - the cached results are used if it has been evaluated
+
+           Otherwise the database is probed for a single row (SELECT 1 ... LIMIT 1).
+        """
+        if self._cache is not None or not isinstance(self._query, SimpleQuery):
+            return bool(self._fetch_all())
+
+        engine = self.engine
+        sql, params = engine.compile(self._query, form='exists')
+        return bool(engine.execute(sql, params, queryset=self).rows)
+
+    def explain(self):
+        """The plan the database will use to execute this query set - one step per line, indented beneath its parent"""
+        if not isinstance(self._query, SimpleQuery):
+            raise exceptions.NotModfiable
+
+        engine = self.engine
+        sql, params = engine.compile(self._query)
+        return '\n'.join('  ' * depth + step for depth, step in engine.explain(sql, params))
+
+    def update(self, **values):
+        """Update every row this query set matches in a single UPDATE statement - returns the number of rows changed
+
+           Values can be F expressions of the row's own fields - e.g. update(stock=F('stock') - 1).
+           Other values are validated as if set on an instance. Instances already fetched are not changed.
+        """
+        if not isinstance(self._query, SimpleQuery):
+            raise exceptions.NotModfiable
+
+        self._model._check_field_names(values)
+        for name, value in values.items():
+            field = self._model.db_field_by_name(name)
+            if not field.is_mutable():
+                raise AttributeError('Cannot change value of immutable field {}'.format(name))
+            if not isinstance(value, F):
+                field.verify_value(value)
+
+        self._evict()
+        engine = self.engine
+        sql, params = engine.compile_update(self._query, values)
+        self._cache = None
+        return engine.execute(sql, params, queryset=self).rowcount
+
+    def _evict(self):
+        """Evict the instances of the rows this query set matches from the active session - before they change"""
+        session = Session.current()
+        if session is not None and session.holds(self._model):
+            key_name = self._model.primary_field().name
+            session.evict(self._model, list(self.values_list(key_name, flat=True).iterator()))
+
+    def _identity(self, kwargs):
+        """The instance in the active session's identity map which kwargs look up by primary key - or None"""
+        session = Session.current()
+        if session is None or len(kwargs) != 1 or self._output != 'models':
+            return None
+        query = self._query
+        if not isinstance(query, SimpleQuery) or query.criteria._members or query.joins or query.limits or \
+                self._defered or not all(isinstance(field, str) for field in query.fields):
+            return None
+        (lookup, value), = kwargs.items()
+        primary = self._model.primary_field().name
+        if lookup not in (primary, primary + LOOKUP_SEP + 'exact'):
+            return None
+        return session.get(self._model, value)
+
+    def delete(self):
+        """Delete every row this query set matches in a single DELETE statement - returns the number of rows deleted"""
+        if not isinstance(self._query, SimpleQuery):
+            raise exceptions.NotModfiable
+
+        self._evict()
+        engine = self.engine
+        sql, params = engine.compile_delete(self._query)
+        self._cache = None
+        return engine.execute(sql, params, queryset=self).rowcount
 
     def get(self, **kwargs):
-        """Try to get a single model from this query set"""
-        qs = self.filter(**kwargs)
-        cache_inst = self._cache.get_cache_instance(id(self), model=self._model)
-        qs.query.execute(cache_inst)
+        """Get the single instance matching these filters - DoesNotExist or MultipleObjects if there isn't one
+
+           Within a Session, getting a model instance by only its primary key returns the instance in the
+           session's identity map without a query - if it is there.
+        """
+        instance = self._identity(kwargs)
+        if instance is not None:
+            return instance
+
+        qs = self.filter(**kwargs) if kwargs else self._clone()
+        if qs.query.is_limitable and not qs.query.limits:
+            qs.query.set_limits(2)
 
-        if len(cache_inst) == 0:
-            raise exceptions.DoesNotExist
+        results = qs._fetch_all()
+        if len(results) == 0:
+            raise exceptions.DoesNotExist('No \'{}\' matches the query'.format(self._model.__name__))
 
-        if len(cache_inst) > 1:
-            raise exceptions.MultipleObjects
+        if len(results) > 1:
+            raise exceptions.MultipleObjects('More than one \'{}\' matches the query'.format(self._model.__name__))
 
-        return self._transform(cache_inst[0])
+        return results[0]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+# pyORM : Implementation of session.py
+
+Summary :
+    An identity map of the instances loaded within a session - a unit of work
+Use Case :
+    As a Developer I want each row loaded once per session to be a single instance
+    So that overlapping queries don't hydrate the same rows again
+
+Testable Statements :
+    Can I load the same primary key through different query sets and get the same instance
+    Can I get an instance by its primary key without a query once it is in the session
+    Can I save every changed instance in the session when it ends
+    Can I update or delete rows in the session without the map holding stale instances
+    ....
+"""
+
+import threading
+from collections import OrderedDict
+
+__version__ = "0.1"
+__author__ = 'Tony Flury : anthony.flury@btinternet.com'
+__created__ = '18 Oct 2026'
+
+
+class Session:
+    """A unit of work - while it is active every instance loaded in this thread is held in its identity map
+
+       The map is keyed by (model, primary key) : a row which is loaded again - by get() or any other query -
+       is the instance already in the map, and isn't decoded again. Values already on an instance are kept -
+       changes made to it in the session are never overwritten by a later query. The instances of the rows
+       changed by QuerySet.update() or removed by QuerySet.delete() are evicted from the map - they are stale.
+
+       Sessions are entered as a context manager, and can be nested - the innermost session is active.
+       When the session ends without an exception the changed instances in it are saved.
+
+       Example :
+
+            with Session() as session:
+                author = Author.objects.get(id=1)
+                for book in Book.objects.filter(title__startswith='A').select_related('author'):
+                    assert book.author is author
+                author.name = 'Anne'
+            # The change to author is saved here
+    """
+    _local = threading.local()
+
+    def __init__(self, flush=True):
+        self._flush = flush
+        self._identities = {}
+        self._decoders = {}
+
+    @classmethod
+    def current(cls):
+        """The innermost active session in this thread - or None"""
+        sessions = getattr(cls._local, 'sessions', None)
+        return sessions[-1] if sessions else None
+
+    def __enter__(self):
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None:
+            sessions = self._local.sessions = []
+        sessions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._local.sessions.remove(self)
+        if exc_type is None and self._flush:
+            self.flush()
+        return False
+
+    def __len__(self):
+        return len(self._identities)
+
+    def __contains__(self, instance):
+        return self._identities.get(self._key(instance), None) is instance
+
+    @staticmethod
+    def _key(instance):
+        model = instance.__class__
+        return model, instance.__dict__.get(model.primary_field().name, None)
+
+    def get(self, model, pk):
+        """The instance of the model with this primary key - or None if it isn't in the session"""
+        return self._identities.get((model, pk), None)
+
+    def add(self, instance):
+        """Add an instance to the identity map - returns the instance already held for its key, if there is one"""
+        return self._identities.setdefault(self._key(instance), instance)
+
+    def remove(self, instance):
+        """Remove an instance from the identity map"""
+        if instance in self:
+            del self._identities[self._key(instance)]
+
+    def holds(self, model):
+        """True if the identity map has any instance of the model"""
+        return any(key[0] is model for key in self._identities)
+
+    def evict(self, model, pks):
+        """Remove the instances of the model with these primary keys from the identity map"""
+        for pk in pks:
+            self._identities.pop((model, pk), None)
+
+    def clear(self):
+        """Remove every instance from the identity map"""
+        self._identities.clear()
+
+    def decoder(self, model, decoder):
+        """Wrap a row decoder so that a row whose primary key is in the identity map isn't decoded again
+
+           The first time a key is decoded the instance is added to the map. Attributes in the row which the
+           instance already held doesn't have (e.g. deferred fields) are set on it.
+        """
+        wrapped = self._decoders.get(decoder, None)
+        if wrapped is not None:
+            return wrapped
+
+        attr_names = decoder.attr_names
+        primary = model.primary_field().name
+        if primary not in attr_names:
+            return decoder
+        index = attr_names.index(primary)
+        identities = self._identities
+
+        def decode(row):
+            key = (model, row[index])
+            instance = identities.get(key, None)
+            if instance is None:
+                instance = identities[key] = decoder(row)
+                return instance
+            attrs = instance.__dict__
+            for name, value in zip(attr_names, row):
+                if name not in attrs:
+                    attrs[name] = value
+            return instance
+
+        decode.attr_names = attr_names
+        return self._decoders.setdefault(decoder, decode)
+
+    def flush(self):
+        """Save every instance in the session which has changed - the instances of each engine in one transaction"""
+        by_engine = OrderedDict()
+        for instance in list(self._identities.values()):
+            if instance.is_dirty():
+                by_engine.setdefault(instance.engine(), []).append(instance)
+
+        for engine, instances in by_engine.items():
+            with engine.atomic():
+                for instance in instances:
+                    instance.save()
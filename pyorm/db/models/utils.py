@@ -18,11 +18,40 @@ __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '29 Aug 2017'
 
 
+def hashable(value):
+    """Convert a value into a hashable equivalent - containers are converted recursively to tuples"""
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(hashable(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return type(value), frozenset(hashable(item) for item in value)
+    if isinstance(value, dict):
+        return dict, frozenset((key, hashable(item)) for key, item in value.items())
+    return value
+
+
 class Lazy:
     def __init__(self, *args, **kwargs):
         """A base class designed to simply record it's args and kwargs - for later processing"""
         self._args  = args
         self._kwargs = kwargs
+        self._structure = None
+        self._hash = None
+
+    @property
+    def args(self):
+        return self._args
+
+    @property
+    def kwargs(self):
+        return self._kwargs
+
+    def structure(self):
+        """The immutable structural representation of this Lazy - built once and then cached"""
+        if self._structure is None:
+            self._structure = (self.__class__,
+                               tuple(hashable(arg) for arg in self._args),
+                               tuple((key, hashable(self._kwargs[key])) for key in sorted(self._kwargs)))
+        return self._structure
 
     def __str__(self):
         """The Str representation always mirrors back the all - with the kwargs sorted alphabetically
@@ -33,17 +62,19 @@ class Lazy:
         return '{}({})'.format(self.__class__.__name__, ','.join(params))
 
     def __eq__(self, other):
-        """Lazies are equal if their strings are equal:
-
-        Use strings so don't have to worry deep comparisons of all items"""
-        return str(self) == str(other)
+        """Lazies are equal if their structures are equal - anything else is equal if the strings are equal"""
+        if not isinstance(other, Lazy):
+            return str(self) == str(other)
+        return self is other or (hash(self) == hash(other) and self.structure() == other.structure())
 
     def __repr__(self):
         """repr and str are the same"""
         return str(self)
 
     def __hash__(self):
-        return hash(str(self))
+        if self._hash is None:
+            self._hash = hash(self.structure())
+        return self._hash
 
 
 class Annotation(Lazy):
@@ -26,8 +26,8 @@ class DummyEngine(EngineCore):
     """Concrete Engine implementation, with mocked connections"""
     _step = 0
 
-    def __init__(self, db_path, shared=True, unique_per_thread=True):
-        super().__init__(db_path, shared=shared, unique_per_thread=unique_per_thread)
+    def __init__(self, db_path, shared=True, unique_per_thread=True, pool=None, options=None):
+        super().__init__(db_path, shared=shared, unique_per_thread=unique_per_thread, pool=pool, options=options)
 
     def get_connection(self):
         DummyEngine._step += 1
@@ -22,7 +22,12 @@ __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '31 Aug 2017'
 
-import pyorm.db.engine.utils as utils
+from pyorm.db.engine.compiler import Compiler
+from pyorm.db.engine.sqlite import Engine
+from pyorm.db.models.models import Model
+from pyorm.db.models.fields import CharField, IntegerField
+from pyorm.db.models.queryset import SimpleQuery, Q
+import pyorm.core.exceptions as exceptions
 
 
 class TestLookupCompile(unittest.TestCase):
@@ -33,10 +38,123 @@ class TestLookupCompile(unittest.TestCase):
         pass
 
     def test_000_000_exact(self):
-        c = utils.Compiler(engine=None, obj=None)
-        print(c.lookup('model__field__exact',13))
+        """Lookups compile to a bound parameter rather than an inlined value"""
+        c = Compiler(engine=Engine, obj=None)
+        self.assertEqual(c.lookup('model__field__exact',13), (['model'], ('model.field = ?', [13])))
+
+        self.assertEqual(c.lookup('parent__model__field__exact',13),
+                         (['parent', 'parent.model'], ('parent.model.field = ?', [13])))
+
+    def test_000_001_same_shape_same_sql(self):
+        """Different values produce identical sql fragments"""
+        c = Compiler(engine=Engine, obj=None)
+        tables1, (sql1, params1) = c.lookup('model__field__contains', 'abc')
+        tables2, (sql2, params2) = c.lookup('model__field__contains', 'xyz')
+        self.assertEqual(sql1, sql2)
+        self.assertEqual((params1, params2), (['abc'], ['xyz']))
+
+    def test_000_002_unknown_lookup(self):
+        """Unknown comparisons are rejected"""
+        c = Compiler(engine=Engine, obj=None)
+        with self.assertRaises(exceptions.UnknownLookup):
+            c.lookup('model__field__nearly', 13)
+
+
+class TestSelectCompile(unittest.TestCase):
+    def setUp(self):
+        class Person(Model):
+            name = CharField()
+            age = IntegerField()
+        self.Person = Person
+        self.engine = Engine(':memory:')
+        Compiler.clear_cache()
+
+    def tearDown(self):
+        Compiler.clear_cache()
+
+    def query(self, **criteria):
+        q = SimpleQuery.from_model(model=self.Person)
+        q.criteria = Q(**criteria)
+        return q
+
+    def test_001_000_simple_select(self):
+        """A query on a model selects every column from the model's table"""
+        sql, params = Compiler(self.engine, SimpleQuery.from_model(model=self.Person)).as_sql()
+        self.assertEqual(sql, 'SELECT Person."name", Person."age", Person."id" FROM Person Person')
+        self.assertEqual(params, [])
+
+    def test_001_001_criteria_order_limits(self):
+        """Criteria, ordering and limits are all compiled with bound values"""
+        q = self.query(name='Tony')
+        q.add_order_by('-age')
+        q.set_limits(10, 5)
+        sql, params = Compiler(self.engine, q).as_sql()
+        self.assertEqual(sql, 'SELECT Person."name", Person."age", Person."id" FROM Person Person'
+                              ' WHERE (Person."name" = ?) ORDER BY Person."age" DESC LIMIT ? OFFSET ?')
+        self.assertEqual(params, ['Tony', 10, 5])
+
+    def test_001_002_cache_hit_same_shape(self):
+        """Queries which differ only by value reuse the cached SQL"""
+        sql1, params1 = Compiler(self.engine, self.query(name='Tony', age__gt=3)).as_sql()
+        sql2, params2 = Compiler(self.engine, self.query(name='Bob', age__gt=5)).as_sql()
+        self.assertEqual(sql1, sql2)
+        self.assertEqual(params1, [3, 'Tony'])
+        self.assertEqual(params2, [5, 'Bob'])
+        self.assertEqual(Compiler.cache_stats()[:3], (1, 1, 1))
+
+    def test_001_003_cache_miss_different_shape(self):
+        """A different structure is compiled separately - an IS NULL comparison is never cached"""
+        Compiler(self.engine, self.query(name='Tony')).as_sql()
+        Compiler(self.engine, self.query(age='Tony')).as_sql()
+        sql, params = Compiler(self.engine, self.query(name=None)).as_sql()
+        self.assertIn('IS NULL', sql)
+        self.assertEqual(params, [])
+        self.assertEqual(Compiler.cache_stats()[:3], (0, 3, 2))
+
+    def test_001_004_cache_lru_eviction(self):
+        """The cache discards the least recently used entry when full"""
+        Compiler.sql_cache.maxsize = 2
+        try:
+            Compiler(self.engine, self.query(name='Tony')).as_sql()
+            Compiler(self.engine, self.query(age=1)).as_sql()
+            Compiler(self.engine, self.query(name='Bob')).as_sql()
+            Compiler(self.engine, self.query(age__gt=1)).as_sql()
+            self.assertEqual(Compiler.cache_stats(), (1, 3, 2, 2))
+            Compiler(self.engine, self.query(age=1)).as_sql()
+            self.assertEqual(Compiler.cache_stats().misses, 4)
+        finally:
+            Compiler.sql_cache.maxsize = 256
+
+    def test_001_005_unknown_field(self):
+        """Criteria on an unknown field fail to compile"""
+        with self.assertRaises(exceptions.CompileError):
+            Compiler(self.engine, self.query(height=3)).as_sql()
+
+    def test_001_006_count_and_exists(self):
+        """Count & exists forms compile the criteria only - and are cached separately from the SELECT"""
+        q = self.query(name='Tony')
+        q.add_order_by('-age')
+        sql, params = Compiler(self.engine, q).as_sql('count')
+        self.assertEqual((sql, params), ('SELECT COUNT(*) FROM Person Person WHERE (Person."name" = ?)', ['Tony']))
+        sql, params = Compiler(self.engine, q).as_sql('exists')
+        self.assertEqual((sql, params), ('SELECT 1 FROM Person Person WHERE (Person."name" = ?) LIMIT 1', ['Tony']))
+        Compiler(self.engine, q).as_sql()
+        self.assertEqual(Compiler.cache_stats()[:3], (0, 3, 3))
+
+        sql, params = Compiler(self.engine, self.query(name='Bob')).as_sql('count')
+        self.assertEqual(params, ['Bob'])
+
+    def test_001_007_count_wrapped(self):
+        """Counting a limited query counts the rows of the full SELECT as a sub-query"""
+        q = self.query(name='Tony')
+        q.set_limits(10, 5)
+        sql, params = Compiler(self.engine, q).as_sql('count')
+        self.assertEqual(sql, 'SELECT COUNT(*) FROM (SELECT Person."name", Person."age", Person."id" FROM Person Person'
+                              ' WHERE (Person."name" = ?) LIMIT ? OFFSET ?) AS "subquery"')
+        self.assertEqual(params, ['Tony', 10, 5])
+        with self.assertRaises(exceptions.CompileError):
+            Compiler(self.engine, q).as_sql('delete')
 
-        print(c.lookup('parent__model__field__exact',13))
 
 def load_tests(loader, tests=None, pattern=None):
     classes = [cls for name, cls in inspect.getmembers(sys.modules[__name__],
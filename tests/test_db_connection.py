@@ -14,23 +14,29 @@ Testable Statements :
     
     Test Series 
     300* : test Core connection functionality
+    301* : test Connection pool - bounds, timeouts, idle eviction & recycling
 """
 import inspect
 import sys
+import time
 import unittest
 from collections import defaultdict
 from pathlib import Path
-from threading import Thread, get_ident
+from threading import Thread, get_ident, Event
 
 import click
 
 from .DummyEngine import DummyEngine
+from pyorm.core.exceptions import ConnectionError
+import pyorm.core.exceptions as exceptions
 
 __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '29 Jul 2017'
 
 class ConnectionCoreTest(unittest.TestCase):
+    # Handles are closed as soon as they are released - rather than kept idle in the pool
+    close_on_release = {'idle_timeout': 0}
 
     def setUp(self):
         DummyEngine.reset()
@@ -165,7 +171,7 @@ class ConnectionCoreTest(unittest.TestCase):
 
     def test_300_050_single_connection_disconnects(self):
         """Test that the disconnect method returns correct value when a single connect is made"""
-        connection = DummyEngine(db_path='database.db')
+        connection = DummyEngine(db_path='database.db', pool=self.close_on_release)
         connect_ref = connection.connect()
 
         connect_ref.close()
@@ -174,7 +180,7 @@ class ConnectionCoreTest(unittest.TestCase):
 
     def test_300_051_single_connection_two_disconnects(self):
         """Test that the disconnect method returns correct value when called twice on after a single connect is made"""
-        connection = DummyEngine(db_path='database.db')
+        connection = DummyEngine(db_path='database.db', pool=self.close_on_release)
         connect_ref = connection.connect()
 
         connect_ref.close()
@@ -185,7 +191,7 @@ class ConnectionCoreTest(unittest.TestCase):
 
     def test_300_052_two_calls_to_connect_disconnects(self):
         """Test that the disconnect method returns correctly after two connect attempts"""
-        engine_inst = DummyEngine(db_path='database.db')
+        engine_inst = DummyEngine(db_path='database.db', pool=self.close_on_release)
         connect_ref1 = engine_inst.connect()
         connect_ref2 = engine_inst.connect()
 
@@ -201,8 +207,8 @@ class ConnectionCoreTest(unittest.TestCase):
 
     def test_300_053_two_ConnectionCore_objects(self):
         """Test that the disconnect method returns the correct value when two Connection objects are sharing same.connection"""
-        engine_inst1 = DummyEngine(db_path='database.db')
-        engine_inst2 = DummyEngine(db_path='database.db')
+        engine_inst1 = DummyEngine(db_path='database.db', pool=self.close_on_release)
+        engine_inst2 = DummyEngine(db_path='database.db', pool=self.close_on_release)
         connect_ref1 = engine_inst1.connect()
         connect_ref2 = engine_inst2.connect()
 
@@ -216,8 +222,8 @@ class ConnectionCoreTest(unittest.TestCase):
 
     def test_300_054_two_different_ConnectionCore_objects(self):
         """Test that the disconnect method returns the correct value when two Connection objects are not sharing"""
-        connection1 = DummyEngine(db_path='database.db', shared=False)
-        connection2 = DummyEngine(db_path='database.db', shared=False)
+        connection1 = DummyEngine(db_path='database.db', shared=False, pool=self.close_on_release)
+        connection2 = DummyEngine(db_path='database.db', shared=False, pool=self.close_on_release)
         connect_ref1 = connection1.connect()
         connect_ref2 = connection2.connect()
 
@@ -230,6 +236,191 @@ class ConnectionCoreTest(unittest.TestCase):
         connect_ref2.handle.close.assert_called_once_with()
 
 
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        DummyEngine.reset()
+
+    def tearDown(self):
+        DummyEngine.reset()
+
+    def test_301_000_pool_stats_occupancy(self):
+        """Test that the pool reports the handles in use and idle"""
+        engine = DummyEngine(db_path='database.db', shared=False, pool={'idle_timeout':None})
+        con1, con2 = engine.connect(), engine.connect()
+
+        stats = engine.pool_stats()
+        self.assertEqual((stats.size, stats.in_use, stats.idle), (2, 2, 0))
+
+        con1.close()
+        stats = engine.pool_stats()
+        self.assertEqual((stats.size, stats.in_use, stats.idle), (2, 1, 1))
+        con1.handle.close.assert_not_called()
+
+        con2.close()
+        self.assertEqual(engine.pool_stats().idle, 2)
+
+    def test_301_001_idle_handle_reused(self):
+        """Test that a released handle is reused rather than creating a new one"""
+        engine = DummyEngine(db_path='database.db', pool={'idle_timeout':None})
+        con1 = engine.connect()
+        handle = con1.handle
+        con1.close()
+
+        con2 = engine.connect()
+        self.assertIs(con2.handle, handle)
+        self.assertEqual(DummyEngine._step, 1)
+
+    def test_301_002_min_size_opened_up_front(self):
+        """Test that min_size handles are opened when the pool is created"""
+        engine = DummyEngine(db_path='database.db', pool={'min_size':2})
+        stats = engine.pool_stats()
+        self.assertEqual((stats.size, stats.idle), (2, 2))
+
+        con = engine.connect()
+        con.close()
+
+        # Released handle is retained as the pool is at min_size
+        con.handle.close.assert_not_called()
+        self.assertEqual(engine.pool_stats().size, 2)
+
+    def test_301_003_idle_handles_kept_by_default(self):
+        """Test that by default released handles are kept for reuse - in a bounded pool"""
+        engine = DummyEngine(db_path='database.db', shared=False)
+        con1 = engine.connect()
+        handle = con1.handle
+        con1.close()
+        handle.close.assert_not_called()
+
+        con2 = engine.connect()
+        self.assertIs(con2.handle, handle)
+        con2.close()
+        self.assertEqual(engine.pool_stats().max_size, 10)
+
+    def test_301_004_conflicting_settings(self):
+        """Test that an engine can't ask for different settings from the pool already open for its database"""
+        DummyEngine(db_path='database.db', pool={'max_size': 2}).connect().close()
+        self.assertEqual(DummyEngine(db_path='database.db').pool_stats().max_size, 2)
+        DummyEngine(db_path='database.db', pool={'max_size': 2}).connect().close()
+        with self.assertRaises(exceptions.pyOrmEngineException):
+            DummyEngine(db_path='database.db', pool={'max_size': 5}).connect()
+        with self.assertRaises(exceptions.pyOrmEngineException):
+            DummyEngine(db_path='database.db', options={'foreign_keys': True}).connect()
+
+    def test_301_010_max_size_timeout(self):
+        """Test that checkout fails with a ConnectionError when the pool is exhausted"""
+        engine = DummyEngine(db_path='database.db', shared=False, pool={'max_size':1, 'timeout':0.05})
+        con1 = engine.connect()
+
+        with self.assertRaisesRegex(ConnectionError, 'pool exhausted'):
+            engine.connect()
+
+        stats = engine.pool_stats()
+        self.assertEqual((stats.size, stats.in_use, stats.waits, stats.timeouts), (1, 1, 1, 1))
+        self.assertGreaterEqual(stats.wait_time, 0.05)
+        con1.close()
+
+    def test_301_011_max_size_waits_for_release(self):
+        """Test that a checkout waits for a handle released by another thread"""
+        engine = DummyEngine(db_path='database.db', shared=False, pool={'max_size':1, 'timeout':5, 'idle_timeout':None})
+        con1 = engine.connect()
+        waiting = Event()
+        result = []
+
+        def testing():
+            waiting.set()
+            result.append(engine.connect())
+
+        t = Thread(target=testing)
+        t.start()
+        waiting.wait()
+        con1.close()
+        t.join()
+
+        self.assertIs(result[0].handle, con1.handle)
+        self.assertEqual(engine.pool_stats().waits, 1)
+        result[0].close()
+
+    def test_301_020_idle_eviction(self):
+        """Test that idle handles are closed once they exceed the idle timeout"""
+        engine = DummyEngine(db_path='database.db', shared=False, pool={'idle_timeout':0.01})
+        con1 = engine.connect()
+        con1.close()
+        con1.handle.close.assert_not_called()
+
+        time.sleep(0.02)
+        con2 = engine.connect()
+
+        con1.handle.close.assert_called_once_with()
+        self.assertIsNot(con2.handle, con1.handle)
+
+    def test_301_030_recycle(self):
+        """Test that handles are closed after being used recycle times"""
+        engine = DummyEngine(db_path='database.db', pool={'idle_timeout':None, 'recycle':2})
+        con = engine.connect()
+        handle = con.handle
+        con.close()
+        con = engine.connect()
+        self.assertIs(con.handle, handle)
+        con.close()
+
+        handle.close.assert_called_once_with()
+        self.assertIsNot(engine.connect().handle, handle)
+
+    def test_301_040_threaded_checkouts_bounded(self):
+        """Test that many threads never hold more than max_size handles"""
+        engine = DummyEngine(db_path='database.db', pool={'max_size':3, 'timeout':10, 'idle_timeout':None})
+        peak = []
+
+        def testing():
+            for _ in range(50):
+                con = engine.connect()
+                peak.append(engine.pool_stats().in_use)
+                con.close()
+
+        threads = [Thread(target=testing) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = engine.pool_stats()
+        self.assertLessEqual(max(peak), 3)
+        self.assertEqual(stats.in_use, 0)
+        self.assertLessEqual(stats.size, 3)
+
+    def test_301_041_threaded_shared_checkouts(self):
+        """Test that threads sharing a single connection release its handle exactly once"""
+        engine = DummyEngine(db_path='database.db', unique_per_thread=False, pool={'idle_timeout':None})
+        handles = set()
+
+        def testing():
+            for _ in range(2000):
+                con = engine.connect()
+                handles.add(id(con.handle))
+                con.close()
+
+        threads = [Thread(target=testing) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = engine.pool_stats()
+        self.assertEqual((stats.in_use, stats.idle), (0, stats.size))
+        self.assertEqual(len(set(id(slot.handle) for slot in engine.pool._idle)), stats.idle)
+
+    def test_301_050_reset_closes_idle_handles(self):
+        """Test that resetting the engines closes the idle handles of every pool"""
+        engine = DummyEngine(db_path='database.db', pool={'idle_timeout':None})
+        con = engine.connect()
+        con.close()
+        con.handle.close.assert_not_called()
+
+        DummyEngine.reset()
+        con.handle.close.assert_called_once_with()
+
+
 def load_tests(loader, tests=None, pattern=None):
     classes = [cls for name, cls in inspect.getmembers(sys.modules[__name__],
                                                        inspect.isclass)
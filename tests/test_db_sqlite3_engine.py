@@ -19,27 +19,47 @@ Test Series
         410_2** : Tests the engine creates the right SQL type for the column
         410_3** : Test the engine generate the right column check clauses
         410_4** : Testing the database adapters (duration & Decimal fields)
+        410_5** : Testing the date truncation functions - and their native SQL forms
+        410_6** : Testing field comparisons with bound parameters
+        410_7** : Testing PRAGMA options & profiles applied to each connection
+        410_8** : Testing function registration & expression indexes
+        410_81* : Testing index DDL - indexed fields, unique, partial & covering indexes, schema & migrations
+        410_9** : Testing atomic blocks - savepoints, rollback & durability
+    411_*** : test instrumentation of the statements executed by an engine
+        411_0** : Pre & post execute listeners
+        411_1** : Slow query log & query plans
 """
 import sys
+import threading
 import unittest
+import unittest.mock
 import click
 import inspect
 from pathlib import Path
 
 import re
+import json
 import datetime
 import decimal
 
 from TempDirectoryContext import TempDirectoryContext as TDC
 
-from pyorm.db.engine.sqlite import Engine, Constants
+from pyorm.db.engine.sqlite import Engine, Constants, profiles
+from pyorm.db.engine.core import FunctionInfo, EngineCore
+from pyorm.db.models.indexes import Index
+from pyorm.db.models.functions import Function, TruncDate
+from pyorm.db.models.queryset import QuerySet, F, Q
+from pyorm.db.migrations import migrations
 
 import pyorm.db.models.fields as fields
+from pyorm.db.models.models import Model
 
 from repeatedtestframework import GenerateTestMethods
 
 import sqlite3
 
+import pyorm.core.exceptions as exceptions
+
 __version__ = "0.1"
 __author__ = 'Tony Flury : anthony.flury@btinternet.com'
 __created__ = '29 Jul 2017'
@@ -74,6 +94,24 @@ class Database(unittest.TestCase):
             con = eng.connect()
             self.assertTrue(file.exists(), 'Database file does not exists post test')
 
+    def test_410_001_handle_reused(self):
+        """test that successive statements reuse the same sqlite connection - and its statement cache"""
+        with TDC() as temp_dir:
+            engine = Engine(Path(temp_dir) / 'database.db')
+            self.addCleanup(Engine.reset)
+            handles = []
+            execute = engine._execute
+
+            def spy(connection, sql, params, many=False):
+                handles.append(connection.handle)
+                return execute(connection, sql, params, many=many)
+            engine._execute = spy
+
+            engine.execute('CREATE TABLE Thing (id integer PRIMARY KEY)')
+            engine.execute('SELECT id FROM Thing')
+            self.assertEqual(len(handles), 2)
+            self.assertIs(handles[0], handles[1])
+
 #Todo Test existing databases and other items.
 
 #
@@ -460,6 +498,607 @@ class DateTrunc(unittest.TestCase):
         self.assertEqual(len(years), 6)
         self.assertCountEqual(years,[('2017-06-13 13:34:09'),('2017-06-13 13:24:11'),('2017-08-09 09:05:00'),('2016-11-05 22:55:59'),('2015-11-05 22:55:59'),(None)])
 
+    def test_410_550_native_matches_functions(self):
+        """The native SQL truncations give the same results as the Python functions"""
+        cases = [('TruncYear', 'd'), ('TruncYear', 'ts'), ('TruncMonth', 'd'), ('TruncMonth', 'ts'),
+                 ('TruncDay', 'd'), ('TruncDay', 'ts'), ('TruncHour', 'ts'), ('TruncMinutes', 'ts'),
+                 ('TruncSeconds', 'ts')]
+        for name, column in cases:
+            with self.subTest(function=name, column=column):
+                native = self.engine.resolve_function(name, column)
+                self.assertNotIn(name, native)
+                cur = self.connection.execute('SELECT {native}, {name}({column}) FROM TEST'.format(
+                    native=native, name=name, column=column))
+                for row in cur.fetchall():
+                    self.assertEqual(row[0], row[1])
+
+    def test_410_551_function_fallback(self):
+        """Functions without a native form are called as registered functions - unknown functions are rejected"""
+        with unittest.mock.patch.dict(Engine._native_functions, clear=True):
+            self.assertEqual(self.engine.resolve_function('TruncYear', 'd'), 'TruncYear(d)')
+        with self.assertRaises(exceptions.CompileError):
+            self.engine.resolve_function('TruncFortnight', 'd')
+
+class Comparisons(unittest.TestCase):
+    def setUp(self):
+        class Person(Model):
+            name = fields.CharField()
+            age = fields.IntegerField()
+
+        self.model = Person
+        self.engine = Engine(':memory:')
+        self.connection = self.engine.connect()
+        self.connection.execute('CREATE TABLE Person (id integer PRIMARY KEY, name text, age integer);')
+        self.connection.executemany('INSERT INTO Person(name, age) VALUES (?,?);',
+                                    [('Tony', 50), ('Antony', 21), ("O'Brien", 33), ('tony', None)])
+
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def _names(self, lookup, value):
+        sql, params = self.engine.resolve_lookup(lookup, value, model=self.model)
+        cur = self.connection.execute('SELECT name FROM Person WHERE ' + sql + ' ORDER BY id', params)
+        return [r['name'] for r in cur.fetchall()]
+
+    def test_410_600_exact_bound(self):
+        sql, params = self.engine.resolve_lookup('name__exact', 'Tony', model=self.model)
+        self.assertEqual((sql, params), ('"name" = ?', ['Tony']))
+        self.assertEqual(self._names('name__exact', 'Tony'), ['Tony'])
+
+    def test_410_601_implicit_exact(self):
+        self.assertEqual(self._names('age', 21), ['Antony'])
+
+    def test_410_602_exact_none(self):
+        self.assertEqual(self._names('age__exact', None), ['tony'])
+
+    def test_410_603_iexact(self):
+        self.assertEqual(self._names('name__iexact', 'TONY'), ['Tony', 'tony'])
+
+    def test_410_604_ordering_comparisons(self):
+        self.assertEqual(self._names('age__gt', 33), ['Tony'])
+        self.assertEqual(self._names('age__gte', 33), ['Tony', "O'Brien"])
+        self.assertEqual(self._names('age__lt', 33), ['Antony'])
+        self.assertEqual(self._names('age__lte', 33), ['Antony', "O'Brien"])
+
+    def test_410_605_like_comparisons(self):
+        self.assertEqual(self._names('name__contains', 'ton'), ['Tony', 'Antony', 'tony'])
+        self.assertEqual(self._names('name__startswith', 'To'), ['Tony', 'tony'])
+        self.assertEqual(self._names('name__endswith', 'ien'), ["O'Brien"])
+
+    def test_410_606_quotes_in_values(self):
+        """Values are bound - never formatted into the SQL"""
+        self.assertEqual(self._names('name__exact', "O'Brien"), ["O'Brien"])
+        self.assertEqual(self._names('name__contains', "'"), ["O'Brien"])
+
+    def test_410_607_same_shape_same_sql(self):
+        sql1, _ = self.engine.resolve_lookup('name__contains', 'a', model=self.model)
+        sql2, _ = self.engine.resolve_lookup('name__contains', 'b', model=self.model)
+        self.assertEqual(sql1, sql2)
+
+    def test_410_608_unknown_field(self):
+        with self.assertRaises(exceptions.CompileError):
+            self.engine.resolve_lookup('height__exact', 2, model=self.model)
+
+
+    def test_410_609_in_comparison(self):
+        sql, params = self.engine.resolve_lookup('age__in', (50, 33), model=self.model)
+        self.assertEqual((sql, params), ('"age" IN (?, ?)', [50, 33]))
+        self.assertEqual(self._names('age__in', [21, 33, 99]), ['Antony', "O'Brien"])
+        self.assertEqual(self._names('age__in', []), [])
+
+class Pragmas(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TDC()
+        self.db_path = Path(self.temp_dir.__enter__()) / 'database.db'
+
+    def tearDown(self):
+        Engine.reset()
+        self.temp_dir.__exit__(None, None, None)
+
+    def _pragma(self, engine, name):
+        connection = engine.get_connection()
+        try:
+            return connection.execute('PRAGMA {}'.format(name)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_410_700_no_options(self):
+        """Without options no PRAGMAs are applied"""
+        engine = Engine(self.db_path)
+        self.assertEqual(engine.pragmas, {})
+        self.assertEqual(self._pragma(engine, 'journal_mode'), 'delete')
+
+    def test_410_701_explicit_options(self):
+        """Each option is applied to a new connection"""
+        engine = Engine(self.db_path, options={'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -4000,
+                                               'mmap_size': 1048576, 'temp_store': 'MEMORY', 'busy_timeout': 1500})
+        self.assertEqual(self._pragma(engine, 'journal_mode'), 'wal')
+        self.assertEqual(self._pragma(engine, 'synchronous'), 1)
+        self.assertEqual(self._pragma(engine, 'cache_size'), -4000)
+        self.assertEqual(self._pragma(engine, 'mmap_size'), 1048576)
+        self.assertEqual(self._pragma(engine, 'temp_store'), 2)
+        self.assertEqual(self._pragma(engine, 'busy_timeout'), 1500)
+
+    def test_410_702_profiles(self):
+        """Each profile applies its options - explicit options override the profile"""
+        for name in ('durable', 'balanced', 'bulk-load'):
+            with self.subTest(profile=name):
+                engine = Engine(self.db_path, options={'profile': name})
+                self.assertEqual(dict(engine.pragmas), profiles[name])
+
+        engine = Engine(self.db_path, options={'profile': 'balanced', 'synchronous': 'FULL'})
+        self.assertEqual(engine.pragmas['synchronous'], 'FULL')
+        self.assertEqual(self._pragma(engine, 'synchronous'), 2)
+        self.assertEqual(self._pragma(engine, 'journal_mode'), 'wal')
+
+    def test_410_703_invalid_options(self):
+        """Unknown profiles, options and values are rejected - values are never formatted unchecked"""
+        for options in ({'profile': 'fastest'}, {'page_size': 4096}, {'journal_mode': 'WAL; DROP TABLE x'},
+                        {'synchronous': 'SOMETIMES'}, {'cache_size': '2000'}, {'mmap_size': -1}):
+            with self.subTest(options=options):
+                with self.assertRaises(exceptions.pyOrmEngineException):
+                    Engine(self.db_path, options=options)
+
+
+class FunctionIndexes(unittest.TestCase):
+    def setUp(self):
+        self.functions = unittest.mock.patch.dict(Engine._functions, {
+            'Reverse': FunctionInfo(lambda value: value[::-1] if value else value, 1, True),
+            'Noisy': FunctionInfo(lambda value: value, -1, False)})
+        self.functions.start()
+        self.engine = Engine(':memory:')
+
+        class Event(Model):
+            _engine = self.engine
+            name = fields.CharField()
+            created = fields.DateTimeField()
+            _indexes = [Index(TruncDate('created', 'days')),
+                        Index(Function('Reverse', 'name'), 'created', name='event_reversed')]
+
+        self.model = Event
+        self.connection = self.engine.connect()
+        self.connection.execute('CREATE TABLE Event (id integer PRIMARY KEY, name text, created timestamp);')
+
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+        self.functions.stop()
+
+    def _plan(self, sql, params=()):
+        return ' '.join(row[3] for row in self.connection.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+    def test_410_800_register_function_metadata(self):
+        """The decorator records the arity and deterministic flags"""
+        self.assertEqual(Engine._functions['TruncDay'].arity, 1)
+        self.assertTrue(Engine._functions['TruncDay'].deterministic)
+        self.assertTrue(self.engine.is_deterministic('Reverse'))
+        self.assertFalse(self.engine.is_deterministic('Noisy'))
+        self.assertFalse(self.engine.is_deterministic('Unknown'))
+
+    def test_410_801_arity_checked(self):
+        """Calling a function with the wrong number of arguments fails to compile"""
+        self.assertEqual(self.engine.resolve_function('Reverse', 'name'), 'Reverse(name)')
+        with self.assertRaises(exceptions.CompileError):
+            self.engine.resolve_function('Reverse', 'name', 'created')
+        self.assertEqual(self.engine.resolve_function('Noisy', 'a', 'b'), 'Noisy(a, b)')
+
+    def test_410_802_index_sql(self):
+        """Indexes are generated over native functions, registered functions and fields"""
+        first, second = self.model.indexes()
+        self.assertEqual(self.engine.index_sql(self.model, first),
+                         'CREATE INDEX IF NOT EXISTS "Event_created_days_idx" ON Event (date("created"))')
+        self.assertEqual(self.engine.index_sql(self.model, second),
+                         'CREATE INDEX IF NOT EXISTS "event_reversed" ON Event (Reverse("name"), "created")')
+
+    def test_410_803_non_deterministic_not_indexed(self):
+        """A function which isn't deterministic can't be indexed"""
+        with self.assertRaises(exceptions.CompileError):
+            self.engine.index_sql(self.model, Index(Function('Noisy', 'name')))
+
+    def test_410_804_indexes_used(self):
+        """The indexes are created, and used by queries over the same expressions"""
+        self.engine.create_indexes(self.model)
+        sql, params = self.engine.compile(QuerySet(model=self.model).dates('created', 'days').query)
+        self.assertIn('Event_created_days_idx', self._plan(sql, params))
+        self.assertIn('event_reversed', self._plan('SELECT id FROM Event WHERE Reverse(name) = ?', ['ynoT']))
+
+
+class IndexDDL(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        class Owner(Model):
+            _engine = self.engine
+            name = fields.CharField(unique=True)
+
+        class Item(Model):
+            _engine = self.engine
+            sku = fields.CharField(indexed=True)
+            stock = fields.IntegerField()
+            price = fields.DecimalField()
+            owner = fields.ForeignKey(Owner)
+            _indexes = [Index('owner', 'sku', unique=True),
+                        Index('price', name='item_in_stock', where=Q(stock__gt=0) & ~Q(sku="o'clock")),
+                        Index('sku', name='item_sku_price', include=['price'])]
+
+        self.owner, self.model = Owner, Item
+        self.connection = self.engine.connect()
+
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def _plan(self, sql, params=()):
+        return ' '.join(row[3] for row in self.connection.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+    def test_410_810_indexed_field(self):
+        """A field declared with indexed=True has an index - unique & primary fields don't need one"""
+        self.assertEqual(self.engine.index_sql(self.model, self.model.indexes()[0]),
+                         'CREATE INDEX IF NOT EXISTS "Item_sku_idx" ON Item ("sku")')
+        self.assertEqual(self.owner.indexes(), [])
+
+    def test_410_811_unique_index(self):
+        """A unique index is named _uniq, and rejects duplicate rows"""
+        self.assertEqual(self.engine.index_sql(self.model, self.model.indexes()[1]),
+                         'CREATE UNIQUE INDEX IF NOT EXISTS "Item_owner_sku_uniq" ON Item ("owner_id", "sku")')
+        self.engine.create_schema(self.owner, self.model)
+        self.connection.execute('INSERT INTO Item (sku, owner_id) VALUES (\'a\', 1)')
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.connection.execute('INSERT INTO Item (sku, owner_id) VALUES (\'a\', 1)')
+
+    def test_410_812_partial_index(self):
+        """The condition of a partial index is written with literal values"""
+        self.assertEqual(self.engine.index_sql(self.model, self.model.indexes()[2]),
+                         'CREATE INDEX IF NOT EXISTS "item_in_stock" ON Item ("price") '
+                         'WHERE (("stock" > 0) AND NOT ("sku" = \'o\'\'clock\'))')
+        self.engine.create_schema(self.owner, self.model)
+        self.assertIn('item_in_stock', self._plan('SELECT id FROM Item WHERE price > ? AND "stock" > 0 '
+                                                  'AND NOT "sku" = \'o\'\'clock\'', [1]))
+
+    def test_410_813_covering_index(self):
+        """The included fields follow the expressions - so a query on them only reads the index"""
+        self.assertEqual(self.engine.index_sql(self.model, self.model.indexes()[3]),
+                         'CREATE INDEX IF NOT EXISTS "item_sku_price" ON Item ("sku", "price")')
+        self.engine.create_schema(self.owner, self.model)
+        self.assertIn('COVERING INDEX item_sku_price', self._plan('SELECT price FROM Item WHERE sku = ?', ['a']))
+
+    def test_410_814_table_sql(self):
+        """The table is created with a column per field - a foreign key has the type of the key it references"""
+        sql = self.engine.table_sql(self.model.table_name(), self.model.db_fields())
+        self.assertTrue(sql.startswith('CREATE TABLE IF NOT EXISTS Item ('))
+        self.assertIn('"owner_id" integer', sql)
+        self.engine.create_schema(self.owner, self.model)
+        names = {row[0] for row in self.connection.execute('SELECT name FROM sqlite_master WHERE type = \'index\'')}
+        self.assertTrue({'Item_sku_idx', 'Item_owner_sku_uniq', 'item_in_stock', 'item_sku_price'} <= names)
+
+    def test_410_815_migration(self):
+        """A migration creates a model's table and indexes, and can add & remove indexes"""
+        class Migration(migrations.Migration):
+            operations = [migrations.CreateModel(name='Ledger', fields=[('amount', fields.IntegerField(indexed=True)),
+                                                                         ('id', fields.AutoField())]),
+                          migrations.AddIndex('Ledger', Index('amount', 'id', name='ledger_amount_id')),
+                          migrations.RemoveIndex('Ledger', 'Ledger_amount_idx')]
+
+        self.assertEqual(Migration().sql(self.engine), [
+            'CREATE TABLE IF NOT EXISTS Ledger ("amount" integer, "id" integer PRIMARY KEY)',
+            'CREATE INDEX IF NOT EXISTS "Ledger_amount_idx" ON Ledger ("amount")',
+            'CREATE INDEX IF NOT EXISTS "ledger_amount_id" ON Ledger ("amount", "id")',
+            'DROP INDEX IF EXISTS "Ledger_amount_idx"'])
+        Migration().execute(self.engine)
+        names = {row[0] for row in self.connection.execute('SELECT name FROM sqlite_master')}
+        self.assertIn('ledger_amount_id', names)
+        self.assertNotIn('Ledger_amount_idx', names)
+
+    def test_410_816_migration_state(self):
+        """Indexes are added to the model as the earlier migrations describe it - not to the model class"""
+        initial = migrations.Migration(operations=[
+            migrations.CreateModel(name='Item', fields=[('quantity', fields.IntegerField(db_column='qty')),
+                                                        ('id', fields.AutoField())])])
+        later = migrations.Migration(operations=[migrations.AddIndex('Item', Index('quantity'))])
+
+        state = {}
+        initial.sql(self.engine, state)
+        self.assertEqual(later.sql(self.engine, state), ['CREATE INDEX IF NOT EXISTS "Item_quantity_idx" ON Item ("qty")'])
+        self.assertEqual([index.name_for(state['Item']) for index in state['Item'].indexes()], ['Item_quantity_idx'])
+        with self.assertRaises(exceptions.MigrationError):
+            later.sql(self.engine)
+
+    def test_410_817_partial_index_literals(self):
+        """The values of a partial index are written as literals as the condition is compiled"""
+        index = Index('sku', name='item_question', where=Q(sku__startswith="what's?") | Q(stock__in=[1, 2]))
+        self.assertEqual(self.engine.index_sql(self.model, index),
+                         'CREATE INDEX IF NOT EXISTS "item_question" ON Item ("sku") '
+                         'WHERE (("sku" like \'what\'\'s?\' || \'%\') OR ("stock" IN (1, 2)))')
+        self.assertEqual(self.engine.inline("name = '?' AND \"odd?\" = ?", ['a?']), "name = '?' AND \"odd?\" = 'a?'")
+        with self.assertRaises(exceptions.CompileError):
+            self.engine.inline('a = ? AND b = ?', [1])
+
+
+class Transactions(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TDC()
+        self.db_path = Path(self.temp_dir.__enter__()) / 'database.db'
+        self.engine = Engine(self.db_path, shared=False, options={'synchronous': 'NORMAL'},
+                             pool={'max_size': 1, 'idle_timeout': None, 'timeout': 2})
+
+        class Account(Model):
+            _engine = self.engine
+            owner = fields.CharField()
+            balance = fields.IntegerField()
+
+        self.model = Account
+        self.engine.execute('CREATE TABLE Account (id integer PRIMARY KEY, owner text, balance integer)')
+        self.engine.execute('INSERT INTO Account VALUES (1, \'Ann\', 100), (2, \'Bob\', 50)')
+
+    def tearDown(self):
+        Engine.reset()
+        self.temp_dir.__exit__(None, None, None)
+
+    def _balances(self):
+        return [row[0] for row in self.engine.execute('SELECT balance FROM Account ORDER BY id').rows]
+
+    def _statements(self):
+        statements = []
+        execute = self.engine._execute
+
+        def spy(connection, sql, params, many=False):
+            statements.append(sql)
+            return execute(connection, sql, params, many=many)
+        patcher = unittest.mock.patch.object(self.engine, '_execute', side_effect=spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return statements
+
+    def test_410_900_commit(self):
+        """Statements on every connection of the thread join the block, and are committed together when it exits"""
+        statements = self._statements()
+        with self.engine.atomic() as connection:
+            self.engine.execute('UPDATE Account SET balance = balance - 10 WHERE id = 1')
+            self.model.objects.filter(id=2).update(balance=60)
+            self.assertTrue(connection.in_transaction)
+            joined = self.engine.connect()
+            self.assertIs(joined, connection)
+            joined.close()
+        self.assertFalse(connection.in_transaction)
+        self.assertEqual(self._balances(), [90, 60])
+        self.assertEqual([sql.split()[0] for sql in statements], ['BEGIN', 'UPDATE', 'UPDATE', 'COMMIT', 'SELECT'])
+
+    def test_410_901_rollback(self):
+        """An exception rolls back every write made within the block"""
+        with self.assertRaises(ValueError):
+            with self.engine.atomic():
+                self.model.objects.update(balance=0)
+                self.model.objects.bulk_create([self.model(owner='Cat', balance=5)])
+                raise ValueError
+        self.assertEqual(self._balances(), [100, 50])
+
+    def test_410_902_savepoints(self):
+        """A nested block is a savepoint - an exception only rolls back the nested block"""
+        statements = self._statements()
+        with self.engine.atomic():
+            self.model.objects.filter(id=1).update(balance=1)
+            with self.assertRaises(ValueError):
+                with self.engine.atomic():
+                    self.model.objects.filter(id=2).update(balance=2)
+                    raise ValueError
+            with self.engine.atomic():
+                self.model.objects.filter(id=2).update(balance=3)
+        self.assertEqual(self._balances(), [1, 3])
+        self.assertEqual([sql for sql in statements if not sql.startswith('UPDATE')],
+                         ['BEGIN IMMEDIATE', 'SAVEPOINT pyorm_savepoint_0', 'ROLLBACK TO pyorm_savepoint_0',
+                          'RELEASE pyorm_savepoint_0', 'SAVEPOINT pyorm_savepoint_0', 'RELEASE pyorm_savepoint_0',
+                          'COMMIT', 'SELECT balance FROM Account ORDER BY id'])
+
+    def test_410_903_join_without_savepoint(self):
+        """A nested block without a savepoint joins the transaction - and transaction() never makes savepoints"""
+        with self.assertRaises(ValueError):
+            with self.engine.atomic():
+                self.model.objects.filter(id=1).update(balance=1)
+                with self.engine.transaction():
+                    with self.engine.atomic(savepoint=False):
+                        self.model.objects.filter(id=2).update(balance=2)
+                        raise ValueError
+        self.assertEqual(self._balances(), [100, 50])
+
+    def test_410_904_decorator(self):
+        """atomic can decorate a function - each call is a transaction"""
+        @self.engine.atomic()
+        def transfer(amount):
+            self.model.objects.filter(id=1).update(balance=F('balance') - amount)
+            self.model.objects.filter(id=2).update(balance=F('balance') + amount)
+            if self._balances()[0] < 0:
+                raise ValueError('Overdrawn')
+
+        transfer(30)
+        with self.assertRaises(ValueError):
+            transfer(80)
+        self.assertEqual(self._balances(), [70, 80])
+
+    def test_410_905_durability(self):
+        """The durability of the outermost block sets the sync on commit - the connection's setting is restored"""
+        pragma = 'PRAGMA synchronous'
+        for durable, expected in ((False, 0), (True, 2), (None, 1)):
+            with self.subTest(durable=durable):
+                with self.engine.atomic(durable=durable) as connection:
+                    self.assertEqual(connection.execute(pragma).fetchone()[0], expected)
+                    with self.engine.atomic(durable=not durable):
+                        self.assertEqual(connection.execute(pragma).fetchone()[0], expected)
+                    self.assertEqual(self.engine.durability(connection, None), expected)
+                reused = self.engine.connect()
+                self.assertIs(reused.handle, connection.handle)
+                self.assertEqual(reused.execute(pragma).fetchone()[0], 1)
+                reused.close()
+
+    def test_410_906_durability_restored_if_begin_fails(self):
+        """The connection's durability is restored even if the transaction can't begin"""
+        with unittest.mock.patch.object(self.engine, '_begin', 'BEGIN NONSENSE'):
+            with self.assertRaises(sqlite3.OperationalError):
+                with self.engine.atomic(durable=False):
+                    pass
+        connection = self.engine.connect()
+        self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertFalse(connection.in_transaction)
+        connection.close()
+
+
+
+class Instrumentation(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        class Item(Model):
+            _engine = self.engine
+            name = fields.CharField()
+
+        self.model = Item
+        self.connection = self.engine.connect()
+        self.connection.executescript("CREATE TABLE Item (id integer PRIMARY KEY, name text);"
+                                      "INSERT INTO Item VALUES (1, 'a'), (2, 'b'), (3, 'c');")
+        self.events = []
+        self.listener = Engine.add_listener(pre_execute=lambda event: self.events.append(('pre', event)),
+                                            post_execute=lambda event: self.events.append(('post', event)))
+
+    def tearDown(self):
+        Engine.remove_listener(self.listener)
+        self.connection.close()
+        Engine.reset()
+
+    def test_411_000_query_events(self):
+        """A query fires a pre & post event - the post event carries the rows fetched, the timing and the QuerySet"""
+        qs = self.model.objects.filter(id__gt=1)
+        self.assertEqual(len(list(qs)), 2)
+
+        (when, pre), (when_post, post) = self.events
+        self.assertEqual((when, when_post), ('pre', 'post'))
+        self.assertEqual(pre.sql, post.sql)
+        self.assertIn('FROM Item Item WHERE', pre.sql)
+        self.assertEqual((pre.param_count, pre.rowcount, pre.elapsed, pre.many), (1, None, None, False))
+        self.assertEqual(post.rowcount, 2)
+        self.assertGreaterEqual(post.elapsed, 0)
+        self.assertIs(post.queryset, qs)
+        self.assertIs(post.engine, self.engine)
+        self.assertEqual(post.thread_id, threading.get_ident())
+        self.assertIsNone(post.error)
+
+    def test_411_001_write_and_streamed_events(self):
+        """Writes report the rows changed, and streamed queries the rows fetched once the cursor is done"""
+        self.model.objects.filter(id__in=[1, 2]).update(name='z')
+        self.assertEqual([event.rowcount for when, event in self.events if when == 'post'], [2])
+
+        del self.events[:]
+        self.assertEqual(len(list(self.model.objects.all().iterator(chunk_size=2))), 3)
+        self.assertEqual([event.rowcount for when, event in self.events if when == 'post'], [3])
+
+        del self.events[:]
+        self.model.objects.bulk_create([self.model(name='d'), self.model(name='e')])
+        statements = [event.sql.split()[0] for when, event in self.events if when == 'post']
+        self.assertEqual(statements, ['BEGIN', 'INSERT', 'SELECT', 'COMMIT'])
+        insert = [event for when, event in self.events if when == 'post' and event.sql.startswith('INSERT')][0]
+        self.assertEqual((insert.param_count, insert.rowcount, insert.queryset), (2, 2, None))
+
+    def test_411_002_failed_statement(self):
+        """A statement which fails fires a post event with the error"""
+        with self.assertRaises(sqlite3.OperationalError):
+            self.engine.execute('SELECT * FROM Missing')
+        when, event = self.events[-1]
+        self.assertEqual(when, 'post')
+        self.assertIsInstance(event.error, sqlite3.OperationalError)
+        self.assertIsNone(event.rowcount)
+
+    def test_411_003_listeners_scoped_to_engine_class(self):
+        """Listeners only apply to engines of the class they were added to - and stop once removed"""
+        other = unittest.mock.Mock()
+        listener = EngineCore.add_listener(post_execute=other)
+        Engine.remove_listener(self.listener)
+        self.engine.execute('SELECT 1')
+        self.assertEqual(self.events, [])
+        self.assertEqual(other.call_args[0][0].sql, 'SELECT 1')
+
+        class OtherEngine(Engine):
+            pass
+        Engine.remove_listener(listener)
+        listener = OtherEngine.add_listener(post_execute=other)
+        other.reset_mock()
+        self.engine.execute('SELECT 1')
+        other.assert_not_called()
+        OtherEngine.remove_listener(listener)
+
+
+
+class SlowQueries(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TDC()
+        self.directory = Path(self.temp_dir.__enter__())
+        self.engine = Engine(':memory:')
+
+        class Item(Model):
+            _engine = self.engine
+            name = fields.CharField()
+
+        self.model = Item
+        self.connection = self.engine.connect()
+        self.connection.executescript("CREATE TABLE Item (id integer PRIMARY KEY, name text);"
+                                      "INSERT INTO Item VALUES (1, 'a'), (2, 'b'), (3, 'c');")
+
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+        self.temp_dir.__exit__(None, None, None)
+
+    def _records(self, path):
+        with path.open() as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_411_100_explain(self):
+        """A query set explains its plan - a scan for an unindexed column, a search for the primary key"""
+        self.assertRegex(self.model.objects.filter(name='a').explain(), r'^SCAN (TABLE )?Item')
+        self.assertRegex(self.model.objects.filter(id=1).explain(), r'^SEARCH (TABLE )?Item USING INTEGER PRIMARY KEY')
+        self.assertEqual(self.engine.explain('SELECT * FROM Item WHERE id IN (SELECT id FROM Item WHERE name = ?)',
+                                             ['a'])[0][0], 0)
+
+    def test_411_101_slow_statements_logged(self):
+        """Each slow statement is written as a JSON line - with the parameter types, timing and plan"""
+        path = self.directory / 'slow.ndjson'
+        log = self.engine.slow_query_log(path, threshold=0)
+        self.addCleanup(log.close)
+        list(self.model.objects.filter(name='secret'))
+        self.model.objects.filter(id=2).update(name='z')
+
+        select, update = self._records(path)
+        self.assertIn('FROM Item Item WHERE (Item."name" = ?)', select['sql'])
+        self.assertEqual((select['params'], select['param_count'], select['rows']), (['str'], 1, 0))
+        self.assertEqual(select['full_scans'], ['Item'])
+        self.assertNotIn('secret', path.read_text())
+        self.assertGreaterEqual(select['elapsed'], 0)
+        self.assertEqual((update['rows'], update['full_scans']), (1, []))
+        self.assertTrue(update['plan'][0].startswith('SEARCH'))
+
+    def test_411_102_threshold(self):
+        """Statements quicker than the threshold aren't logged - and nothing is logged once the log is closed"""
+        path = self.directory / 'slow.ndjson'
+        log = self.engine.slow_query_log(path, threshold=60)
+        list(self.model.objects.all())
+        self.assertFalse(path.exists())
+
+        log.threshold = 0
+        self.engine.execute('SELECT 1')
+        log.close()
+        list(self.model.objects.all())
+        self.assertEqual([record['sql'] for record in self._records(path)], ['SELECT 1'])
+
+    def test_411_103_rotation(self):
+        """The file is rotated once it reaches max_bytes"""
+        path = self.directory / 'slow.ndjson'
+        log = self.engine.slow_query_log(path, threshold=0, max_bytes=400, backup_count=2)
+        self.addCleanup(log.close)
+        for _ in range(10):
+            list(self.model.objects.all())
+        self.assertEqual(sorted(file.name for file in self.directory.iterdir()),
+                         ['slow.ndjson', 'slow.ndjson.1', 'slow.ndjson.2'])
+
+
+
 def load_tests(loader, tests=None, pattern=None):
     classes = [cls for name, cls in inspect.getmembers(sys.modules[__name__],
                                                        inspect.isclass)
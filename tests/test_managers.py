@@ -14,6 +14,7 @@ Testable Statements :
 
 Test Series
     280 - Test manager are created by default
+    281 - Test the query set methods are available on the manager
 """
 import sys
 import inspect
@@ -26,7 +27,9 @@ __created__ = '26 Aug 2017'
 
 from pyorm.db.models.models import Model
 from pyorm.db.models.managers import Manager
-from pyorm.db.models.fields import CharField
+from pyorm.db.models.fields import CharField, IntegerField
+from pyorm.db.models.aggregates import Sum
+from pyorm.db.engine.sqlite import Engine
 
 class DefaultManagerCreation(unittest.TestCase):
     def setUp(self):
@@ -58,6 +61,41 @@ class DefaultManagerCreation(unittest.TestCase):
         self.assertIsInstance(inst.tests,Manager,msg='tests Attribute isn\'t a Manager')
 
 
+class ManagerQuerySetMethods(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        class Item(Model):
+            _engine = self.engine
+            name = CharField()
+            stock = IntegerField()
+
+        self.model = Item
+        self.connection = self.engine.connect()
+        self.engine.create_schema(Item)
+        Item.objects.bulk_create([Item(name='b', stock=2), Item(name='a', stock=3)])
+
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_281_000_aggregate(self):
+        """Test that aggregates & annotations are available without all()"""
+        self.assertEqual(self.model.objects.aggregate(total=Sum('stock')), {'total': 5})
+        self.assertEqual([item.double for item in self.model.objects.annotate(double=Sum('stock')).order_by('name')],
+                         [3, 2])
+
+    def test_281_001_values(self):
+        """Test that values, values_list & order_by are available without all()"""
+        self.assertEqual(list(self.model.objects.order_by('name').values('name')), [{'name': 'a'}, {'name': 'b'}])
+        self.assertEqual(list(self.model.objects.values_list('stock', flat=True).order_by('stock')), [2, 3])
+
+    def test_281_002_defer_only(self):
+        """Test that defer & only are available without all()"""
+        self.assertNotIn('stock', self.model.objects.defer('stock').get(name='a').__dict__)
+        self.assertNotIn('name', self.model.objects.only('stock').get(stock=3).__dict__)
+
+
 def load_tests(loader, tests=None, pattern=None):
     classes = [cls for name, cls in inspect.getmembers(sys.modules[__name__],
                                                        inspect.isclass)
@@ -19,6 +19,10 @@ Test Series
         253 - Model creation with arguments
         254 - Model creation with errors
         255 - Model setting with errors
+    26n_* : test model instance attributes
+        260 - The id attribute
+        261 - Building instances from database rows
+        262 - Dirty field tracking & saving instances
 """
 import inspect
 import sys
@@ -32,6 +36,8 @@ from repeatedtestframework import GenerateTestMethods
 import pyorm.db.models.fields as fields
 from pyorm.core.validators import RegexValidator
 from pyorm.db.models.models import Model
+from pyorm.db.engine.sqlite import Engine
+from pyorm.db.models.managers import Manager
 import pyorm.core.exceptions as exceptions
 
 __version__ = "0.1"
@@ -568,6 +574,164 @@ class TestModelIdAttribute(unittest.TestCase):
         with self.assertRaises(AttributeError):
             inst.id = 18
 
+
+class TestModelRowDecoder(unittest.TestCase):
+    def setUp(self):
+        class TestModel(Model):
+            artist_name = fields.CharField()
+            birth_date = fields.DateField(db_column='birth')
+            death_date = fields.DateField()
+        self.TestModel = TestModel
+
+    def test_261_001_decode_full_row(self):
+        """Test that a row with every column in field order is decoded into an instance"""
+        inst = self.TestModel.from_db(('John Lennon', date(1940, 10, 9), date(1980, 12, 8), 17))
+        self.assertIsInstance(inst, self.TestModel)
+        self.assertEqual((inst.artist_name, inst.birth_date, inst.death_date, inst.id),
+                         ('John Lennon', date(1940, 10, 9), date(1980, 12, 8), 17))
+        self.assertFalse(inst.is_dirty())
+
+    def test_261_002_decode_named_columns(self):
+        """Test that a row with a subset of db_columns is decoded into an instance"""
+        inst = self.TestModel.from_db((17, date(1940, 10, 9)), columns=('id', 'birth'))
+        self.assertEqual((inst.id, inst.birth_date), (17, date(1940, 10, 9)))
+
+    def test_261_003_decoders_cached(self):
+        """Test that the decoder for a set of columns is built once"""
+        self.assertIs(self.TestModel.row_decoder(), self.TestModel.row_decoder(('artist_name', 'birth', 'death_date', 'id')))
+        self.assertIs(self.TestModel.row_decoder(('id', 'birth')), self.TestModel.row_decoder(['id', 'birth']))
+
+    def test_261_004_decode_unknown_column(self):
+        """Test that a decoder can't be built for an unknown column"""
+        with self.assertRaises(exceptions.ColumnError):
+            self.TestModel.row_decoder(('id', 'birth_date'))
+
+    def test_261_005_decoded_not_validated(self):
+        """Test that decoding trusts the database, but the instance still validates changes"""
+        inst = self.TestModel.from_db(('John Lennon', None, None, 17))
+        self.assertFalse(inst.is_dirty())
+        inst.artist_name = 'Paul McCartney'
+        self.assertTrue(inst.is_dirty())
+        with self.assertRaises(AttributeError):
+            inst.id = 18
+        with self.assertRaises(AttributeError):
+            inst.birth_date = 'not a date'
+
+
+class TestModelSave(unittest.TestCase):
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        class Counter(Model):
+            _engine = self.engine
+            name = fields.CharField()
+            body = fields.CharField()
+            hits = fields.IntegerField()
+
+        self.model = Counter
+        self.connection = self.engine.connect()
+        self.engine.create_schema(Counter)
+        self.statements = []
+        execute = self.engine._execute
+
+        def spy(connection, sql, params, many=False):
+            self.statements.append((sql, list(params)))
+            return execute(connection, sql, params, many=many)
+        self.engine._execute = spy
+
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_262_001_new_instance_inserted(self):
+        """Test that a new instance is dirty in every field, and is inserted when saved"""
+        inst = self.model(name='page', body='x' * 1000, hits=0)
+        self.assertTrue(inst.is_dirty())
+        self.assertFalse(inst.is_saved())
+        self.assertEqual(inst.dirty_fields(), {'name', 'body', 'hits', 'id'})
+        self.assertTrue(inst.save())
+        self.assertTrue(inst.id)
+        self.assertFalse(inst.is_dirty())
+        self.assertEqual([sql for sql, params in self.statements if sql.startswith('INSERT')],
+                         ['INSERT INTO Counter ("name", "body", "hits") VALUES (?, ?, ?)'])
+
+    def test_262_002_changed_fields_updated(self):
+        """Test that only the changed fields are written - by the primary key"""
+        self.model(name='page', body='x' * 1000, hits=0).save()
+        inst = self.model.objects.get(name='page')
+        inst.hits = 1
+        self.assertEqual(inst.dirty_fields(), {'hits'})
+        del self.statements[:]
+        self.assertTrue(inst.save())
+        self.assertEqual(self.statements, [('UPDATE Counter SET "hits" = ? WHERE "id" = ?', [1, inst.id])])
+        self.assertFalse(inst.is_dirty())
+        self.assertEqual(self.model.objects.get(id=inst.id).hits, 1)
+
+    def test_262_003_clean_instance_not_written(self):
+        """Test that saving an unchanged instance - or one set to the same values - executes nothing"""
+        self.model(name='page', body='text', hits=0).save()
+        inst = self.model.objects.get(name='page')
+        inst.hits = 0
+        inst.name = 'page'
+        self.assertFalse(inst.is_dirty())
+        del self.statements[:]
+        self.assertFalse(inst.save())
+        self.assertEqual(self.statements, [])
+
+    def test_262_004_save_joins_atomic(self):
+        """Test that a save within an atomic block is rolled back with it"""
+        inst = self.model(name='page', body='text', hits=0)
+        inst.save()
+        with self.assertRaises(RuntimeError):
+            with self.engine.atomic():
+                inst.hits = 5
+                inst.save()
+                raise RuntimeError
+        self.assertEqual(self.model.objects.get(id=inst.id).hits, 0)
+
+    def test_262_005_deleted_instance(self):
+        """Test that saving changes to an instance which was deleted fails"""
+        inst = self.model(name='page', body='text', hits=0)
+        inst.save()
+        self.model.objects.all().delete()
+        inst.hits = 1
+        with self.assertRaises(exceptions.DoesNotExist):
+            inst.save()
+
+    def test_262_006_primary_key_changed(self):
+        """Test that changing the primary key updates the row it was loaded with"""
+        class Code(Model):
+            _engine = self.engine
+            code = fields.CharField(primary=True)
+            label = fields.CharField()
+
+        self.engine.create_schema(Code)
+        Code(code='GB', label='Britain').save()
+        inst = Code.objects.get(code='GB')
+        inst.code = 'UK'
+        inst.code = 'XX'
+        inst.label = 'United Kingdom'
+        self.assertTrue(inst.save())
+        self.assertEqual([(row.code, row.label) for row in Code.objects.all()], [('XX', 'United Kingdom')])
+        inst.label = 'Elsewhere'
+        inst.save()
+        self.assertEqual(Code.objects.get(code='XX').label, 'Elsewhere')
+
+    def test_262_007_custom_manager(self):
+        """Test that instances of a model with a custom manager name are saved through it"""
+        class Tag(Model):
+            _engine = self.engine
+            name = fields.CharField()
+            tags = Manager()
+
+        self.engine.create_schema(Tag)
+        tag = Tag(name='new')
+        tag.save()
+        tag.name = 'renamed'
+        tag.save()
+        self.assertEqual([row.name for row in Tag.tags.all()], ['renamed'])
+
+
 def load_tests(loader, tests=None, pattern=None):
     classes = [cls for name, cls in inspect.getmembers(sys.modules[__name__],
                                                        inspect.isclass)
@@ -18,6 +18,16 @@ Test Suites:
     530 - Query Hierarchy & TableInfo & Join classes
     540 - Query
     550 - Query Sets
+    551 - Query Set execution against a database
+    552 - Bulk creation of instances
+    553 - Selecting related instances in the same query
+    554 - Prefetching related instances
+    555 - Deferred loading of fields
+    556 - Lazy evaluation & caching of Query Sets
+    557 - Aggregation & annotation
+    558 - Bulk updates & deletes
+    559 - Keyset pagination
+    560 - Sessions - the identity map & unit of work
     
 """
 
@@ -30,14 +40,16 @@ import inspect
 from collections import Counter
 from functools import partial
 
-from unittest.mock import MagicMock, Mock, call, sentinel
+from unittest.mock import MagicMock, Mock, call, sentinel, patch
 
 from pyorm.db.models.queryset import F, Q, BaseQuery, OrderingAndLimits, \
     QuerySet, FilterableQuery, RawSQL, Combination, Difference, Union, \
     Intersection, Join, SimpleQuery
 
 from pyorm.db.engine.core import EngineCore
+from pyorm.db.engine.sqlite import Engine
 from pyorm.db.models.models import Model
+from pyorm.db.models.session import Session
 import pyorm.db.models.fields as fields
 import pyorm.core.exceptions as exceptions
 
@@ -311,6 +323,30 @@ class TestQ(unittest.TestCase):
         self.assertEqual(q3._members, [~q1, ~q2])
         self.assertEqual(q3._operator, 'OR')
 
+    def test_510_210_structural_hash(self):
+        """Test that equal Q trees hash equally - and that the hash reflects values, negation and operators"""
+        q1 = Q(name='Tony') & ~Q(age__gt=17)
+        q2 = Q(name='Tony') & ~Q(age__gt=17)
+        self.assertEqual(q1, q2)
+        self.assertEqual(hash(q1), hash(q2))
+        self.assertNotEqual(q1, Q(name='Tony') & Q(age__gt=17))
+        self.assertNotEqual(q1, Q(name='Tony') | ~Q(age__gt=17))
+        self.assertNotEqual(q1, Q(name='Bob') & ~Q(age__gt=17))
+
+    def test_510_211_hash_with_unhashable_values(self):
+        """Test that Q objects with list values can still be hashed and used as keys"""
+        q1 = Q(age__in=[1, 2, 3])
+        self.assertEqual(hash(q1), hash(Q(age__in=[1, 2, 3])))
+        self.assertEqual({q1: 'x'}[Q(age__in=[1, 2, 3])], 'x')
+
+    def test_510_212_hash_is_cached(self):
+        """Test that the hash is computed once and not rebuilt from the repr"""
+        q1 = Q(name='Tony') & Q(age__gt=17)
+        h = hash(q1)
+        with patch.object(Q, '__repr__', side_effect=AssertionError('repr called')):
+            self.assertEqual(hash(q1), h)
+            self.assertEqual(q1, Q(name='Tony') & Q(age__gt=17))
+
 
 class TestQSQL(unittest.TestCase):
     """
@@ -320,14 +356,13 @@ class TestQSQL(unittest.TestCase):
     def setUp(self):
         """Setup Engine Mock and resolve_lookup method"""
 
-        def resolve_lookup( lookup, value, model=None, joins=None):
-            """Dummy resolve__lookup method"""
-            lookup_format = {'name__exact': 'name = {!r}',
-                             'name__gte':'name >= {!r}',
-                             'address__exact':'address={!r}',
-                             'address__contains': 'address like \'%{}%\''}
-            f = lookup_format[lookup]
-            return f.format(value)
+        def resolve_lookup( lookup, value, default_alias='', model=None, joins=None):
+            """Dummy resolve__lookup method - returns the sql fragment and the bound params"""
+            lookup_format = {'name__exact': 'name = ?',
+                             'name__gte':'name >= ?',
+                             'address__exact':'address=?',
+                             'address__contains': 'address like \'%\' || ? || \'%\''}
+            return lookup_format[lookup], [value]
 
         self.test_engine = MagicMock(autospec=EngineCore)
         self.test_engine.resolve_lookup=Mock(side_effect=resolve_lookup)
@@ -338,58 +373,62 @@ class TestQSQL(unittest.TestCase):
         """Test that the lookups in a Q object are executed as expected."""
 
         q1 = Q(name__gte=23)
-        sql = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
+        sql, params = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
 
         # Confirm that the resolve lookup has been called as expected
-        self.test_engine.resolve_lookup.assert_has_calls(calls=[call('name__gte', 23, model=self.test_model, joins=self.joins)])
+        self.test_engine.resolve_lookup.assert_has_calls(calls=[call('name__gte', 23, default_alias='', model=self.test_model, joins=self.joins)])
 
         # Confirm that the expected sql is created
-        self.assertEqual(sql,'(name >= 23)')
+        self.assertEqual(sql,'(name >= ?)')
+        self.assertEqual(params, [23])
 
     def test_510_301_SQL_creation_simple_negated_Q(self):
         """Test that the lookups in a negated Q object are executed as expected."""
 
         q1 = ~Q(name__exact='hello')
 
-        sql = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
+        sql, params = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
 
         # Confirm that the resolve lookup has been called as expected
-        self.test_engine.resolve_lookup.assert_has_calls(calls=[call('name__exact', 'hello', model=self.test_model, joins=self.joins)])
+        self.test_engine.resolve_lookup.assert_has_calls(calls=[call('name__exact', 'hello', default_alias='', model=self.test_model, joins=self.joins)])
 
         # Confirm that the expected sql is created
-        self.assertEqual(sql,'NOT (name = \'hello\')')
+        self.assertEqual(sql,'NOT (name = ?)')
+        self.assertEqual(params, ['hello'])
 
     def test_510_302_SQL_creation_complex_Q(self):
         """Test that the lookups in a complex Q object are executed as expected."""
 
         q1 = Q(name__exact='hello') | Q(address__contains='Brantham')
 
-        sql = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
+        sql, params = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
 
         # Confirm that the resolve lookup has been called as expected
         self.test_engine.resolve_lookup.assert_has_calls(calls=[
-            call('name__exact', 'hello', model=self.test_model, joins=self.joins),
-            call('address__contains', 'Brantham', model=self.test_model, joins=self.joins)])
+            call('name__exact', 'hello', default_alias='', model=self.test_model, joins=self.joins),
+            call('address__contains', 'Brantham', default_alias='', model=self.test_model, joins=self.joins)])
 
         # Confirm that the expected sql is created
-        self.assertEqual(sql, '((name = \'hello\') OR (address like \'%Brantham%\'))')
+        self.assertEqual(sql, '((name = ?) OR (address like \'%\' || ? || \'%\'))')
+        self.assertEqual(params, ['hello', 'Brantham'])
 
     def test_510_303_SQL_creation_complex_Q(self):
         """Test that the lookups in a complex Q with and and or"""
 
         q1 = Q(name__exact='hello', name__gte='Hello') | Q(name__gte='Ipswich')
 
-        sql = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
+        sql, params = q1.resolve(engine=self.test_engine, model=self.test_model, joins=self.joins)
 
         # Confirm that the resolve lookup has been called as expected
         self.test_engine.resolve_lookup.assert_has_calls(calls=[
-            call('name__exact', 'hello', model=self.test_model, joins=self.joins),
-            call('name__gte', 'Hello', model=self.test_model, joins=self.joins),
-            call('name__gte', 'Ipswich', model=self.test_model, joins=self.joins)],
+            call('name__exact', 'hello', default_alias='', model=self.test_model, joins=self.joins),
+            call('name__gte', 'Hello', default_alias='', model=self.test_model, joins=self.joins),
+            call('name__gte', 'Ipswich', default_alias='', model=self.test_model, joins=self.joins)],
             any_order = True)
 
         # Confirm that the expected sql is created
-        self.assertEqual(sql, '((name = \'hello\' AND name >= \'Hello\') OR (name >= \'Ipswich\'))')
+        self.assertEqual(sql, '((name = ? AND name >= ?) OR (name >= ?))')
+        self.assertEqual(params, ['hello', 'Hello', 'Ipswich'])
 
 
 class TestF(unittest.TestCase):
@@ -722,12 +761,30 @@ class TestF(unittest.TestCase):
         self.assertIsInstance(f1, F)
         self.assertEqual(f1, -(F('x') + F('y')))
 
+    def test_520_080_structural_hash(self):
+        """Test that equal expressions hash equally - and that negated copies don't share the cached hash"""
+        f = F('x') + F('y') * 2
+        self.assertEqual(hash(f), hash(F('x') + F('y') * 2))
+        self.assertNotEqual(hash(f), hash(-f))
+        self.assertNotEqual(f, -f)
+        self.assertEqual(+(-f), f)
+        self.assertEqual(hash(+(-f)), hash(f))
+        self.assertNotEqual(f, F('x') + F('y') * 3)
+
+    def test_520_081_lazy_structural_hash(self):
+        """Test that Lazy objects compare and hash on their class, args and kwargs"""
+        self.assertEqual(Count('id', distinct=True), Count('id', distinct=True))
+        self.assertEqual(hash(Count('id', distinct=True)), hash(Count('id', distinct=True)))
+        self.assertNotEqual(Count('id'), Sum('id'))
+        self.assertNotEqual(Count('id'), Count('id', distinct=True))
+        self.assertEqual(hash(Annotation(['a', 'b'])), hash(Annotation(['a', 'b'])))
+
 
 class TestFSQL(unittest.TestCase):
 
     def setUp(self):
 
-        def resolve(field, engine=None, model=None, joins=None):
+        def resolve(field, default_alias='', engine=None, model=None, joins=None):
             """Naive field name resolution method - we only case that the SQL uses the column name that this method returns"""
             c_name =  field + '_column'
             joins.append(field + '_join')
@@ -744,20 +801,21 @@ class TestFSQL(unittest.TestCase):
            The Engine resolve method is mocked out - what we care is that the engine is called.
         """
         f = F('name')
-        sql = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
+        sql, params = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
 
-        self.engine.resolve_name.assert_called_once_with('name', model=self.model, joins=self.joins)
+        self.engine.resolve_name.assert_called_once_with('name', default_alias='', model=self.model, joins=self.joins)
         self.assertEqual(sql, 'name_column')
+        self.assertEqual(params, [])
         self.assertEqual(self.joins, ['name_join'])
 
     def test_520_101_sql_creation_additive_F_object(self):
         """Test SQL generation for a additive F object"""
         f = F('name') + F('age')
 
-        sql = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
+        sql, params = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
 
-        self.engine.resolve_name.assert_has_calls(calls=[call('name',model=self.model, joins=self.joins),
-                                                         call('age',model=self.model, joins=self.joins),])
+        self.engine.resolve_name.assert_has_calls(calls=[call('name', default_alias='', model=self.model, joins=self.joins),
+                                                         call('age', default_alias='', model=self.model, joins=self.joins),])
         self.assertEqual(sql, '(name_column+age_column)')
         self.assertEqual(Counter(self.joins), Counter(['name_join','age_join']))
 
@@ -765,29 +823,30 @@ class TestFSQL(unittest.TestCase):
         """Test SQL generation of F object with a constant"""
 
         f = F('name') * 23
-        sql = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
+        sql, params = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
 
         # Confirm correct SQL is created
-        self.assertEqual(sql, '(name_column*23)')
+        self.assertEqual(sql, '(name_column*?)')
+        self.assertEqual(params, [23])
 
         # Confirm that the right engine method is called as expected
-        self.engine.resolve_name.assert_has_calls(calls=[call('name',model=self.model, joins=self.joins),])
+        self.engine.resolve_name.assert_has_calls(calls=[call('name', default_alias='', model=self.model, joins=self.joins),])
         self.assertEqual(Counter(self.joins), Counter(['name_join']))
 
     def test_520_103_sql_creation_complex_F_object(self):
         """Test F object sql creation with multi-layer F object"""
 
         f = (F('name') + F('age')) * F('salary')
-        sql = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
+        sql, params = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
 
         # Confirm correct SQL is created
         self.assertEqual(sql, '((name_column+age_column)*salary_column)')
 
         # Confirm that the right engine method is called as expected
         self.engine.resolve_name.assert_has_calls(
-                calls=[call('name',model=self.model, joins=self.joins),
-                        call('age',model=self.model, joins=self.joins),
-                        call('salary',model=self.model, joins=self.joins),])
+                calls=[call('name', default_alias='', model=self.model, joins=self.joins),
+                        call('age', default_alias='', model=self.model, joins=self.joins),
+                        call('salary', default_alias='', model=self.model, joins=self.joins),])
 
         # Confirm that the join data from the resolve method is being returned.
         self.assertEqual(Counter(self.joins),
@@ -797,16 +856,16 @@ class TestFSQL(unittest.TestCase):
         """Test SQL creation with multi-layer F object """
 
         f = F('salary') + F('salary') * F('bonus_rate')
-        sql = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
+        sql, params = f.resolve(engine=self.engine, model=self.model, joins=self.joins)
 
         # Confim the right SQL is generated - and the right joins are recorded
         self.assertEqual(sql, '(salary_column+(salary_column*bonus_rate_column))')
 
         # Confirm that the right engine method is called as expected
         self.engine.resolve_name.assert_has_calls(
-                calls=[call('salary',model=self.model, joins=self.joins),
-                        call('bonus_rate',model=self.model, joins=self.joins),
-                        call('salary',model=self.model, joins=self.joins),],
+                calls=[call('salary', default_alias='', model=self.model, joins=self.joins),
+                        call('bonus_rate', default_alias='', model=self.model, joins=self.joins),
+                        call('salary', default_alias='', model=self.model, joins=self.joins),],
                 any_order=True)
 
         self.assertEqual(Counter(self.joins), Counter(['salary_join', 'salary_join','bonus_rate_join']))
@@ -1388,6 +1447,23 @@ class TestJoin(unittest.TestCase):
         self.assertEqual(node.relation, 'ModelA__owner__orders')
         self.assertEqual(node.fields, ('orderid', 'id'))
 
+    def test_530_505_join_extends_existing_node(self):
+        """Test that a deeper relation extends the existing node - rather than replacing it"""
+        j = Join(root_model=self.modelA)
+        owner = j.addJoin('owner')
+        orders = j.addJoin('owner__orders')
+
+        self.assertIs(j.addJoin('owner'), owner)
+        self.assertIs(orders.parent, owner)
+        self.assertEqual(list(owner.children.values()), [orders])
+        self.assertEqual(self.modelA.get_relationship.call_count, 1)
+
+    def test_530_506_join_unknown_relation(self):
+        """Test that a relation which doesn't exist is rejected"""
+        j = Join(root_model=self.modelA)
+        with self.assertRaises(exceptions.JoinError):
+            j.addJoin('owner__nothing')
+
     def test_530_510_create_from_tuple(self):
         """Test creation of joins from tuples - single join"""
         j = Join(root_model=self.modelA)
@@ -1847,6 +1923,1089 @@ class TestQuerySet(unittest.TestCase):
             qs2._fields)
 
 
+class TestQuerySetExecution(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Person(Model):
+            _engine = self.engine
+            name = fields.CharField(db_column='full_name')
+            age = fields.IntegerField()
+
+        self.model = Person
+
+        # Holding a connection keeps the in memory database open for the test
+        self.connection = self.engine.connect()
+        self.connection.execute('CREATE TABLE Person (id integer PRIMARY KEY, full_name text, age integer);')
+        self.connection.executemany('INSERT INTO Person(full_name, age) VALUES (?,?);',
+                                    [('Person {}'.format(i), i) for i in range(10)])
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_551_000_iterator_models(self):
+        """Test that the iterator returns model instances across several chunks"""
+        people = list(self.model.objects.iterator(chunk_size=3))
+        self.assertEqual(len(people), 10)
+        self.assertTrue(all(isinstance(person, self.model) for person in people))
+        self.assertEqual([(p.id, p.name, p.age) for p in people[:2]], [(1, 'Person 0', 0), (2, 'Person 1', 1)])
+
+    def test_551_001_fetch_chunks(self):
+        """Test that rows are fetched in chunks no bigger than the chunk size"""
+        chunks = list(self.engine.fetch('SELECT id FROM Person', chunk_size=3))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 3, 1])
+        with self.assertRaises(ValueError):
+            list(self.engine.fetch('SELECT id FROM Person', chunk_size=0))
+
+    def test_551_002_iterator_filtered(self):
+        """Test that the iterator applies the query criteria"""
+        people = self.model.objects.filter(age__gte=5).exclude(age=7).iterator(chunk_size=2)
+        self.assertEqual([p.age for p in people], [5, 6, 8, 9])
+
+    def test_551_003_iterator_values(self):
+        """Test that the iterator returns dictionaries keyed by field name for values()"""
+        rows = list(QuerySet(model=self.model).filter(age__lt=2).values('name').iterator())
+        self.assertEqual(rows, [{'name': 'Person 0'}, {'name': 'Person 1'}])
+
+        rows = list(QuerySet(model=self.model).filter(age=0).values().iterator())
+        self.assertEqual(rows, [{'id': 1, 'name': 'Person 0', 'age': 0}])
+
+    def test_551_004_iterator_values_list(self):
+        """Test that the iterator returns tuples or single values for values_list()"""
+        qs = QuerySet(model=self.model).filter(age__lt=2)
+        self.assertEqual(list(qs.values_list('name', 'age').iterator()), [('Person 0', 0), ('Person 1', 1)])
+        self.assertEqual(list(qs.values_list('age', flat=True).iterator(chunk_size=1)), [0, 1])
+
+    def test_551_006_dates(self):
+        """Test that dates() compiles to native SQL and returns distinct, ordered dates"""
+        self.connection.execute('CREATE TABLE Event (id integer PRIMARY KEY, day date, at timestamp);')
+        self.connection.executemany('INSERT INTO Event(day, at) VALUES (?,?);',
+                                    [(datetime.date(2012, 11, 19), datetime.datetime(2017, 6, 13, 13, 34, 9)),
+                                     (datetime.date(2012, 2, 1), datetime.datetime(2017, 6, 13, 13, 4, 1)),
+                                     (datetime.date(2010, 9, 17), datetime.datetime(2016, 11, 5, 22, 55, 59))])
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Event(Model):
+            _engine = self.engine
+            day = fields.DateField()
+            at = fields.DateTimeField()
+
+        qs = QuerySet(model=Event).dates('day', 'years')
+        sql, params = self.engine.compile(qs.query)
+        self.assertNotIn('TruncYear', sql)
+        self.assertEqual(list(qs.iterator()), [datetime.date(2010, 1, 1), datetime.date(2012, 1, 1)])
+        self.assertEqual(list(QuerySet(model=Event).dates('day', 'months', order='DESC').iterator()),
+                         [datetime.date(2012, 11, 1), datetime.date(2012, 2, 1), datetime.date(2010, 9, 1)])
+        self.assertEqual(list(QuerySet(model=Event).datetimes('at', 'hours').iterator()),
+                         [datetime.datetime(2016, 11, 5, 22), datetime.datetime(2017, 6, 13, 13)])
+
+    def test_551_008_datetimes_each_kind(self):
+        """Test that datetimes() parses every kind of truncation - natively and through the registered functions"""
+        self.connection.execute('CREATE TABLE Event (id integer PRIMARY KEY, at timestamp);')
+        self.connection.executemany('INSERT INTO Event(at) VALUES (?);',
+                                    [(datetime.datetime(2017, 6, 13, 13, 34, 9),), (datetime.datetime(2016, 11, 5, 22, 55, 59),)])
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Event(Model):
+            _engine = self.engine
+            at = fields.DateTimeField()
+
+        expected = {'years': [datetime.datetime(2016, 1, 1), datetime.datetime(2017, 1, 1)],
+                    'months': [datetime.datetime(2016, 11, 1), datetime.datetime(2017, 6, 1)],
+                    'days': [datetime.datetime(2016, 11, 5), datetime.datetime(2017, 6, 13)],
+                    'hours': [datetime.datetime(2016, 11, 5, 22), datetime.datetime(2017, 6, 13, 13)],
+                    'minutes': [datetime.datetime(2016, 11, 5, 22, 55), datetime.datetime(2017, 6, 13, 13, 34)],
+                    'seconds': [datetime.datetime(2016, 11, 5, 22, 55, 59), datetime.datetime(2017, 6, 13, 13, 34, 9)]}
+        for native in (True, False):
+            with patch.dict(Engine._native_functions, clear=not native):
+                for kind, datetimes in expected.items():
+                    with self.subTest(kind=kind, native=native):
+                        self.assertEqual(list(QuerySet(model=Event).datetimes('at', kind).iterator()), datetimes)
+
+    def test_551_005_iterator_releases_connection(self):
+        """Test that the connection is released when the iterator is finished with - even if not exhausted"""
+        in_use = self.engine.pool_stats().in_use
+        people = self.model.objects.iterator(chunk_size=3)
+        next(people)
+        people.close()
+        self.assertEqual(self.connection._refs, 1)
+        self.assertEqual(self.engine.pool_stats().in_use, in_use)
+        self.assertIsNone(QuerySet(model=self.model)._cache)
+
+    def test_551_007_order_by_and_reverse(self):
+        """Test that order_by replaces the ordering - and reverse inverts it"""
+        qs = self.model.objects.all().order_by('-age').order_by('age')
+        self.assertEqual(qs.query.order_by, ['age'])
+        self.assertEqual([p.age for p in qs.reverse().iterator()], list(range(9, -1, -1)))
+        self.assertEqual(qs.order_by().query.order_by, [])
+
+
+class TestBulkCreate(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Person(Model):
+            _engine = self.engine
+            name = fields.CharField(db_column='full_name')
+            age = fields.IntegerField()
+
+        self.model = Person
+        self.connection = self.engine.connect()
+        self.connection.execute('CREATE TABLE Person (id integer PRIMARY KEY, full_name text UNIQUE, age integer);')
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def _rows(self):
+        return [tuple(row) for row in self.connection.execute('SELECT id, full_name, age FROM Person ORDER BY id')]
+
+    def test_552_000_bulk_create(self):
+        """Test that bulk_create inserts every instance and returns the allocated primary keys"""
+        people = [self.model(name='Person {}'.format(i), age=i) for i in range(5)]
+        pks = self.model.objects.bulk_create(people)
+        self.assertEqual(pks, [1, 2, 3, 4, 5])
+        self.assertEqual([p.id for p in people], pks)
+        self.assertFalse(any(p.is_dirty() for p in people))
+        self.assertEqual(self._rows(), [(i + 1, 'Person {}'.format(i), i) for i in range(5)])
+
+    def test_552_001_bulk_create_batches(self):
+        """Test that rows are batched into multi-row statements no larger than the limit on bound parameters"""
+        statements = []
+        execute = self.engine._execute
+
+        def spy(connection, sql, params, many=False):
+            statements.append((sql.count('?'), len(params) if many else 1))
+            return execute(connection, sql, params, many=many)
+
+        people = [self.model(name='Person {}'.format(i), age=i) for i in range(25)]
+        with patch.object(self.engine, '_execute', side_effect=spy), \
+                patch.object(self.engine, 'max_variables', return_value=20):
+            pks = self.model.objects.bulk_create(people)
+
+        self.assertEqual(pks, list(range(1, 26)))
+        self.assertIn((20, 2), statements)           # 2 statements of 10 rows by executemany
+        self.assertIn((10, 1), statements)           # The remaining 5 rows
+
+        self.model.objects.bulk_create([self.model(name='Batched {}'.format(i), age=i) for i in range(7)],
+                                       batch_size=3)
+        self.assertEqual(len(self._rows()), 32)
+
+    def test_552_002_bulk_create_explicit_keys(self):
+        """Test that instances with primary keys keep them - others are allocated keys"""
+        people = [self.model(name='Explicit', age=1, id=100), self.model(name='Allocated', age=2)]
+        self.assertEqual(self.model.objects.bulk_create(people), [100, 101])
+        self.assertEqual(self._rows(), [(100, 'Explicit', 1), (101, 'Allocated', 2)])
+
+    def test_552_003_bulk_create_single_transaction(self):
+        """Test that a failure part way through inserts nothing"""
+        people = [self.model(name='Person {}'.format(i % 3), age=i) for i in range(5)]
+        with self.assertRaises(Exception):
+            self.model.objects.bulk_create(people, batch_size=2)
+        self.assertEqual(self._rows(), [])
+        self.assertFalse(self.connection.in_transaction)
+
+    def test_552_004_bulk_create_invalid(self):
+        """Test that bulk_create only accepts instances of the model"""
+        with self.assertRaises(TypeError):
+            self.model.objects.bulk_create([{'name': 'Tony'}])
+        with self.assertRaises(ValueError):
+            self.model.objects.bulk_create([self.model(name='Tony')], batch_size=0)
+        self.assertEqual(self.model.objects.bulk_create([]), [])
+
+
+class TestSelectRelated(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Publisher(Model):
+            _engine = self.engine
+            name = fields.CharField()
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Author(Model):
+            _engine = self.engine
+            name = fields.CharField()
+            publisher = fields.ForeignKey(Publisher)
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Book(Model):
+            _engine = self.engine
+            _order_by = ['id']
+            title = fields.CharField()
+            author = fields.ForeignKey('Author')
+
+        self.Publisher, self.Author, self.Book = Publisher, Author, Book
+        self.connection = self.engine.connect()
+        self.connection.executescript('''
+            CREATE TABLE Publisher (id integer PRIMARY KEY, name text);
+            CREATE TABLE Author (id integer PRIMARY KEY, name text, publisher_id integer);
+            CREATE TABLE Book (id integer PRIMARY KEY, title text, author_id integer);
+            INSERT INTO Publisher VALUES (1, 'Penguin');
+            INSERT INTO Author VALUES (1, 'Austen', 1), (2, 'Anonymous', NULL);
+            INSERT INTO Book VALUES (1, 'Emma', 1), (2, 'Persuasion', 1), (3, 'Beowulf', 2), (4, 'Draft', NULL);
+        ''')
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_553_000_foreign_key_field(self):
+        """Test the ForeignKey column name and relationship"""
+        self.assertEqual(self.Book.db_field_by_name('author').db_column, 'author_id')
+        self.assertEqual(self.Book.get_relationship('author'), (self.Author, 'author_id', 'id'))
+        self.assertIsNone(self.Book.get_relationship('title'))
+        self.assertEqual(self.Book.dependencies(), [self.Author])
+
+    def test_553_001_select_related_sql(self):
+        """Test that the related model's columns are selected through a join"""
+        sql, params = self.engine.compile(self.Book.objects.select_related('author').query)
+        self.assertIn('LEFT OUTER JOIN Author Book__author ON Book.author_id = Book__author.id', sql)
+        self.assertIn('Book__author."name" AS "author__name"', sql)
+        self.assertIn('Book__author."publisher_id" AS "author__publisher_id"', sql)
+
+    def test_553_002_select_related_hydration(self):
+        """Test that each instance has its related instance attached - in a single query"""
+        statements = []
+        execute = self.engine._execute
+
+        def spy(connection, sql, params, many=False):
+            statements.append(sql)
+            return execute(connection, sql, params, many=many)
+
+        with patch.object(self.engine, '_execute', side_effect=spy):
+            books = list(self.Book.objects.select_related('author').iterator())
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([book.title for book in books], ['Emma', 'Persuasion', 'Beowulf', 'Draft'])
+        self.assertIsInstance(books[0].author, self.Author)
+        self.assertEqual((books[0].author.id, books[0].author.name), (1, 'Austen'))
+        self.assertEqual(books[2].author.name, 'Anonymous')
+        self.assertIsNone(books[3].author)
+        self.assertFalse(any(book.is_dirty() or (book.author and book.author.is_dirty()) for book in books))
+
+    def test_553_003_select_related_nested(self):
+        """Test that a relation path selects every model along the path"""
+        qs = self.Book.objects.select_related('author__publisher')
+        self.assertEqual(qs.query.joins, ['author', 'author__publisher'])
+        books = list(qs.iterator())
+        self.assertEqual(books[0].author.publisher.name, 'Penguin')
+        self.assertIsNone(books[2].author.publisher)
+        self.assertIsNone(books[3].author)
+
+    def test_553_004_select_related_all_and_clear(self):
+        """Test that select_related with no names follows every ForeignKey - and None clears the relations"""
+        qs = self.Book.objects.select_related()
+        self.assertEqual(qs.query.joins, ['author'])
+        self.assertEqual(qs.select_related(None).query.joins, [])
+        self.assertEqual([book.author for book in qs.select_related(None).iterator()], [1, 1, 2, None])
+        self.assertEqual(qs.values('title').query.joins, [])
+
+    def test_553_005_select_related_filtered(self):
+        """Test that select_related combines with filters across the same relation"""
+        books = list(self.Book.objects.select_related('author').filter(author__name='Austen').iterator())
+        self.assertEqual([(book.title, book.author.name) for book in books], [('Emma', 'Austen'),
+                                                                              ('Persuasion', 'Austen')])
+
+    def test_553_006_select_related_invalid(self):
+        """Test that an unknown relation is rejected"""
+        with self.assertRaises(exceptions.JoinError):
+            self.Book.objects.select_related('title')
+        with self.assertRaises(exceptions.JoinError):
+            self.Book.objects.select_related('author__nothing')
+
+    def test_553_007_save_related_instance(self):
+        """Test that a related instance is stored by its key"""
+        author = self.Author.objects.select_related().filter(id=1)
+        austen = next(author.iterator())
+        self.Book.objects.bulk_create([self.Book(title='Sanditon', author=austen)])
+        self.assertEqual(tuple(self.connection.execute('SELECT author_id FROM Book WHERE title = ?',
+                                                        ('Sanditon',)).fetchone()), (1,))
+
+
+class TestPrefetchRelated(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Author(Model):
+            _engine = self.engine
+            _order_by = ['id']
+            name = fields.CharField()
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Book(Model):
+            _engine = self.engine
+            _order_by = ['id']
+            title = fields.CharField()
+            author = fields.ForeignKey(Author, related_name='books')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Review(Model):
+            _engine = self.engine
+            _order_by = ['id']
+            stars = fields.IntegerField()
+            book = fields.ForeignKey(Book)
+
+        self.Author, self.Book, self.Review = Author, Book, Review
+        self.connection = self.engine.connect()
+        self.connection.executescript('''
+            CREATE TABLE Author (id integer PRIMARY KEY, name text);
+            CREATE TABLE Book (id integer PRIMARY KEY, title text, author_id integer);
+            CREATE TABLE Review (id integer PRIMARY KEY, stars integer, book_id integer);
+            INSERT INTO Author VALUES (1, 'Austen'), (2, 'Bronte'), (3, 'Nobody');
+            INSERT INTO Book VALUES (1, 'Emma', 1), (2, 'Persuasion', 1), (3, 'Shirley', 2), (4, 'Draft', NULL);
+            INSERT INTO Review VALUES (1, 5, 1), (2, 4, 1), (3, 3, 3);
+        ''')
+
+        self.statements = []
+        execute = self.engine._execute
+
+        def spy(connection, sql, params, many=False):
+            self.statements.append((sql, params))
+            return execute(connection, sql, params, many=many)
+
+        patcher = patch.object(self.engine, '_execute', side_effect=spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_554_000_reverse_relationships(self):
+        """Test that ForeignKeys referencing a model are found as reverse relations"""
+        self.assertEqual(self.Author.reverse_relationships(), {'books': self.Book.db_field_by_name('author')})
+        self.assertEqual(self.Book.reverse_relationships(), {'review_set': self.Review.db_field_by_name('book')})
+
+    def test_554_001_prefetch_reverse(self):
+        """Test that a reverse relation is fetched for every instance in one query"""
+        authors = list(self.Author.objects.prefetch_related('books').iterator())
+        self.assertEqual(len(self.statements), 2)
+        self.assertIn('IN (?, ?, ?)', self.statements[1][0])
+        self.assertEqual([[book.title for book in author.books] for author in authors],
+                         [['Emma', 'Persuasion'], ['Shirley'], []])
+        self.assertIs(authors[0].books[0].author, authors[0])
+
+    def test_554_002_prefetch_forward(self):
+        """Test that a ForeignKey is fetched for every instance in one query - each key only once"""
+        books = list(self.Book.objects.prefetch_related('author').iterator())
+        self.assertEqual(len(self.statements), 2)
+        self.assertEqual(self.statements[1][1], [1, 2])
+        self.assertEqual([book.author.name if book.author else None for book in books],
+                         ['Austen', 'Austen', 'Bronte', None])
+        self.assertIs(books[0].author, books[1].author)
+
+    def test_554_003_prefetch_nested(self):
+        """Test that each step of a relation path is fetched once"""
+        authors = list(self.Author.objects.prefetch_related('books', 'books__review_set').iterator())
+        self.assertEqual(len(self.statements), 3)
+        self.assertEqual([review.stars for review in authors[0].books[0].review_set], [5, 4])
+        self.assertEqual(authors[0].books[1].review_set, [])
+        self.assertEqual([review.stars for review in authors[1].books[0].review_set], [3])
+
+    def test_554_004_prefetch_batched(self):
+        """Test that the keys are batched under the limit on bound parameters"""
+        with patch.object(self.engine, 'max_variables', return_value=2):
+            authors = list(self.Author.objects.prefetch_related('books').iterator())
+        self.assertEqual([params for sql, params in self.statements[1:]], [[1, 2], [3]])
+        self.assertEqual([len(author.books) for author in authors], [2, 1, 0])
+
+    def test_554_005_prefetch_per_chunk(self):
+        """Test that the relations are fetched for each chunk streamed by iterator"""
+        authors = list(self.Author.objects.prefetch_related('books').iterator(chunk_size=2))
+        self.assertEqual([len(author.books) for author in authors], [2, 1, 0])
+        self.assertEqual([params for sql, params in self.statements[1:]], [[1, 2], [3]])
+
+    def test_554_006_prefetch_invalid_and_clear(self):
+        """Test that unknown relations are rejected - and None clears the lookups"""
+        with self.assertRaises(exceptions.JoinError):
+            self.Author.objects.prefetch_related('nothing')
+        qs = self.Author.objects.prefetch_related('books')
+        self.assertEqual(qs._related, ['books'])
+        self.assertEqual(qs.prefetch_related(None)._related, [])
+
+
+class TestDeferredFields(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Document(Model):
+            _engine = self.engine
+            _order_by = ['id']
+            title = fields.CharField()
+            body = fields.CharField(db_column='content')
+            size = fields.IntegerField()
+
+        self.model = Document
+        self.connection = self.engine.connect()
+        self.connection.execute('CREATE TABLE Document (id integer PRIMARY KEY, title text, content text, size integer);')
+        self.connection.executemany('INSERT INTO Document (title, content, size) VALUES (?, ?, ?)',
+                                    [('Doc {}'.format(i), 'Body {}'.format(i) * 100, i) for i in range(5)])
+
+        self.statements = []
+        execute = self.engine._execute
+
+        def spy(connection, sql, params, many=False):
+            self.statements.append((sql, params))
+            return execute(connection, sql, params, many=many)
+
+        patcher = patch.object(self.engine, '_execute', side_effect=spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_555_000_defer_sql(self):
+        """Test that deferred fields are left out of the SELECT - and that the primary key can't be deferred"""
+        qs = self.model.objects.all().defer('body', 'id')
+        self.assertEqual(qs._defered, ['body'])
+        self.assertEqual(qs.query.fields, ['title', 'size', 'id'])
+        sql, params = self.engine.compile(qs.query)
+        self.assertNotIn('content', sql)
+
+    def test_555_001_only_sql(self):
+        """Test that only selects the named fields and the primary key"""
+        qs = self.model.objects.all().only('title')
+        self.assertEqual(qs._defered, ['body', 'size'])
+        self.assertEqual(qs.query.fields, ['title', 'id'])
+        self.assertEqual(qs.defer(None).query.fields, ['title', 'content', 'size', 'id'])
+
+    def test_555_002_deferred_loaded_on_access(self):
+        """Test that a deferred field is loaded on first access - for every instance in one query"""
+        docs = list(self.model.objects.all().defer('body').iterator())
+        self.assertEqual(len(self.statements), 1)
+        self.assertNotIn('body', docs[0].__dict__)
+
+        self.assertEqual(docs[3].body, 'Body 3' * 100)
+        self.assertEqual(len(self.statements), 2)
+        self.assertEqual(self.statements[1][1], [1, 2, 3, 4, 5])
+        self.assertEqual([doc.body for doc in docs], ['Body {}'.format(i) * 100 for i in range(5)])
+        self.assertEqual(len(self.statements), 2)
+        self.assertFalse(any(doc.is_dirty() for doc in docs))
+
+    def test_555_003_deferred_each_field_separately(self):
+        """Test that only the field accessed is loaded"""
+        docs = list(self.model.objects.all().only('title').iterator())
+        self.assertEqual(docs[0].size, 0)
+        self.assertNotIn('body', docs[0].__dict__)
+        self.assertIn('"size"', self.statements[1][0])
+        self.assertNotIn('content', self.statements[1][0])
+
+    def test_555_004_deferred_loaded_per_chunk(self):
+        """Test that deferred fields are loaded for the chunk the instance was fetched in"""
+        docs = list(self.model.objects.all().defer('body').iterator(chunk_size=2))
+        self.assertEqual(docs[4].body, 'Body 4' * 100)
+        self.assertEqual(self.statements[-1][1], [5])
+
+    def test_555_005_deferred_set_before_access(self):
+        """Test that setting a deferred field doesn't load it - and it is then dirty"""
+        doc = next(self.model.objects.all().defer('body').iterator())
+        doc.body = 'New'
+        self.assertEqual(doc.body, 'New')
+        self.assertTrue(doc.is_dirty())
+        self.assertEqual(len(self.statements), 1)
+
+    def test_555_006_deferred_deleted_row(self):
+        """Test that loading a deferred field of an instance whose row was deleted fails"""
+        doc = next(self.model.objects.all().defer('body').iterator())
+        self.connection.execute('DELETE FROM Document WHERE id = 1')
+        with self.assertRaises(exceptions.DoesNotExist):
+            doc.body
+
+    def test_555_007_defer_unknown_field(self):
+        """Test that only fields on the model can be deferred"""
+        with self.assertRaises(AttributeError):
+            self.model.objects.all().defer('nothing')
+        with self.assertRaises(AttributeError):
+            self.model.objects.all().only('nothing')
+
+
+class TestQuerySetEvaluation(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Person(Model):
+            _engine = self.engine
+            _order_by = ['id']
+            name = fields.CharField()
+            age = fields.IntegerField()
+
+        self.model = Person
+        self.connection = self.engine.connect()
+        self.connection.execute('CREATE TABLE Person (id integer PRIMARY KEY, name text, age integer);')
+        self.connection.executemany('INSERT INTO Person(name, age) VALUES (?,?);',
+                                    [('Person {}'.format(i), i) for i in range(10)])
+
+        self.statements = []
+        execute = self.engine._execute
+
+        def spy(connection, sql, params, many=False):
+            self.statements.append((sql, params))
+            return execute(connection, sql, params, many=many)
+
+        patcher = patch.object(self.engine, '_execute', side_effect=spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_556_000_lazy(self):
+        """Test that building a query set executes nothing"""
+        qs = self.model.objects.filter(age__gte=5).order_by('-age')
+        self.assertEqual(self.statements, [])
+        self.assertEqual([p.age for p in qs], [9, 8, 7, 6, 5])
+        self.assertEqual(len(self.statements), 1)
+
+    def test_556_001_cached(self):
+        """Test that the query is executed once - iteration, len and bool reuse the results"""
+        qs = self.model.objects.all()
+        self.assertEqual(len(qs), 10)
+        self.assertTrue(qs)
+        people = list(qs)
+        self.assertEqual([p.id for p in qs], list(range(1, 11)))
+        self.assertIs(list(qs)[0], people[0])
+        self.assertEqual(qs[3].age, 3)
+        self.assertEqual(len(self.statements), 1)
+
+    def test_556_002_clone_not_cached(self):
+        """Test that a query set derived from an evaluated query set executes its own query"""
+        qs = self.model.objects.all()
+        list(qs)
+        self.assertEqual(len(qs.filter(age__lt=3)), 3)
+        self.assertEqual(len(self.statements), 2)
+
+    def test_556_003_empty(self):
+        """Test that bool is False for no results - and none() executes nothing"""
+        self.assertFalse(self.model.objects.filter(age__gt=100))
+        self.assertEqual(len(self.model.objects.all().none()), 0)
+        self.assertEqual(len(self.statements), 1)
+
+    def test_556_004_slice_limits(self):
+        """Test that slicing an unevaluated query set compiles to LIMIT & OFFSET"""
+        qs = self.model.objects.all()[2:5]
+        self.assertIsInstance(qs, QuerySet)
+        self.assertEqual(qs.query.limits, [3, 2])
+        self.assertEqual([p.age for p in qs], [2, 3, 4])
+        self.assertIn('LIMIT ? OFFSET ?', self.statements[0][0])
+        self.assertEqual(self.statements[0][1][-2:], [3, 2])
+
+        self.assertEqual(self.model.objects.all()[:4].query.limits, [4])
+        self.assertEqual([p.age for p in self.model.objects.all()[7:]], [7, 8, 9])
+
+    def test_556_005_slice_of_slice(self):
+        """Test that slicing a sliced query set stays within the first slice"""
+        qs = self.model.objects.all()[2:8]
+        self.assertEqual(qs[1:3].query.limits, [2, 3])
+        self.assertEqual(qs[4:].query.limits, [2, 6])
+        self.assertEqual([p.age for p in qs[4:]], [6, 7])
+        self.assertEqual(qs[10:].query.limits, [0, 8])
+
+    def test_556_006_index(self):
+        """Test that an index executes a query for a single row"""
+        self.assertEqual(self.model.objects.all()[4].age, 4)
+        self.assertEqual(self.statements[0][1][-2:], [1, 4])
+        with self.assertRaises(IndexError):
+            self.model.objects.all()[20]
+        with self.assertRaises(ValueError):
+            self.model.objects.all()[-1]
+        with self.assertRaises(TypeError):
+            self.model.objects.all()['a']
+
+    def test_556_007_step(self):
+        """Test that a slice with a step executes the query and returns a list"""
+        self.assertEqual([p.age for p in self.model.objects.all()[1:6:2]], [1, 3, 5])
+
+    def test_556_008_get(self):
+        """Test that get returns a single instance - and fails for none or many"""
+        self.assertEqual(self.model.objects.get(name='Person 3').age, 3)
+        self.assertEqual(self.statements[0][1][-1], 2)
+        with self.assertRaises(exceptions.DoesNotExist):
+            self.model.objects.get(name='Nobody')
+        with self.assertRaises(exceptions.MultipleObjects):
+            self.model.objects.filter(age__lt=5).get()
+
+    def test_556_009_count(self):
+        """Test that count is compiled to SELECT COUNT(*) - with the criteria, and without the ordering"""
+        qs = self.model.objects.filter(age__gte=4).order_by('-age')
+        self.assertEqual(qs.count(), 6)
+        self.assertEqual(self.statements[0], ('SELECT COUNT(*) FROM Person Person WHERE (Person."age" >= ?)', [4]))
+        self.assertEqual(self.model.objects.count(), 10)
+
+    def test_556_010_count_wrapped(self):
+        """Test that counting a sliced or DISTINCT query set counts the rows the query returns"""
+        self.assertEqual(self.model.objects.all()[3:6].count(), 3)
+        self.assertEqual(self.model.objects.all()[8:20].count(), 2)
+        self.assertIn('FROM (SELECT', self.statements[0][0])
+        self.connection.execute('INSERT INTO Person(name, age) VALUES (?,?)', ('Person 1', 1))
+        self.assertEqual(self.model.objects.all().values_list('name', 'age').distinct().count(), 10)
+
+    def test_556_011_exists(self):
+        """Test that exists probes for a single row"""
+        self.assertTrue(self.model.objects.filter(age=3).exists())
+        self.assertFalse(self.model.objects.filter(age=30).exists())
+        self.assertEqual(self.statements[0], ('SELECT 1 FROM Person Person WHERE (Person."age" = ?) LIMIT 1', [3]))
+        self.assertFalse(self.model.objects.all()[10:].exists())
+        self.assertTrue(self.model.objects.all()[9:].exists())
+
+    def test_556_012_count_exists_cached(self):
+        """Test that count and exists use the results of an evaluated query set"""
+        qs = self.model.objects.filter(age__lt=5)
+        list(qs)
+        self.assertEqual(qs.count(), 5)
+        self.assertTrue(qs.exists())
+        self.assertEqual(len(self.statements), 1)
+        self.assertFalse(qs.none().exists())
+
+
+class TestAggregation(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Author(Model):
+            _engine = self.engine
+            _order_by = ['id']
+            name = fields.CharField()
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Book(Model):
+            _engine = self.engine
+            title = fields.CharField()
+            pages = fields.IntegerField()
+            price = fields.IntegerField()
+            author = fields.ForeignKey(Author)
+
+        self.Author, self.Book = Author, Book
+        self.connection = self.engine.connect()
+        self.connection.executescript('''
+            CREATE TABLE Author (id integer PRIMARY KEY, name text);
+            CREATE TABLE Book (id integer PRIMARY KEY, title text, pages integer, price integer, author_id integer);
+            INSERT INTO Author VALUES (1, 'Austen'), (2, 'Bronte');
+            INSERT INTO Book VALUES (1, 'Emma', 400, 10, 1), (2, 'Persuasion', 250, 8, 1),
+                                    (3, 'Shirley', 500, 10, 2), (4, 'Villette', 600, 12, 2), (5, 'Draft', 50, 1, NULL);
+        ''')
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_557_000_aggregate(self):
+        """Test that aggregate returns a dict of the aggregates over every row"""
+        result = self.Book.objects.all().aggregate(Sum('pages'), longest=Max('pages'), shortest=Min('pages'),
+                                                   average=Avg('price'), books=Count())
+        self.assertEqual(result, {'pages__sum': 1800, 'longest': 600, 'shortest': 50, 'average': 8.2, 'books': 5})
+
+    def test_557_001_aggregate_filtered_distinct(self):
+        """Test that aggregates use the criteria - and distinct aggregates count each value once"""
+        qs = self.Book.objects.filter(author__name='Austen')
+        self.assertEqual(qs.aggregate(total=Sum('pages')), {'total': 650})
+        self.assertEqual(self.Book.objects.all().aggregate(prices=Count('price', distinct=True)), {'prices': 4})
+        self.assertEqual(self.Book.objects.filter(pages__gt=1000).aggregate(Sum('pages')), {'pages__sum': None})
+
+    def test_557_002_aggregate_expression(self):
+        """Test that an F expression can be aggregated"""
+        self.assertEqual(self.Book.objects.all().aggregate(value=Sum(F('pages') * F('price'))),
+                         {'value': 400 * 10 + 250 * 8 + 500 * 10 + 600 * 12 + 50})
+
+    def test_557_003_aggregate_sql(self):
+        """Test that aggregate compiles the aggregates only - without the ordering"""
+        sql, params = self.engine.compile(
+            self.Book.objects.all().order_by('title').annotate(Count('price', distinct=True), alias='prices').query)
+        self.assertIn('COUNT(DISTINCT Book."price") AS "prices"', sql)
+        self.assertIn('GROUP BY Book."title", Book."pages", Book."price", Book."author_id", Book."id"', sql)
+
+    def test_557_004_values_annotate_group_by(self):
+        """Test that annotating values groups the rows by the values"""
+        qs = self.Book.objects.all().values('author').annotate(books=Count(), total=Sum('pages')).order_by('author')
+        self.assertEqual(list(qs), [{'author': None, 'books': 1, 'total': 50},
+                                    {'author': 1, 'books': 2, 'total': 650},
+                                    {'author': 2, 'books': 2, 'total': 1100}])
+        self.assertEqual(qs.count(), 3)
+        self.assertEqual(list(self.Book.objects.all().values_list('author__name').annotate(
+            longest=Max('pages')).filter(author__id__gt=0).order_by('-longest')), [('Bronte', 600), ('Austen', 400)])
+
+    def test_557_005_annotate_models(self):
+        """Test that annotations are set on model instances by their alias"""
+        books = list(self.Book.objects.all().annotate(double=Max(F('pages') * 2)).order_by('id'))
+        self.assertEqual([book.double for book in books], [800, 500, 1000, 1200, 100])
+        self.assertFalse(books[0].is_dirty())
+
+    def test_557_006_invalid(self):
+        """Test that invalid aggregations are rejected"""
+        with self.assertRaises(AttributeError):
+            self.Book.objects.all().annotate(Count())
+        with self.assertRaises(AttributeError):
+            self.Book.objects.all().annotate(pages=Count())
+        with self.assertRaises(TypeError):
+            self.Book.objects.all().aggregate()
+        with self.assertRaises(exceptions.QuerySetError):
+            self.Book.objects.all()[:2].aggregate(Sum('pages'))
+
+
+class TestBulkWrites(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Supplier(Model):
+            _engine = self.engine
+            name = fields.CharField()
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Product(Model):
+            _engine = self.engine
+            name = fields.CharField()
+            stock = fields.IntegerField()
+            price = fields.IntegerField(db_column='unit_price')
+            supplier = fields.ForeignKey(Supplier)
+
+        self.Supplier, self.Product = Supplier, Product
+        self.connection = self.engine.connect()
+        self.connection.executescript('''
+            CREATE TABLE Supplier (id integer PRIMARY KEY, name text);
+            CREATE TABLE Product (id integer PRIMARY KEY, name text, stock integer, unit_price integer,
+                                  supplier_id integer);
+            INSERT INTO Supplier VALUES (1, 'Acme'), (2, 'Bolt');
+            INSERT INTO Product VALUES (1, 'Anvil', 5, 100, 1), (2, 'Rocket', 0, 500, 1),
+                                       (3, 'Nut', 50, 1, 2), (4, 'Washer', 80, 1, NULL);
+        ''')
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def _rows(self):
+        return [tuple(row) for row in self.connection.execute(
+            'SELECT id, name, stock, unit_price, supplier_id FROM Product ORDER BY id')]
+
+    def test_558_000_update_values(self):
+        """Test that update changes every matching row in one statement - and returns the number changed"""
+        sql, params = self.engine.compile_update(self.Product.objects.filter(stock__gt=10).query, {'price': 2})
+        self.assertEqual((sql, params), ('UPDATE Product SET "unit_price" = ? WHERE (Product."stock" > ?)', [2, 10]))
+        self.assertEqual(self.Product.objects.filter(stock__gt=10).update(price=2), 2)
+        self.assertEqual([row[3] for row in self._rows()], [100, 500, 2, 2])
+
+    def test_558_001_update_f_expression(self):
+        """Test that F expressions update each row from its own values"""
+        self.assertEqual(self.Product.objects.filter(stock__gt=0).update(stock=F('stock') - 1,
+                                                                         price=F('price') * 2), 3)
+        self.assertEqual([row[2:4] for row in self._rows()], [(4, 200), (0, 500), (49, 2), (79, 2)])
+
+    def test_558_002_update_related_criteria(self):
+        """Test that criteria across a relation select the rows through a sub-query"""
+        qs = self.Product.objects.filter(supplier__name='Acme')
+        sql, params = self.engine.compile_update(qs.query, {'stock': 10})
+        self.assertIn('WHERE "id" IN (SELECT Product."id" FROM Product Product', sql)
+        self.assertEqual(qs.update(stock=10), 2)
+        self.assertEqual([row[2] for row in self._rows()], [10, 10, 50, 80])
+
+    def test_558_003_update_related_instance(self):
+        """Test that a related instance is stored by its key - and that every row is updated without criteria"""
+        bolt = self.Supplier.objects.get(name='Bolt')
+        self.assertEqual(self.Product.objects.update(supplier=bolt), 4)
+        self.assertEqual([row[4] for row in self._rows()], [2, 2, 2, 2])
+
+    def test_558_004_update_invalid(self):
+        """Test that invalid updates are rejected"""
+        with self.assertRaises(AttributeError):
+            self.Product.objects.update(weight=3)
+        with self.assertRaises(AttributeError):
+            self.Product.objects.update(id=3)
+        with self.assertRaises(AttributeError):
+            self.Product.objects.update(stock='many')
+        with self.assertRaises(exceptions.CompileError):
+            self.Product.objects.update(stock=F('supplier__id'))
+        with self.assertRaises(exceptions.CompileError):
+            self.Product.objects.all()[:2].update(stock=1)
+        self.assertEqual([row[2] for row in self._rows()], [5, 0, 50, 80])
+
+    def test_558_005_delete(self):
+        """Test that delete removes every matching row in one statement - and returns the number deleted"""
+        qs = self.Product.objects.filter(stock=0)
+        self.assertEqual(self.engine.compile_delete(qs.query), ('DELETE FROM Product WHERE (Product."stock" = ?)', [0]))
+        self.assertEqual(qs.delete(), 1)
+        self.assertEqual(self.Product.objects.filter(supplier__name='Bolt').delete(), 1)
+        self.assertEqual([row[0] for row in self._rows()], [1, 4])
+        self.assertEqual(self.Product.objects.all().delete(), 2)
+        self.assertEqual(self._rows(), [])
+
+    def test_558_006_write_clears_cache(self):
+        """Test that the results of an evaluated query set are discarded by a write"""
+        qs = self.Product.objects.filter(stock__gte=50)
+        self.assertEqual(len(qs), 2)
+        qs.update(stock=0)
+        self.assertEqual(len(qs), 0)
+
+
+class TestKeysetPagination(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Post(Model):
+            _engine = self.engine
+            title = fields.CharField()
+            score = fields.IntegerField()
+            published = fields.DateField()
+
+        self.Post = Post
+        self.connection = self.engine.connect()
+        self.connection.executescript('''
+            CREATE TABLE Post (id integer PRIMARY KEY, title text, score integer, published date);
+            INSERT INTO Post VALUES (1, 'a', 10, '2026-01-03'), (2, 'b', 20, '2026-01-01'),
+                                    (3, 'c', 10, '2026-01-02'), (4, 'd', 30, '2026-01-02'),
+                                    (5, 'e', 20, '2026-01-04'), (6, 'f', 10, '2026-01-01');
+        ''')
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def _pages(self, qs, size):
+        pages, cursor = [], None
+        while True:
+            page = list(qs.after(cursor)[:size])
+            if not page:
+                return pages
+            pages.append([post.id for post in page])
+            cursor = qs.cursor(page[-1])
+
+    def test_559_000_first_page(self):
+        """Test that a query set with no cursor starts at the first row - ordered with the primary key added"""
+        qs = self.Post.objects.all().order_by('score').after()
+        self.assertEqual(qs.query.order_by, ['score', 'id'])
+        self.assertEqual([post.id for post in qs[:3]], [1, 3, 6])
+
+    def test_559_001_row_value_comparison(self):
+        """Test that a cursor compiles to a row value comparison after the criteria"""
+        qs = self.Post.objects.filter(score__lt=30).order_by('score')
+        cursor = qs.cursor(self.Post.objects.get(id=3))
+        sql, params = self.engine.compile(qs.after(cursor)[:2].query)
+        self.assertEqual(sql, 'SELECT Post."title", Post."score", Post."published", Post."id" FROM Post Post '
+                              'WHERE (Post."score" < ?) AND (Post."score", Post."id") > (?, ?) '
+                              'ORDER BY Post."score", Post."id" LIMIT ?')
+        self.assertEqual(params, [30, 10, 3, 2])
+
+    def test_559_002_pages(self):
+        """Test that following the cursors visits every row once - in order, breaking ties on the key"""
+        self.assertEqual(self._pages(self.Post.objects.all().order_by('score'), 4), [[1, 3, 6, 2], [5, 4]])
+        self.assertEqual(self._pages(self.Post.objects.all().order_by('-score'), 2), [[4, 5], [2, 6], [3, 1]])
+        self.assertEqual(self._pages(self.Post.objects.all().order_by('published', 'title'), 5),
+                         [[2, 6, 3, 4, 1], [5]])
+
+    def test_559_003_mixed_directions(self):
+        """Test that mixed directions are expanded to a comparison per column"""
+        qs = self.Post.objects.all().order_by('-score', 'published')
+        cursor = qs.cursor(self.Post.objects.get(id=2))
+        sql, params = self.engine.compile(qs.after(cursor).query)
+        self.assertIn('WHERE ((Post."score" < ? OR Post."score" IS NULL) OR (Post."score" = ? AND Post."published" > ?) '
+                      'OR (Post."score" = ? AND Post."published" = ? AND Post."id" > ?))', sql)
+        self.assertEqual(params, [20, 20, datetime.date(2026, 1, 1), 20, datetime.date(2026, 1, 1), 2])
+        self.assertEqual(self._pages(qs, 4), [[4, 2, 5, 6], [3, 1]])
+
+    def test_559_004_reverse(self):
+        """Test that reversing a seeked query set returns the rows before the cursor - nearest first"""
+        qs = self.Post.objects.all().order_by('score')
+        cursor = qs.cursor(self.Post.objects.get(id=5))
+        previous = qs.after(cursor).reverse()
+        self.assertEqual(previous.query.order_by, ['-score', '-id'])
+        self.assertEqual([post.id for post in previous], [2, 6, 3, 1])
+        self.assertEqual([post.id for post in qs.reverse().after(cursor)], [2, 6, 3, 1])
+        self.assertEqual(previous.count(), 4)
+
+    def test_559_005_cursors_are_opaque(self):
+        """Test that a cursor is a url safe string which round trips dates & values from a row dictionary"""
+        qs = self.Post.objects.all().order_by('published')
+        cursor = qs.cursor({'published': datetime.date(2026, 1, 2), 'id': 3})
+        self.assertIsInstance(cursor, str)
+        self.assertRegex(cursor, r'^[A-Za-z0-9_=-]+$')
+        self.assertEqual(qs.after(cursor).query.keyset, [datetime.date(2026, 1, 2), 3])
+        self.assertEqual([post.id for post in qs.after(cursor)], [4, 1, 5])
+
+    def test_559_006_invalid_cursors(self):
+        """Test that a malformed cursor, or one taken from another ordering, is rejected"""
+        qs = self.Post.objects.all().order_by('score')
+        cursor = self.Post.objects.all().order_by('title').cursor(self.Post.objects.get(id=1))
+        with self.assertRaises(exceptions.CursorError):
+            qs.after(cursor)
+        with self.assertRaises(exceptions.CursorError):
+            qs.after('not a cursor')
+        with self.assertRaises(exceptions.CursorError):
+            qs.cursor({'score': 10})
+        with self.assertRaises(exceptions.QuerySetError):
+            self.Post.objects.all().order_by(F('score') + 1).after()
+
+    def test_559_007_null_values(self):
+        """Test that NULLs are paged in sqlite's order - first ascending, last descending"""
+        self.connection.execute('UPDATE Post SET title = NULL, score = NULL WHERE id IN (2, 5)')
+        for ordering, expected in ((('title',), [[2, 5], [1, 3], [4, 6]]),
+                                   (('-title',), [[6, 4], [3, 1], [5, 2]]),
+                                   (('-score', 'title'), [[4, 1, 3], [6, 2, 5]])):
+            with self.subTest(ordering=ordering):
+                qs = self.Post.objects.all().order_by(*ordering)
+                self.assertEqual(sum(self._pages(qs, 3 if len(ordering) > 1 else 2), []),
+                                 [post.id for post in qs.after()])
+                self.assertEqual(self._pages(qs, 3 if len(ordering) > 1 else 2), expected)
+
+        qs = self.Post.objects.all().order_by('title')
+        sql, params = self.engine.compile(qs.after(qs.cursor(self.Post.objects.get(id=2))).query)
+        self.assertIn('WHERE ((Post."title" IS NOT NULL) OR (Post."title" IS NULL AND Post."id" > ?))', sql)
+        self.assertEqual(params, [2])
+
+class TestSession(unittest.TestCase):
+    # noinspection PyMissingOrEmptyDocstring
+    def setUp(self):
+        self.engine = Engine(':memory:')
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Writer(Model):
+            _engine = self.engine
+            name = fields.CharField()
+
+        # noinspection PyMissingOrEmptyDocstring
+        class Novel(Model):
+            _engine = self.engine
+            title = fields.CharField()
+            writer = fields.ForeignKey(Writer)
+
+        self.Writer, self.Novel = Writer, Novel
+        self.connection = self.engine.connect()
+        self.connection.executescript('''
+            CREATE TABLE Writer (id integer PRIMARY KEY, name text);
+            CREATE TABLE Novel (id integer PRIMARY KEY, title text, writer_id integer);
+            INSERT INTO Writer VALUES (1, 'Austen'), (2, 'Bronte');
+            INSERT INTO Novel VALUES (1, 'Emma', 1), (2, 'Persuasion', 1), (3, 'Shirley', 2);
+        ''')
+        self.statements = []
+        execute = self.engine._execute
+
+        # noinspection PyMissingOrEmptyDocstring
+        def spy(connection, sql, params, many=False):
+            self.statements.append(sql)
+            return execute(connection, sql, params, many=many)
+        self.engine._execute = spy
+
+    # noinspection PyMissingOrEmptyDocstring
+    def tearDown(self):
+        self.connection.close()
+        Engine.reset()
+
+    def test_560_000_no_session(self):
+        """Without a session every query builds new instances"""
+        self.assertIsNone(Session.current())
+        self.assertIsNot(self.Writer.objects.get(id=1), self.Writer.objects.get(id=1))
+
+    def test_560_001_same_instance(self):
+        """Within a session the same primary key is the same instance - across query sets & related selects"""
+        with Session() as session:
+            self.assertIs(Session.current(), session)
+            austen = self.Writer.objects.get(id=1)
+            self.assertIs(self.Writer.objects.filter(name='Austen').get(), austen)
+            novels = list(self.Novel.objects.select_related('writer').filter(writer=1))
+            self.assertTrue(all(novel.writer is austen for novel in novels))
+            self.assertIn(austen, session)
+            self.assertEqual(len(session), 3)
+        self.assertIsNone(Session.current())
+
+    def test_560_002_get_without_query(self):
+        """Getting an instance in the session by its primary key executes nothing"""
+        with Session():
+            writers = list(self.Writer.objects.all())
+            del self.statements[:]
+            self.assertIs(self.Writer.objects.get(id=2), writers[1])
+            self.assertIs(self.Writer.objects.get(id__exact=1), writers[0])
+            self.assertEqual(self.statements, [])
+            with self.assertRaises(exceptions.DoesNotExist):
+                self.Writer.objects.filter(name='Austen').get(id=2)
+
+    def test_560_003_changes_kept(self):
+        """Changes made in the session aren't overwritten by later queries - and are saved when it ends"""
+        with Session():
+            austen = self.Writer.objects.get(id=1)
+            austen.name = 'Jane Austen'
+            self.assertEqual(self.Writer.objects.all()[0].name, 'Jane Austen')
+            del self.statements[:]
+        self.assertEqual([sql for sql in self.statements if sql.startswith('UPDATE')],
+                         ['UPDATE Writer SET "name" = ? WHERE "id" = ?'])
+        self.assertEqual(self.Writer.objects.get(id=1).name, 'Jane Austen')
+
+    def test_560_004_nested_and_rolled_back(self):
+        """The innermost session is active - and a session ended by an exception saves nothing"""
+        with Session() as outer:
+            outer_austen = self.Writer.objects.get(id=1)
+            with self.assertRaises(RuntimeError):
+                with Session() as inner:
+                    self.assertIs(Session.current(), inner)
+                    austen = self.Writer.objects.get(id=1)
+                    self.assertIsNot(austen, outer_austen)
+                    austen.name = 'changed'
+                    raise RuntimeError
+            self.assertIs(Session.current(), outer)
+        self.assertEqual(self.Writer.objects.get(id=1).name, 'Austen')
+
+    def test_560_005_saved_instances_added(self):
+        """An instance saved in the session is in its identity map"""
+        with Session() as session:
+            bronte = self.Writer(name='Anne Bronte')
+            bronte.save()
+            self.assertIn(bronte, session)
+            self.assertIs(self.Writer.objects.get(name='Anne Bronte'), bronte)
+
+    def test_560_006_deleted_evicted(self):
+        """Rows deleted in the session are evicted - and their unsaved changes aren't flushed"""
+        with Session() as session:
+            austen = self.Writer.objects.get(id=1)
+            bronte = self.Writer.objects.get(id=2)
+            austen.name = 'changed'
+            self.Writer.objects.filter(id=1).delete()
+            self.assertIsNone(session.get(self.Writer, 1))
+            self.assertNotIn(austen, session)
+            self.assertIn(bronte, session)
+            with self.assertRaises(exceptions.DoesNotExist):
+                self.Writer.objects.get(id=1)
+        self.assertEqual([writer.name for writer in self.Writer.objects.all()], ['Bronte'])
+
+    def test_560_007_updated_evicted(self):
+        """Rows updated in the session are evicted - the next query loads their new values"""
+        with Session() as session:
+            novels = list(self.Novel.objects.all())
+            self.Novel.objects.filter(writer=1).update(title='Untitled')
+            self.assertNotIn(novels[0], session)
+            self.assertIn(novels[2], session)
+            self.assertEqual([novel.title for novel in self.Novel.objects.all()], ['Untitled', 'Untitled', 'Shirley'])
+            self.assertIs(self.Novel.objects.get(id=3), novels[2])
+
+
+
 # noinspection PyMissingOrEmptyDocstring
 def load_tests(loader, tests=None, pattern=None):
     classes = [cls for name, cls in inspect.getmembers(sys.modules[__name__],